@@ -0,0 +1,95 @@
+"""
+Benchmark for embedding transfer formats.
+
+Compares JSON float lists with base64 packed float32 (``encoding_format:
+"base64"``) in two ways:
+
+- decode: ``_parse_embeddings`` on pre-built response bodies, which isolates
+  JSON float parsing and list allocation from the network
+- end to end: ``embed_batch`` against the in-process fake LM Studio server
+
+Both report vectors per second; higher is better.
+
+    python benchmarks/bench_embedding_transfer.py --dim 1024 --batch 64
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import time
+from array import array
+
+from fake_server import EMBEDDING_ID, FakeConfig, FakeLMStudio, embedding_vector
+
+import llm_lmstudio
+
+ENCODINGS = ("float", "base64")
+
+
+def build_body(encoding: str, count: int, dim: int) -> bytes:
+    data = []
+    for index in range(count):
+        vector = embedding_vector(index, dim)
+        if encoding == "base64":
+            value = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+        else:
+            value = vector
+        data.append({"object": "embedding", "index": index, "embedding": value})
+    return json.dumps({"object": "list", "data": data}).encode("utf-8")
+
+
+def best_rate(function, count: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--inputs", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        f"lmstudio/{EMBEDDING_ID}", "http://localhost:1234", EMBEDDING_ID, "/api/v0"
+    )
+    inputs = [f"document {i}" for i in range(args.batch)]
+    print(
+        f"codec {llm_lmstudio._codec.name}, {args.dim} dimensions, "
+        f"batches of {args.batch}, best of {args.repeat}"
+    )
+    print("decode (vectors/s):")
+    for encoding in ENCODINGS:
+        body = build_body(encoding, args.batch, args.dim)
+        rate = best_rate(
+            lambda: model._parse_embeddings(body, inputs), args.batch, args.repeat
+        )
+        print(f"  {encoding:<7} {rate:12,.0f}   {len(body) / args.batch:9,.0f} B/vector")
+
+    print("end to end against the fake server (vectors/s):")
+    texts = [f"document {i}" for i in range(args.inputs)]
+    encoding = llm_lmstudio.EMBED_ENCODING
+    with FakeLMStudio(FakeConfig(embedding_dim=args.dim)) as server:
+        model = llm_lmstudio.LMStudioEmbeddingModel(
+            f"lmstudio/{EMBEDDING_ID}", server.url, EMBEDDING_ID, "/api/v0"
+        )
+        try:
+            for name in ENCODINGS:
+                llm_lmstudio.EMBED_ENCODING = name
+                rate = best_rate(
+                    lambda: list(model.embed_batch(texts)), args.inputs, args.repeat
+                )
+                print(f"  {name:<7} {rate:12,.0f}")
+        finally:
+            llm_lmstudio.EMBED_ENCODING = encoding
+
+
+if __name__ == "__main__":
+    main()
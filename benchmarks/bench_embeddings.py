@@ -0,0 +1,171 @@
+"""
+Embedding throughput benchmark.
+
+Runs ``LMStudioEmbeddingModel.embed_batch`` against the fake LM Studio server
+from ``fake_server.py`` for every combination of request batch size
+(``EMBED_BATCH_SIZE``), vector dimensions and requests in flight
+(``EMBED_CONCURRENCY``), and reports for each:
+
+- vectors per second
+- response bytes parsed per vector
+- tracemalloc peak while embedding, in KiB
+
+The server runs in a child process, one per dimension, so that its response
+buffers and CPU time are not counted. The embedding cache is disabled.
+
+``--json`` and ``--baseline`` work as in ``bench_plugin.py``.
+
+    python benchmarks/bench_embeddings.py --batch-sizes 8,32,128 --dims 384,1024
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from bench_plugin import compare
+from fake_server import EMBEDDING_ID, FakeConfig, FakeLMStudio
+
+import llm_lmstudio
+
+
+class CountingEmbeddingModel(llm_lmstudio.LMStudioEmbeddingModel):
+    """Counts the response bytes handed to the parser."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.parsed_bytes = 0
+        self._lock = threading.Lock()
+
+    def _parse_embeddings(self, content, inputs):
+        with self._lock:
+            self.parsed_bytes += len(content)
+        return super()._parse_embeddings(content, inputs)
+
+
+def serve(dim: int, urls, stop) -> None:
+    with FakeLMStudio(FakeConfig(embedding_dim=dim)) as server:
+        urls.put(server.url)
+        stop.wait()
+
+
+@contextmanager
+def fake_server(dim: int):
+    """Run a fake server for ``dim``-dimensional vectors in a child process."""
+    context = multiprocessing.get_context("spawn")
+    urls = context.Queue()
+    stop = context.Event()
+    process = context.Process(target=serve, args=(dim, urls, stop), daemon=True)
+    process.start()
+    try:
+        yield urls.get(timeout=30)
+    finally:
+        stop.set()
+        process.join()
+
+
+def reset_pool(url: str) -> None:
+    """Drop the server's thread pool; its size is fixed when it is created."""
+    pool = llm_lmstudio._embedding_pools.pop(url, None)
+    if pool is not None:
+        pool.shutdown()
+
+
+def run(url: str, texts: list[str], repeat: int) -> dict[str, float]:
+    model = CountingEmbeddingModel(
+        f"lmstudio/{EMBEDDING_ID}", url, EMBEDDING_ID, "/api/v0"
+    )
+    reset_pool(url)
+    list(model.embed_batch(texts[: model.batch_size]))  # warm up
+    model.parsed_bytes = 0
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in model.embed_batch(texts))
+        best = min(best, time.perf_counter() - start)
+        assert count == len(texts)
+    tracemalloc.start()
+    try:
+        for _ in model.embed_batch(texts):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "vectors_per_second": len(texts) / best,
+        "bytes_per_vector": model.parsed_bytes / ((repeat + 1) * len(texts)),
+        "peak_kib": peak / 1024,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--inputs", type=int, default=2048)
+    parser.add_argument("--batch-sizes", default="8,32,128")
+    parser.add_argument("--dims", default="384,768,1024")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with results from --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    dims = [int(dim) for dim in args.dims.split(",")]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    llm_lmstudio._embedding_cache = None
+    texts = [f"document {i} " * 8 for i in range(args.inputs)]
+    print(
+        f"codec {llm_lmstudio._codec.name}, encoding {llm_lmstudio.EMBED_ENCODING}, "
+        f"{args.inputs} inputs, best of {args.repeat}"
+    )
+    print(
+        f"  {'dim':>5} {'batch':>5} {'conc':>4} "
+        f"{'vectors/s':>11} {'B/vector':>9} {'peak KiB':>9}"
+    )
+    results: dict[str, float] = {}
+    batch_size = llm_lmstudio.EMBED_BATCH_SIZE
+    concurrency = llm_lmstudio.EMBED_CONCURRENCY
+    try:
+        for dim in dims:
+            with fake_server(dim) as url:
+                for size in batch_sizes:
+                    for level in levels:
+                        llm_lmstudio.EMBED_BATCH_SIZE = size
+                        llm_lmstudio.EMBED_CONCURRENCY = level
+                        row = run(url, texts, args.repeat)
+                        print(
+                            f"  {dim:>5} {size:>5} {level:>4} "
+                            f"{row['vectors_per_second']:>11,.0f} "
+                            f"{row['bytes_per_vector']:>9,.0f} "
+                            f"{row['peak_kib']:>9,.0f}"
+                        )
+                        prefix = f"embeddings.d{dim}.b{size}.c{level}"
+                        for name, value in row.items():
+                            results[f"{prefix}.{name}"] = value
+    finally:
+        llm_lmstudio.EMBED_BATCH_SIZE = batch_size
+        llm_lmstudio.EMBED_CONCURRENCY = concurrency
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        if regressions:
+            print("Regressions beyond tolerance:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
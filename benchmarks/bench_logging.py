@@ -0,0 +1,107 @@
+"""
+Benchmark for debug logging on the stream parsing path.
+
+Runs the ``SSEParser`` stream path with debug logging disabled, compares it
+with a build where ``_debug`` does nothing and with the previous ``_debug``
+that checked the environment variable on each call, and then measures it with
+debug logging enabled. Use ``--malformed-every`` to add malformed chunks that
+reach the debug calls.
+
+    python benchmarks/bench_logging.py --tokens 20000 --malformed-every 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+from bench_sse import build_stream, sse_path
+
+import llm_lmstudio
+
+
+def build_body(tokens: int, malformed_every: int) -> bytes:
+    if not malformed_every:
+        return build_stream(tokens)
+    events = build_stream(tokens).split(b"\n\n")
+    bad = b'data: {"choices":[{"delta":{"content":42}}]}'
+    for i in range(len(events) - 3, 0, -malformed_every):
+        events.insert(i, bad)
+    return b"\n\n".join(events)
+
+
+def getenv_debug(message: str, *args) -> None:
+    """The ``_debug`` used before the move to ``logging``."""
+    if os.getenv("LLM_LMSTUDIO_DEBUG") == "1":
+        print(message % args if args else message, file=sys.stderr)
+
+
+def run_once(model, body: bytes, chunk_size: int) -> float:
+    start = time.perf_counter()
+    for _ in sse_path(model, body, chunk_size):
+        pass
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--malformed-every",
+        type=int,
+        default=0,
+        help="insert a malformed chunk every N events",
+    )
+    args = parser.parse_args()
+
+    model = llm_lmstudio.LMStudioModel(
+        "lmstudio/bench", "http://localhost:1234", "bench-model", "/api/v0"
+    )
+    body = build_body(args.tokens, args.malformed_every)
+    os.environ.pop("LLM_LMSTUDIO_DEBUG", None)
+    print(
+        f"{args.tokens} tokens, {len(body)} bytes, "
+        f"{args.chunk_size}-byte reads, best of {args.repeat}"
+    )
+
+    debug = llm_lmstudio._debug
+    variants = (
+        ("no logging", lambda message, *args: None, False),
+        ("os.getenv check", getenv_debug, False),
+        ("logging, disabled", debug, False),
+        ("logging, enabled", debug, True),
+    )
+    memory_handler = logging.StreamHandler(io.StringIO())
+    memory_handler.setFormatter(llm_lmstudio._stderr_handler.formatter)
+    run_once(model, body, args.chunk_size)  # warm up
+    best = {name: float("inf") for name, _, _ in variants}
+    # Interleave the variants so that drift affects them all equally.
+    for _ in range(args.repeat):
+        for name, function, enabled in variants:
+            llm_lmstudio._debug = function
+            llm_lmstudio.configure_logging(enabled)
+            if enabled:
+                # Measure formatting and dispatch, not terminal output.
+                llm_lmstudio.logger.removeHandler(llm_lmstudio._stderr_handler)
+                llm_lmstudio.logger.addHandler(memory_handler)
+            try:
+                elapsed = run_once(model, body, args.chunk_size)
+            finally:
+                llm_lmstudio.logger.removeHandler(memory_handler)
+                llm_lmstudio.configure_logging(False)
+                llm_lmstudio._debug = debug
+            best[name] = min(best[name], elapsed)
+    for name, elapsed in best.items():
+        print(
+            f"  {name:<18} {elapsed * 1000:8.1f} ms total "
+            f"{elapsed / args.tokens * 1e6:6.2f} µs/token"
+        )
+
+if __name__ == "__main__":
+    main()
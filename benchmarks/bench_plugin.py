@@ -0,0 +1,351 @@
+"""
+Offline benchmark suite for plugin overhead.
+
+Starts the in-process fake LM Studio server from ``fake_server.py`` and
+measures ``LMStudioModel``, ``LMStudioAsyncModel`` and
+``LMStudioEmbeddingModel`` without any network access:
+
+- cpu: CPU time of the consuming thread per streamed token and per request,
+  for text and tool-call streams (the fake server runs in other threads)
+- ttft: overhead from calling ``execute`` to the server receiving the request,
+  and from the server writing the first token to the first yielded event
+- memory: tracemalloc peak per stream
+- load: time added on top of the server's model-load delay when the model
+  has to be loaded first
+- concurrency: aggregate tokens/s and mean TTFT for concurrent streams
+- embeddings: inputs/s for several batch sizes
+
+``--json`` writes the results. ``--baseline`` compares them with an earlier
+``--json`` file and exits with status 1 if a metric regressed by more than
+``--tolerance``.
+
+    python benchmarks/bench_plugin.py --tokens 2000 --json results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import llm
+from fake_server import EMBEDDING_ID, LLM_ID, FakeConfig, FakeLMStudio
+
+import llm_lmstudio
+
+SEARCH_TOOL = llm.Tool(
+    name="search",
+    description="Search for a query.",
+    input_schema={
+        "type": "object",
+        "properties": {"query": {"type": "string"}},
+        "required": ["query"],
+    },
+)
+
+# Metrics where a larger value is better; every other metric is a cost.
+HIGHER_IS_BETTER = (
+    "tokens_per_second",
+    "inputs_per_second",
+    "vectors_per_second",
+)
+
+
+class NullResponse:
+    """The parts of ``llm.Response`` that the plugin calls, doing nothing."""
+
+    def __init__(self) -> None:
+        self.response_json = None
+
+    def set_usage(self, **kwargs) -> None:
+        pass
+
+    def set_resolved_model(self, model_id: str) -> None:
+        pass
+
+    def add_tool_call(self, tool_call) -> None:
+        pass
+
+
+def make_prompt(model, tool_call: bool = False) -> llm.Prompt:
+    return llm.Prompt(
+        "Hello",
+        model,
+        messages=[llm.user("Hello")],
+        tools=[SEARCH_TOOL] if tool_call else [],
+    )
+
+
+def run_sync(model, prompt, stream: bool = True) -> tuple[float, int]:
+    """Consume one response; return (seconds to first event, event count)."""
+    start = time.perf_counter()
+    first = None
+    count = 0
+    for _ in model.execute(prompt, stream, NullResponse(), None):
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+    return first or 0.0, count
+
+
+async def run_async(model, prompt, stream: bool = True) -> tuple[float, int]:
+    start = time.perf_counter()
+    first = None
+    count = 0
+    async for _ in model.execute(prompt, stream, NullResponse(), None):
+        if first is None:
+            first = time.perf_counter() - start
+        count += 1
+    return first or 0.0, count
+
+
+def thread_cpu(function: Callable[[], object]) -> float:
+    start = time.thread_time()
+    function()
+    return time.thread_time() - start
+
+
+def bench_cpu(server, models, tokens: int, repeat: int) -> dict[str, float]:
+    """Fit consuming-thread CPU time to ``fixed + tokens * per_token``."""
+    results = {}
+    sync_model, async_model = models
+    for tool_call in (False, True):
+        kind = "tool_call" if tool_call else "text"
+        sync_prompt = make_prompt(sync_model, tool_call)
+        async_prompt = make_prompt(async_model, tool_call)
+        runners = (
+            ("sync", lambda: run_sync(sync_model, sync_prompt)),
+            ("async", lambda: asyncio.run(run_async(async_model, async_prompt))),
+        )
+        for name, runner in runners:
+            server.configure(tokens=1, tool_call=tool_call, token_rate=0.0)
+            runner()  # warm up imports and the codec
+            cpu = {}
+            for count in (1, tokens):
+                server.configure(tokens=count, tool_call=tool_call, token_rate=0.0)
+                cpu[count] = min(thread_cpu(runner) for _ in range(repeat))
+            per_token = (cpu[tokens] - cpu[1]) / (tokens - 1)
+            results[f"cpu.{name}.{kind}.us_per_token"] = per_token * 1e6
+            results[f"cpu.{name}.{kind}.request_ms"] = (cpu[1] - per_token) * 1000
+    server.configure(tokens=tokens, tool_call=False)
+    return results
+
+
+def bench_ttft(server, models, repeat: int) -> dict[str, float]:
+    results = {}
+    server.configure(tool_call=False, token_rate=0.0, prefill_delay=0.0)
+    sync_model, async_model = models
+    runners = (
+        ("sync", lambda: run_sync(sync_model, make_prompt(sync_model))),
+        ("async", lambda: asyncio.run(run_async(async_model, make_prompt(async_model)))),
+    )
+    for name, runner in runners:
+        before, after = [], []
+        for _ in range(repeat):
+            server.stats.request_received.clear()
+            server.stats.first_token_sent.clear()
+            called = time.perf_counter()
+            first, _ = runner()
+            before.append(server.stats.request_received[0] - called)
+            after.append(called + first - server.stats.first_token_sent[0])
+        results[f"ttft.{name}.request_ms"] = statistics.median(before) * 1000
+        results[f"ttft.{name}.first_token_ms"] = statistics.median(after) * 1000
+    return results
+
+
+def bench_memory(server, models) -> dict[str, float]:
+    results = {}
+    server.configure(tool_call=False, token_rate=0.0, prefill_delay=0.0)
+    sync_model, async_model = models
+    runners = (
+        ("sync", lambda: run_sync(sync_model, make_prompt(sync_model))),
+        ("async", lambda: asyncio.run(run_async(async_model, make_prompt(async_model)))),
+    )
+    for name, runner in runners:
+        runner()  # warm up imports and caches
+        tracemalloc.start()
+        try:
+            runner()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results[f"memory.{name}.peak_kib"] = peak / 1024
+    return results
+
+
+def bench_load(server, models, load_delay: float) -> dict[str, float]:
+    results = {}
+    server.configure(tool_call=False, token_rate=0.0, load_delay=load_delay)
+    sync_model, async_model = models
+    runners = (
+        ("sync", lambda: run_sync(sync_model, make_prompt(sync_model))),
+        ("async", lambda: asyncio.run(run_async(async_model, make_prompt(async_model)))),
+    )
+    for name, runner in runners:
+        server.configure(loaded=False)
+        first, _ = runner()
+        results[f"load.{name}.overhead_ms"] = (first - load_delay) * 1000
+    server.configure(loaded=True, load_delay=0.0)
+    return results
+
+
+def bench_concurrency(
+    server, models, tokens: int, token_rate: float, levels: list[int]
+) -> dict[str, float]:
+    results = {}
+    server.configure(tool_call=False, token_rate=token_rate, prefill_delay=0.0)
+    sync_model, async_model = models
+
+    async def gather(level: int):
+        return await asyncio.gather(
+            *(run_async(async_model, make_prompt(async_model)) for _ in range(level))
+        )
+
+    for level in levels:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(level) as pool:
+            sync_runs = list(
+                pool.map(
+                    lambda _: run_sync(sync_model, make_prompt(sync_model)),
+                    range(level),
+                )
+            )
+        sync_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        async_runs = asyncio.run(gather(level))
+        async_elapsed = time.perf_counter() - start
+        for name, runs, elapsed in (
+            ("sync", sync_runs, sync_elapsed),
+            ("async", async_runs, async_elapsed),
+        ):
+            prefix = f"concurrency.{name}.c{level}"
+            results[f"{prefix}.tokens_per_second"] = level * tokens / elapsed
+            results[f"{prefix}.ttft_ms"] = statistics.mean(r[0] for r in runs) * 1000
+    return results
+
+
+def bench_embeddings(
+    server, model, inputs: int, batch_sizes: list[int]
+) -> dict[str, float]:
+    results = {}
+    texts = [f"document {i} " * 8 for i in range(inputs)]
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for offset in range(0, inputs, batch_size):
+            vectors = list(model.embed_batch(texts[offset : offset + batch_size]))
+            assert len(vectors) == len(texts[offset : offset + batch_size])
+        elapsed = time.perf_counter() - start
+        results[f"embeddings.b{batch_size}.inputs_per_second"] = inputs / elapsed
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, value in results.items():
+        before = baseline.get(name)
+        # A ratio against zero or a negative value means nothing.
+        if before is None or before <= 0:
+            continue
+        if name.endswith(HIGHER_IS_BETTER):
+            change = (before - value) / before
+        else:
+            change = (value - before) / before
+        if change > tolerance:
+            regressions.append(f"{name}: {before:.2f} -> {value:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--token-rate",
+        type=float,
+        default=500.0,
+        help="tokens per second per stream in the concurrency benchmark",
+    )
+    parser.add_argument("--load-delay", type=float, default=0.25)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--embedding-inputs", type=int, default=512)
+    parser.add_argument("--batch-sizes", default="1,16,64")
+    parser.add_argument(
+        "--only",
+        default="cpu,ttft,memory,load,concurrency,embeddings",
+        help="comma-separated subset of benchmarks to run",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with results from --json")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    only = set(args.only.split(","))
+
+    config = FakeConfig(tokens=args.tokens)
+    results: dict[str, float] = {}
+    with FakeLMStudio(config) as server:
+        sync_model = llm_lmstudio.LMStudioModel(
+            f"lmstudio/{LLM_ID}", server.url, LLM_ID, "/api/v0"
+        )
+        async_model = llm_lmstudio.LMStudioAsyncModel(
+            f"lmstudio/{LLM_ID}", server.url, LLM_ID, "/api/v0"
+        )
+        embedding_model = llm_lmstudio.LMStudioEmbeddingModel(
+            f"lmstudio/{EMBEDDING_ID}", server.url, EMBEDDING_ID, "/api/v0"
+        )
+        models = (sync_model, async_model)
+        print(
+            f"fake server {server.url}, {args.tokens} tokens per response, "
+            f"{threading.active_count()} threads"
+        )
+        if "cpu" in only:
+            results.update(bench_cpu(server, models, args.tokens, args.repeat))
+        if "ttft" in only:
+            results.update(bench_ttft(server, models, args.repeat))
+        if "memory" in only:
+            results.update(bench_memory(server, models))
+        if "load" in only:
+            results.update(bench_load(server, models, args.load_delay))
+        if "concurrency" in only:
+            levels = [int(level) for level in args.concurrency.split(",")]
+            concurrency_tokens = min(args.tokens, 500)
+            server.configure(tokens=concurrency_tokens)
+            results.update(
+                bench_concurrency(
+                    server, models, concurrency_tokens, args.token_rate, levels
+                )
+            )
+            server.configure(tokens=args.tokens)
+        if "embeddings" in only:
+            batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+            results.update(
+                bench_embeddings(
+                    server, embedding_model, args.embedding_inputs, batch_sizes
+                )
+            )
+
+    width = max(map(len, results), default=0)
+    for name, value in results.items():
+        print(f"  {name:<{width}} {value:10.2f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        if regressions:
+            print("Regressions beyond tolerance:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
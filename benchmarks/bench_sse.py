@@ -0,0 +1,131 @@
+"""
+Microbenchmark for the stream parsing path.
+
+Compares the previous line-based path (``iter_lines`` → decode → string
+slicing) with the byte-level ``SSEParser`` on a synthetic LM Studio stream and
+reports the overhead per streamed token, both for SSE framing alone and
+including JSON decoding and event processing.
+
+    python benchmarks/bench_sse.py --tokens 20000 --chunk-size 512
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import time
+from collections.abc import Callable, Iterator
+
+import requests
+
+import llm_lmstudio
+
+
+def build_stream(tokens: int) -> bytes:
+    lines = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "bench-model",
+            "choices": [{"index": 0, "delta": {"content": f"tok{i} "}}],
+        }
+        lines.append(f"data: {json.dumps(chunk)}\n\n")
+    usage = {"prompt_tokens": 10, "completion_tokens": tokens}
+    lines.append(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode("utf-8")
+
+
+def make_response(body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(body)
+    return response
+
+
+def line_path(model, body: bytes, chunk_size: int) -> Iterator:
+    """The parsing loop used before ``SSEParser`` was introduced."""
+    state = llm_lmstudio.StreamState()
+    for line in make_response(body).iter_lines(chunk_size=chunk_size):
+        yield from model._process_stream_line(line.decode("utf-8"), state)
+
+
+def line_framing(model, body: bytes, chunk_size: int) -> Iterator:
+    for line in make_response(body).iter_lines(chunk_size=chunk_size):
+        line = line.decode("utf-8")
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data != "[DONE]":
+                yield data
+
+
+def sse_framing(model, body: bytes, chunk_size: int) -> Iterator:
+    parser = llm_lmstudio.SSEParser()
+    for raw_chunk in make_response(body).iter_content(chunk_size=chunk_size):
+        for data in parser.feed(raw_chunk):
+            if data != "[DONE]":
+                yield data
+    yield from parser.close()
+
+
+def sse_path(model, body: bytes, chunk_size: int) -> Iterator:
+    state = llm_lmstudio.StreamState()
+    parser = llm_lmstudio.SSEParser()
+    for raw_chunk in make_response(body).iter_content(chunk_size=chunk_size):
+        for data in parser.feed(raw_chunk):
+            yield from model._process_stream_data(data, state)
+    for data in parser.close():
+        yield from model._process_stream_data(data, state)
+
+
+def measure(
+    path: Callable[..., Iterator], model, body: bytes, chunk_size: int, repeat: int
+) -> tuple[float, int]:
+    best = float("inf")
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in path(model, body, chunk_size))
+        best = min(best, time.perf_counter() - start)
+    return best, count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    model = llm_lmstudio.LMStudioModel(
+        "lmstudio/bench", "http://localhost:1234", "bench-model", "/api/v0"
+    )
+    body = build_stream(args.tokens)
+    print(
+        f"{args.tokens} tokens, {len(body)} bytes, "
+        f"{args.chunk_size}-byte reads, best of {args.repeat}"
+    )
+    paths = (
+        ("framing only", "iter_lines", line_framing, args.tokens + 1),
+        ("framing only", "SSEParser", sse_framing, args.tokens + 1),
+        ("framing + chunk processing", "iter_lines", line_path, args.tokens),
+        ("framing + chunk processing", "SSEParser", sse_path, args.tokens),
+    )
+    section = None
+    for title, name, path, expected in paths:
+        if title != section:
+            section = title
+            print(f"{title}:")
+        elapsed, events = measure(path, model, body, args.chunk_size, args.repeat)
+        assert events == expected, (name, events)
+        print(
+            f"  {name:<11} {elapsed * 1000:8.1f} ms total "
+            f"{elapsed / args.tokens * 1e6:6.2f} µs/token"
+        )
+
+
+if __name__ == "__main__":
+    main()
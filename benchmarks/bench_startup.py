@@ -0,0 +1,101 @@
+"""
+Startup benchmark for the plugin import.
+
+``llm`` imports every installed plugin on every invocation, so the plugin's
+import cost is paid even by commands that never talk to LM Studio. This script
+runs ``python -X importtime`` in fresh interpreters, with ``llm`` imported
+first, and reports the cumulative import time of ``llm_lmstudio`` plus the
+most expensive modules that it adds. Bytecode is cached in a temporary
+directory so that source compilation is not measured.
+
+The script exits with status 1 when the best run exceeds ``--budget-ms``
+(50 ms by default), or when the import pulls in a module listed by
+``--forbid``.
+
+    python benchmarks/bench_startup.py --runs 5 --budget-ms 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+PLUGIN = "llm_lmstudio"
+# Loaded on first use, never by ``import llm_lmstudio``.
+DEFAULT_FORBIDDEN = ("requests", "httpx", "http.server")
+
+
+def importtime(code: str, pycache: str) -> dict[str, tuple[int, int]]:
+    """Run ``code`` with ``-X importtime``; map module -> (self_us, cumulative_us)."""
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def measure(runs: int) -> tuple[list[float], dict[str, tuple[int, int]]]:
+    """Return the plugin's cumulative import time per run, in milliseconds,
+    and the modules it added on the last run."""
+    with tempfile.TemporaryDirectory() as pycache:
+        code = f"import llm; import {PLUGIN}"
+        importtime(code, pycache)  # populate the bytecode cache
+        baseline = importtime("import llm", pycache)
+        timings = []
+        for _ in range(runs):
+            modules = importtime(code, pycache)
+            timings.append(modules[PLUGIN][1] / 1000)
+    added = {name: cost for name, cost in modules.items() if name not in baseline}
+    return timings, added
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    parser.add_argument(
+        "--forbid",
+        default=",".join(DEFAULT_FORBIDDEN),
+        help="comma-separated modules that the import must not load",
+    )
+    args = parser.parse_args()
+
+    timings, added = measure(args.runs)
+    best = min(timings)
+    print(
+        f"import {PLUGIN} after llm: best {best:.1f} ms, "
+        f"median {sorted(timings)[len(timings) // 2]:.1f} ms over {args.runs} runs"
+    )
+    print(f"{len(added)} modules added; most expensive (cumulative / self ms):")
+    ranked = sorted(added.items(), key=lambda item: -item[1][1])
+    for name, (self_us, cumulative_us) in ranked[: args.top]:
+        print(f"  {cumulative_us / 1000:7.1f} {self_us / 1000:7.1f}  {name}")
+
+    failures = []
+    forbidden = [name for name in args.forbid.split(",") if name in added]
+    if forbidden:
+        failures.append(f"import loads {', '.join(forbidden)}")
+    if best > args.budget_ms:
+        failures.append(f"{best:.1f} ms exceeds the {args.budget_ms:.1f} ms budget")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
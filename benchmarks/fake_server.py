@@ -0,0 +1,331 @@
+"""
+In-process fake LM Studio server for offline benchmarks.
+
+Implements the endpoints the plugin uses: model discovery (``/api/v0/models``
+and ``/v1/models``), the per-model state check, ``/api/v1/models/load``, chat
+completions (streaming and non-streaming, text or tool calls) and embeddings.
+Streams use chunked transfer encoding, as LM Studio does. Token rate, SSE
+chunking, prefill and load delays are configurable. Responses are pre-encoded,
+so the server does as little work as possible in the process being measured.
+Embeddings are returned as JSON floats, or as base64 float32 when the request
+sets ``encoding_format``.
+
+    with FakeLMStudio(FakeConfig(tokens=500, token_rate=200)) as server:
+        model = llm_lmstudio.LMStudioModel(
+            "lmstudio/fake-llm", server.url, "fake-llm", "/api/v0"
+        )
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LLM_ID = "fake-llm"
+EMBEDDING_ID = "fake-embed"
+
+
+@dataclass
+class FakeConfig:
+    tokens: int = 200  # completion tokens per chat response
+    token_rate: float = 0.0  # tokens per second; 0 streams as fast as possible
+    events_per_write: int = 1  # SSE events per socket write
+    prefill_delay: float = 0.0  # seconds before the first token
+    load_delay: float = 0.0  # seconds spent in /api/v1/models/load
+    loaded: bool = True  # whether the chat model starts loaded
+    tool_call: bool = False  # stream a tool call instead of text
+    embedding_dim: int = 768
+    prompt_tokens: int = 32
+
+
+@dataclass
+class ServerStats:
+    """Timestamps on the shared ``time.perf_counter`` clock."""
+
+    requests: int = 0
+    loads: int = 0
+    request_received: list[float] = field(default_factory=list)
+    first_token_sent: list[float] = field(default_factory=list)
+
+
+def _sse(payload: dict) -> bytes:
+    return b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+
+
+def _chunk(delta: dict, finish_reason: str | None = None) -> dict:
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": LLM_ID,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def build_stream_events(config: FakeConfig) -> list[bytes]:
+    """Return the SSE events for one streamed chat response."""
+    if config.tool_call:
+        query = " ".join(f"w{i}" for i in range(config.tokens))
+        arguments = json.dumps({"query": query})
+        step = max(1, len(arguments) // config.tokens)
+        fragments = [arguments[i : i + step] for i in range(0, len(arguments), step)]
+        events = [
+            _sse(
+                _chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "id": "call_fake",
+                                "type": "function",
+                                "function": {"name": "search", "arguments": ""},
+                            }
+                        ]
+                    }
+                )
+            )
+        ]
+        events += [
+            _sse(
+                _chunk(
+                    {"tool_calls": [{"index": 0, "function": {"arguments": fragment}}]}
+                )
+            )
+            for fragment in fragments
+        ]
+        finish_reason = "tool_calls"
+    else:
+        events = [_sse(_chunk({"content": f"tok{i} "})) for i in range(config.tokens)]
+        finish_reason = "stop"
+    events.append(_sse(_chunk({}, finish_reason)))
+    usage = {
+        "prompt_tokens": config.prompt_tokens,
+        "completion_tokens": config.tokens,
+        "total_tokens": config.prompt_tokens + config.tokens,
+    }
+    events.append(_sse({"choices": [], "usage": usage}))
+    events.append(b"data: [DONE]\n\n")
+    return events
+
+
+# Embedding vectors repeat with this period, so they can be pre-encoded.
+EMBEDDING_PERIOD = 97
+
+
+def embedding_vector(index: int, dim: int) -> list[float]:
+    """The vector the fake server returns for input ``index``."""
+    return [((index + j) % EMBEDDING_PERIOD) / EMBEDDING_PERIOD for j in range(dim)]
+
+
+def build_embedding_items(dim: int) -> dict[str, list[bytes]]:
+    """Pre-encoded ``"embedding"`` values, one per vector in the period."""
+    items: dict[str, list[bytes]] = {"float": [], "base64": []}
+    for index in range(EMBEDDING_PERIOD):
+        vector = embedding_vector(index, dim)
+        items["float"].append(json.dumps(vector).encode("utf-8"))
+        packed = base64.b64encode(array("f", vector).tobytes())
+        items["base64"].append(b'"' + packed + b'"')
+    return items
+
+
+def build_completion(config: FakeConfig) -> bytes:
+    message: dict = {"role": "assistant"}
+    if config.tool_call:
+        message["content"] = ""
+        message["tool_calls"] = [
+            {
+                "id": "call_fake",
+                "type": "function",
+                "function": {"name": "search", "arguments": '{"query": "fake"}'},
+            }
+        ]
+    else:
+        message["content"] = "".join(f"tok{i} " for i in range(config.tokens))
+    return json.dumps(
+        {
+            "model": LLM_ID,
+            "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": config.prompt_tokens,
+                "completion_tokens": config.tokens,
+            },
+        }
+    ).encode("utf-8")
+
+
+class FakeLMStudio:
+    """A threaded HTTP server on a free local port, usable as a context manager."""
+
+    def __init__(self, config: FakeConfig | None = None) -> None:
+        self.config = config or FakeConfig()
+        self.stats = ServerStats()
+        self.loaded = self.config.loaded
+        self._lock = threading.Lock()
+        self._events = build_stream_events(self.config)
+        self._completion = build_completion(self.config)
+        self._embeddings = build_embedding_items(self.config.embedding_dim)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def configure(self, **changes) -> None:
+        """Change the configuration and rebuild the pre-encoded responses."""
+        for name, value in changes.items():
+            setattr(self.config, name, value)
+        self._events = build_stream_events(self.config)
+        self._completion = build_completion(self.config)
+        self._embeddings = build_embedding_items(self.config.embedding_dim)
+        if "loaded" in changes:
+            self.loaded = changes["loaded"]
+
+    def __enter__(self) -> FakeLMStudio:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _models(self) -> list[dict]:
+        return [
+            {
+                "id": LLM_ID,
+                "object": "model",
+                "type": "llm",
+                "state": "loaded" if self.loaded else "not-loaded",
+                "max_context_length": 8192,
+            },
+            {
+                "id": EMBEDDING_ID,
+                "object": "model",
+                "type": "embeddings",
+                "state": "loaded",
+                "max_context_length": 2048,
+            },
+        ]
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def _json(self, payload, status: int = 200) -> None:
+                if isinstance(payload, bytes):
+                    body = payload
+                else:
+                    body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self) -> None:
+                path = self.path.rstrip("/")
+                if path == "/api/v0/models":
+                    self._json({"object": "list", "data": server._models()})
+                elif path.startswith("/api/v0/models/"):
+                    model_id = path.rsplit("/", 1)[1]
+                    for model in server._models():
+                        if model["id"] == model_id:
+                            self._json(model)
+                            return
+                    self._json({"error": "model not found"}, 404)
+                elif path == "/v1/models":
+                    loaded = [m for m in server._models() if m["state"] == "loaded"]
+                    self._json({"object": "list", "data": loaded})
+                else:
+                    self._json({"error": "not found"}, 404)
+
+            def do_POST(self) -> None:
+                path = self.path.rstrip("/")
+                if path == "/api/v1/models/load":
+                    self._body()
+                    time.sleep(server.config.load_delay)
+                    with server._lock:
+                        server.loaded = True
+                        server.stats.loads += 1
+                    self._json(
+                        {
+                            "status": "loaded",
+                            "instance_id": LLM_ID,
+                            "load_time_seconds": server.config.load_delay,
+                        }
+                    )
+                elif path.endswith("/chat/completions"):
+                    received = time.perf_counter()
+                    payload = self._body()
+                    with server._lock:
+                        server.stats.requests += 1
+                        server.stats.request_received.append(received)
+                    if payload.get("stream"):
+                        self._stream()
+                    else:
+                        time.sleep(server.config.prefill_delay)
+                        self._json(server._completion)
+                elif path.endswith("/embeddings"):
+                    payload = self._body()
+                    inputs = payload.get("input", [])
+                    if isinstance(inputs, str):
+                        inputs = [inputs]
+                    encoding = payload.get("encoding_format") or "float"
+                    items = server._embeddings[encoding]
+                    data = b",".join(
+                        b'{"object":"embedding","index":%d,"embedding":%s}'
+                        % (i, items[i % EMBEDDING_PERIOD])
+                        for i in range(len(inputs))
+                    )
+                    self._json(
+                        b'{"object":"list","data":[%s],"model":"%s"}'
+                        % (data, EMBEDDING_ID.encode())
+                    )
+                else:
+                    self._json({"error": "not found"}, 404)
+
+            def _stream(self) -> None:
+                config = server.config
+                events = server._events
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(config.prefill_delay)
+                interval = 1 / config.token_rate if config.token_rate else 0.0
+                started = time.perf_counter()
+                step = max(1, config.events_per_write)
+                for index in range(0, len(events), step):
+                    if interval:
+                        delay = started + index * interval - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                    if index == 0:
+                        with server._lock:
+                            server.stats.first_token_sent.append(time.perf_counter())
+                    data = b"".join(events[index : index + step])
+                    try:
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        self.wfile.flush()
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
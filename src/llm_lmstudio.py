@@ -5,19 +5,43 @@ Requires llm >= 0.32 (structured messages API) and LM Studio >= 0.4.0.
 
 from __future__ import annotations
 
+import asyncio
+import atexit
+import base64
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import importlib
 import json
+import logging
 import os
+import re
+import sqlite3
+import struct
 import sys
+import threading
 import time
 import uuid
-from collections.abc import AsyncGenerator, Iterable, Iterator
-from dataclasses import dataclass, field
-from typing import Any, ClassVar, cast
+import weakref
+from array import array
+from collections import deque
+from collections.abc import (
+    AsyncGenerator,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+)
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from itertools import islice
+from typing import TYPE_CHECKING, Any, ClassVar, TypedDict, cast
 from urllib.parse import urlparse
 
-import httpx
+import click
 import llm
-import requests
 from llm.parts import (
     AttachmentPart,
     ReasoningPart,
@@ -28,6 +52,25 @@ from llm.parts import (
 )
 from pydantic import Field
 
+if TYPE_CHECKING:
+    import http.server
+
+    import httpx
+
+# ``llm`` imports every plugin on every invocation, so the HTTP clients are
+# imported by the functions that use them: requests for discovery and the sync
+# model, httpx only for the async model. ``__getattr__`` below keeps
+# ``llm_lmstudio.requests`` and ``llm_lmstudio.httpx`` available.
+_LAZY_MODULES = ("requests", "httpx")
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_MODULES:
+        module = importlib.import_module(name)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # --------------------------------------------------------------------------- #
 #  Configuration                                                              #
 # --------------------------------------------------------------------------- #
@@ -37,6 +80,180 @@ raw = (
 )  # hard default
 SERVER_LIST = [u.strip().rstrip("/") for u in raw.split(",") if u.strip()]
 TIMEOUT = float(os.getenv("LMSTUDIO_TIMEOUT", "90"))
+# Unset keeps every stream chunk in ``response_json``. An integer switches to
+# compact mode, which keeps the model, finish reason, usage and at most this
+# many leading chunks.
+_stream_chunks = os.getenv("LMSTUDIO_STREAM_CHUNKS")
+STREAM_CHUNK_LIMIT = int(_stream_chunks) if _stream_chunks else None
+# Check streamed tool-call arguments as they arrive instead of at the end.
+VALIDATE_TOOL_ARGUMENTS = os.getenv("LMSTUDIO_VALIDATE_TOOL_ARGUMENTS") == "1"
+
+# Merge consecutive text/reasoning stream events until they reach this many
+# UTF-8 bytes or the first merged fragment is this many milliseconds old.
+# Both default to 0, which disables coalescing.
+COALESCE_BYTES = int(os.getenv("LMSTUDIO_COALESCE_BYTES", "0"))
+COALESCE_MS = float(os.getenv("LMSTUDIO_COALESCE_MS", "0"))
+# Phase profiling sink: "stderr", "jsonl:<path>" or "otel". Unset disables it.
+PROFILE = os.getenv("LLM_LMSTUDIO_PROFILE", "")
+# "auto" picks orjson, then msgspec, then the standard library.
+JSON_CODEC = os.getenv("LMSTUDIO_JSON_CODEC", "auto")
+# Send debug records from the "llm_lmstudio" logger to stderr.
+DEBUG = os.getenv("LLM_LMSTUDIO_DEBUG") == "1"
+# Write Prometheus metrics to this file when the process exits.
+METRICS_FILE = os.getenv("LMSTUDIO_METRICS_FILE", "")
+# SQLite file that caches responses to temperature-0 requests. Unset disables
+# the cache; entries are evicted least recently used beyond the size limit.
+RESPONSE_CACHE = os.getenv("LMSTUDIO_RESPONSE_CACHE", "")
+RESPONSE_CACHE_MAX_MB = float(os.getenv("LMSTUDIO_RESPONSE_CACHE_MAX_MB", "256"))
+# Identical temperature-0 requests made concurrently by the async model share
+# one upstream request. Set to "0" to send each one separately.
+DEDUPLICATE_REQUESTS = os.getenv("LMSTUDIO_DEDUPLICATE_REQUESTS", "1") != "0"
+# Inputs per embeddings request, and embeddings requests in flight per server.
+EMBED_BATCH_SIZE = max(1, int(os.getenv("LMSTUDIO_EMBED_BATCH_SIZE", "32")))
+EMBED_CONCURRENCY = max(1, int(os.getenv("LMSTUDIO_EMBED_CONCURRENCY", "4")))
+# Estimated tokens per embeddings request, at about four characters a token.
+EMBED_BATCH_TOKENS = int(os.getenv("LMSTUDIO_EMBED_BATCH_TOKENS", "8192"))
+# "base64" asks for packed float32 embeddings, "float" for JSON number lists.
+# Servers that reject base64 fall back to floats automatically.
+EMBED_ENCODING = os.getenv("LMSTUDIO_EMBED_ENCODING", "base64")
+# Seconds a pooled embedding model avoids a server after a failed request.
+EMBED_SERVER_COOLDOWN = float(os.getenv("LMSTUDIO_EMBED_SERVER_COOLDOWN", "30"))
+# SQLite file that caches embeddings by model and content, shared by every
+# collection. Unset disables it.
+EMBED_CACHE = os.getenv("LMSTUDIO_EMBED_CACHE", "")
+EMBED_CACHE_MAX_MB = float(os.getenv("LMSTUDIO_EMBED_CACHE_MAX_MB", "1024"))
+# Truncate embeddings to this many dimensions and re-normalize them, for
+# Matryoshka-trained models. 0 keeps every dimension.
+EMBED_DIMENSIONS = int(os.getenv("LMSTUDIO_EMBED_DIMENSIONS", "0"))
+# "float16" rounds embeddings to half precision; "int8" scales each vector to
+# integers in [-127, 127]. Either setting, or EMBED_DIMENSIONS, also registers
+# a variant of each embedding model with the settings in its id.
+EMBED_PRECISION = os.getenv("LMSTUDIO_EMBED_PRECISION", "float32")
+# SQLite file for the semantic cache, which replays the response to an earlier
+# request whose final user message means nearly the same. Unset disables it.
+# The messages are embedded with the ``llm`` embedding model named below.
+SEMANTIC_CACHE = os.getenv("LMSTUDIO_SEMANTIC_CACHE", "")
+SEMANTIC_CACHE_MODEL = os.getenv("LMSTUDIO_SEMANTIC_CACHE_MODEL", "")
+# Minimum cosine similarity for a hit, and seconds an entry stays valid; a TTL
+# of 0 keeps entries forever.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("LMSTUDIO_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("LMSTUDIO_SEMANTIC_CACHE_TTL", "86400"))
+
+# --------------------------------------------------------------------------- #
+#  JSON codec                                                                 #
+# --------------------------------------------------------------------------- #
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class _StreamDelta(TypedDict, total=False):
+    content: str | None
+    reasoning_content: str | None
+    reasoning: str | None
+    tool_calls: list[Any] | None
+
+
+class _StreamChoice(TypedDict, total=False):
+    delta: _StreamDelta
+    finish_reason: str | None
+
+
+class _StreamChunk(TypedDict, total=False):
+    """The parts of a Chat Completions stream chunk that the plugin reads."""
+
+    model: str
+    choices: list[_StreamChoice]
+    usage: dict[str, Any] | None
+
+
+@dataclass(frozen=True)
+class JSONCodec:
+    """JSON functions used for request bodies and response payloads.
+
+    ``loads`` and ``loads_chunk`` raise ``ValueError`` for invalid JSON
+    whichever library is used. ``loads_chunk`` decodes one stream chunk and
+    may skip fields the plugin does not read.
+    """
+
+    name: str
+    loads: Callable[[bytes | str], Any]
+    dumps: Callable[[Any], bytes]
+    loads_chunk: Callable[[bytes | str], Any]
+
+
+def _stdlib_codec() -> JSONCodec:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    return JSONCodec("json", json.loads, dumps, json.loads)
+
+
+def _orjson_codec() -> JSONCodec:
+    import orjson
+
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError.
+    return JSONCodec("orjson", orjson.loads, orjson.dumps, orjson.loads)
+
+
+def _msgspec_codec() -> JSONCodec:
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    chunk_decoder = msgspec.json.Decoder(_StreamChunk)
+
+    def loads(data: bytes | str) -> Any:
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def loads_chunk(data: bytes | str) -> Any:
+        try:
+            return chunk_decoder.decode(data)
+        except msgspec.ValidationError:
+            # Valid JSON with an unexpected shape; decode it generically so
+            # the stream processor can report what is wrong with it.
+            return loads(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    return JSONCodec("msgspec", loads, msgspec.json.encode, loads_chunk)
+
+
+_JSON_CODECS: dict[str, Callable[[], JSONCodec]] = {
+    "orjson": _orjson_codec,
+    "msgspec": _msgspec_codec,
+    "json": _stdlib_codec,
+}
+
+
+def _select_json_codec(name: str) -> JSONCodec:
+    """Return the named codec, or the fastest installed one for ``auto``.
+
+    An unknown or missing codec is reported and ``auto`` is used instead.
+    """
+    if name != "auto":
+        try:
+            return _JSON_CODECS[name]()
+        except KeyError:
+            problem = (
+                f"Unknown LMSTUDIO_JSON_CODEC value {name!r}. "
+                f"Expected auto, {', '.join(_JSON_CODECS)}."
+            )
+        except ImportError:
+            problem = f"LMSTUDIO_JSON_CODEC={name} requires {name}, which is missing."
+        print(
+            f"LMSTUDIO WARN: {problem} Using the fastest installed codec.",
+            file=sys.stderr,
+        )
+    for factory in _JSON_CODECS.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+    return _stdlib_codec()
+
+
+_codec = _select_json_codec(JSON_CODEC)
 
 # --------------------------------------------------------------------------- #
 #  Internal helpers                                                           #
@@ -45,31 +262,103 @@ _cache: dict[str, tuple[list[dict[str, Any]], str]] = {}
 _errors: dict[str, Exception] = {}
 
 
-def _debug(message: str) -> None:
-    if os.getenv("LLM_LMSTUDIO_DEBUG") == "1":
-        print(message, file=sys.stderr)
+logger = logging.getLogger("llm_lmstudio")
+
+
+class _StderrHandler(logging.StreamHandler):
+    """Write to the current ``sys.stderr``, so redirection and capture apply."""
+
+    @property  # type: ignore[override]
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value) -> None:
+        pass
+
+
+_stderr_handler = _StderrHandler()
+_stderr_handler.setFormatter(logging.Formatter("LMSTUDIO %(levelname)s: %(message)s"))
+# Cached ``logger.isEnabledFor(logging.DEBUG)``; refreshed by configure_logging.
+_debug_enabled = False
+
+
+def configure_logging(enabled: bool | None = None) -> None:
+    """Attach the stderr handler when debugging is on and cache the level check.
+
+    ``enabled`` defaults to ``LLM_LMSTUDIO_DEBUG``. Applications that configure
+    the ``llm_lmstudio`` logger themselves should call this again afterwards.
+    """
+    global _debug_enabled
+    if enabled is None:
+        enabled = DEBUG
+    if enabled:
+        logger.setLevel(logging.DEBUG)
+        if _stderr_handler not in logger.handlers:
+            logger.addHandler(_stderr_handler)
+        logger.propagate = False
+    elif _stderr_handler in logger.handlers:
+        # Undo only what enabling did; keep any level set by the application.
+        logger.setLevel(logging.NOTSET)
+        logger.removeHandler(_stderr_handler)
+        logger.propagate = True
+    _debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+
+def _debug(message: str, *args: Any) -> None:
+    """Log ``message % args`` at debug level; nothing is formatted when off."""
+    if _debug_enabled:
+        logger.debug(message, *args)
+
+
+configure_logging()
+
+
+def _loaded_exception_types(*names: str) -> tuple[type[BaseException], ...]:
+    """Resolve ``"module.Error"`` names from modules that are already imported.
+
+    A module that was never imported cannot have raised, so it is skipped
+    instead of being imported just to build an ``except`` clause.
+    """
+    types = []
+    for name in names:
+        module_name, _, attribute = name.rpartition(".")
+        module = sys.modules.get(module_name)
+        if module is not None:
+            types.append(getattr(module, attribute))
+    return tuple(types)
+
+
+def _attachment_http_errors() -> tuple[type[BaseException], ...]:
+    # llm fetches URL attachments with httpx (httpx2 in newer releases).
+    return _loaded_exception_types("httpx.HTTPError", "httpx2.HTTPError")
 
 
 def _fetch_models(base: str) -> tuple[list[dict[str, Any]], str]:
     """Return cached metadata and API path prefix for one LM Studio server."""
+    import requests
+
     if base in _cache:
         return _cache[base]
+    started = time.perf_counter()
+    outcome = "error"
     try:
         # Prefer the richer metadata endpoint
         api_path = "/api/v0"
-        _debug(f"LMSTUDIO DEBUG: Fetching models from {base}{api_path}/models")
+        _debug("Fetching models from %s%s/models", base, api_path)
         r = requests.get(f"{base}{api_path}/models", timeout=TIMEOUT)
         if r.status_code == 404:  # Older LM Studio → fall back
             api_path = "/v1"
             _debug(
-                f"LMSTUDIO DEBUG: {base}/api/v0/models not found, falling back to {base}{api_path}/models"
+                "%s/api/v0/models not found, falling back to %s%s/models",
+                base,
+                base,
+                api_path,
             )
             r = requests.get(f"{base}{api_path}/models", timeout=TIMEOUT)
             r.raise_for_status()
             data = r.json().get("data", [])
-            _debug(
-                f"LMSTUDIO DEBUG: Received data from /v1 endpoint for {base}: {data}"
-            )
+            _debug("Received data from /v1 endpoint for %s: %s", base, data)
             # v1 has no 'type'; assume plain LLM or infer from ID
             meta = []
             for m_data in data:
@@ -78,17 +367,28 @@ def _fetch_models(base: str) -> tuple[list[dict[str, Any]], str]:
                 # V1 doesn't reliably tell us VLM status
                 current_model_meta = {"id": m_id, "type": m_type, "vision": False}
                 _debug(
-                    f"LMSTUDIO DEBUG: Processed /v1 model data for {base}: ID={m_id}, Inferred Type={m_type}, Vision=False"
+                    "Processed /v1 model data for %s: ID=%s, Inferred Type=%s, Vision=False",
+                    base,
+                    m_id,
+                    m_type,
                 )
                 meta.append(current_model_meta)
         else:
             r.raise_for_status()
             meta = r.json().get("data", [])
-            _debug(f"LMSTUDIO DEBUG: Received full metadata from /api/v0 for {base}:")
-            for m_debug in meta:
-                _debug(
-                    f"  LMSTUDIO DEBUG: Model ID: {m_debug.get('id')}, Type: {m_debug.get('type')}, Original Vision: {m_debug.get('vision')}, Path: {m_debug.get('path')}, Publisher: {m_debug.get('publisher')}, Architecture: {m_debug.get('architecture')}, Quantization: {m_debug.get('quantization')}"
-                )
+            if _debug_enabled:
+                _debug("Received full metadata from /api/v0 for %s:", base)
+                for m_debug in meta:
+                    _debug(
+                        "Model ID: %s, Type: %s, Original Vision: %s, Path: %s, Publisher: %s, Architecture: %s, Quantization: %s",
+                        m_debug.get("id"),
+                        m_debug.get("type"),
+                        m_debug.get("vision"),
+                        m_debug.get("path"),
+                        m_debug.get("publisher"),
+                        m_debug.get("architecture"),
+                        m_debug.get("quantization"),
+                    )
 
             # Add 'vision' flag for /api/v0 models for clarity
             for m in meta:
@@ -101,14 +401,28 @@ def _fetch_models(base: str) -> tuple[list[dict[str, Any]], str]:
                     is_vlm_type or has_vision_flag
                 )  # Set our 'vision' flag based on these
                 _debug(
-                    f"  LMSTUDIO DEBUG: For model {m.get('id')}: Original type='{m.get('type')}', original vision_key_present_and_true='{has_vision_flag}', calculated plugin vision_support='{m['vision']}'"
+                    "For model %s: Original type='%s', original vision_key_present_and_true='%s', calculated plugin vision_support='%s'",
+                    m.get("id"),
+                    m.get("type"),
+                    has_vision_flag,
+                    m["vision"],
                 )
 
         _cache[base] = (meta, api_path)
+        outcome = "ok"
         return meta, api_path
     except (requests.RequestException, KeyError, TypeError, ValueError) as e:
         _errors[base] = e
+        if isinstance(e, requests.Timeout):
+            outcome = "timeout"
         return [], ""  # Return empty list and empty path on error
+    finally:
+        metrics.inc("lmstudio_discovery_total", server=base, outcome=outcome)
+        metrics.observe(
+            "lmstudio_discovery_duration_seconds",
+            time.perf_counter() - started,
+            server=base,
+        )
 
 
 def _host_tag(base: str) -> str:
@@ -116,207 +430,2008 @@ def _host_tag(base: str) -> str:
     return urlparse(base).netloc.replace(":", "_").replace(".", "_")
 
 
-# --------------------------------------------------------------------------- #
-#  Registration hooks                                                         #
-# --------------------------------------------------------------------------- #
-@llm.hookimpl
-def register_models(register):
-    single_server = len(SERVER_LIST) == 1
-    for base in SERVER_LIST:
-        models, api_path = _fetch_models(base)
-        if not models and not api_path:  # Skip if fetch failed completely
-            continue
-        for m in models:
-            if m.get("type") == "embeddings":
-                continue  # handled in embedding hook
+(
+    _EXPECT_VALUE,
+    _EXPECT_FIRST_ITEM,
+    _EXPECT_FIRST_KEY,
+    _EXPECT_KEY,
+    _EXPECT_COLON,
+    _EXPECT_COMMA,
+    _EXPECT_END,
+) = range(7)
+_JSON_WHITESPACE = frozenset(" \t\n\r")
+_JSON_LITERAL_CHARS = frozenset("0123456789+-.eEtrufalsn")
+_JSON_STRING_SPECIAL = re.compile(r'["\\\x00-\x1f]')
+_JSON_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+_JSON_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
 
-            raw_id = m["id"]
-            if single_server:
-                model_id = f"lmstudio/{raw_id}"
-            else:
-                model_id = f"lmstudio@{_host_tag(base)}/{raw_id}"
 
-            # Check if model is loaded (only reliable via /api/v0)
-            is_loaded = m.get("state") == "loaded"
-            # display_model_id = f"{model_id} 🟢" if is_loaded else model_id
+class _JSONScanner:
+    """Check incrementally that text fragments form exactly one JSON value.
 
-            # Use the 'vision' flag that was calculated and refined by _fetch_models
-            supports_images_flag = m.get("vision", False)
+    Fragments are scanned once, so the cost is linear in the total length.
+    String bodies are skipped with a regular expression, which keeps large
+    string arguments cheap. ``feed`` and ``close`` raise ``ValueError`` at the
+    first character that cannot be part of a valid document.
+    """
 
-            # Modify the actual model_id that will be registered
-            # final_model_id_for_registration = model_id # This was the old approach
-            # The actual model_id should remain clean for lookup.
+    __slots__ = (
+        "stack",
+        "expect",
+        "offset",
+        "_in_string",
+        "_string_is_key",
+        "_escape",
+        "_hex_digits",
+        "_literal",
+    )
 
-            display_suffix_parts = []
-            if is_loaded:
-                display_suffix_parts.append("●")  # Black Circle for loaded
-            if supports_images_flag:
-                display_suffix_parts.append("👁")  # Eye for vision (U+1F441)
-            # Assuming schema support for these models, as it's a general capability of the endpoint
-            display_suffix_parts.append(
-                "⚒"
-            )  # Hammer and Pick for schema/tools (U+2692)
+    def __init__(self) -> None:
+        self.stack: list[str] = []
+        self.expect = _EXPECT_VALUE
+        self.offset = 0
+        self._in_string = False
+        self._string_is_key = False
+        self._escape = False
+        self._hex_digits = 0
+        self._literal: list[str] = []
 
-            display_suffix = ""
-            if display_suffix_parts:
-                display_suffix = " " + " ".join(
-                    display_suffix_parts
-                )  # Join with spaces, add leading space
+    @property
+    def complete(self) -> bool:
+        return self.expect == _EXPECT_END and not self._literal
 
-            _debug(
-                f"LMSTUDIO DEBUG [register_models]: Base model_id: '{model_id}', Calculated display_suffix: '{display_suffix}'"
-            )
-            _debug(
-                f"LMSTUDIO DEBUG [register_models]: For {raw_id}, passing model_id='{model_id}', supports_images={supports_images_flag} to constructor."
-            )
+    def feed(self, text: str) -> None:
+        i = 0
+        n = len(text)
+        while i < n:
+            if self._in_string:
+                i = self._scan_string(text, i)
+                continue
+            ch = text[i]
+            if self._literal:
+                if ch in _JSON_LITERAL_CHARS:
+                    self._literal.append(ch)
+                    i += 1
+                    continue
+                self._finish_literal(i)
+            if ch not in _JSON_WHITESPACE:
+                self._structural(ch, i)
+            i += 1
+        self.offset += n
 
-            current_metadata = {
-                "publisher": m.get("publisher"),
-                "arch": m.get(
-                    "arch"
-                ),  # Note: LM Studio API docs say 'architecture' but example shows 'arch'
-                "quantization": m.get("quantization"),
-                "max_context_length": m.get("max_context_length"),
-                "state": m.get(
-                    "state", "unknown"
-                ),  # Default to unknown if not available
-                "api_path": api_path,  # Store the API path used
-                "base_url": base,  # Store the base URL
-                "vision": supports_images_flag,  # Ensure our calculated flag is in metadata
-                "raw_lmstudio_type": m.get(
-                    "type"
-                ),  # Store original type for debugging/inspection
-            }
-            # Filter out None values for cleaner inspection, but keep 'vision' as it's boolean
-            current_metadata = {
-                k: v
-                for k, v in current_metadata.items()
-                if v is not None or k == "vision"
-            }
+    def close(self) -> None:
+        if self._literal:
+            self._finish_literal(0)
+        if self._in_string or self.expect != _EXPECT_END:
+            raise ValueError(f"Truncated JSON at offset {self.offset}")
 
-            register(
-                LMStudioModel(
-                    model_id,
-                    base,
-                    raw_id,
-                    api_path,
-                    supports_images=supports_images_flag,
-                    metadata=current_metadata,
-                    display_suffix=display_suffix,
-                ),
-                LMStudioAsyncModel(
-                    model_id,
-                    base,
-                    raw_id,
-                    api_path,
-                    supports_images=supports_images_flag,
-                    metadata=current_metadata,
-                    display_suffix=display_suffix,
-                ),
-            )
-    if _errors:
-        _debug(
-            "Warning: Some LM Studio servers were unreachable:\n  "
-            + "\n  ".join(f"{k}: {v}" for k, v in _errors.items())
-        )
+    def _error(self, message: str, index: int) -> ValueError:
+        return ValueError(f"{message} at offset {self.offset + index}")
 
+    def _scan_string(self, text: str, i: int) -> int:
+        n = len(text)
+        while i < n:
+            if self._hex_digits:
+                if text[i] not in _JSON_HEX_DIGITS:
+                    raise self._error("Invalid unicode escape", i)
+                self._hex_digits -= 1
+                i += 1
+                continue
+            if self._escape:
+                ch = text[i]
+                if ch == "u":
+                    self._hex_digits = 4
+                elif ch not in '"\\/bfnrt':
+                    raise self._error("Invalid escape", i)
+                self._escape = False
+                i += 1
+                continue
+            match = _JSON_STRING_SPECIAL.search(text, i)
+            if match is None:
+                return n
+            i = match.start()
+            ch = text[i]
+            if ch == '"':
+                self._in_string = False
+                self._end_string(i + 1)
+                return i + 1
+            if ch != "\\":
+                raise self._error("Control character in string", i)
+            self._escape = True
+            i += 1
+        return n
 
-@llm.hookimpl
-def register_embedding_models(register):
-    single_server = len(SERVER_LIST) == 1
-    for base in SERVER_LIST:
-        models, api_path = _fetch_models(base)
-        if not models and not api_path:  # Skip if fetch failed completely
-            continue
-        for m in models:
-            if m.get("type") == "embeddings":
-                raw_id = m["id"]
-                if single_server:
-                    model_id = raw_id
-                else:
-                    model_id = f"lmstudio@{_host_tag(base)}/{raw_id}"
-                register(LMStudioEmbeddingModel(model_id, base, raw_id, api_path))
+    def _end_string(self, end: int) -> None:
+        if self._string_is_key:
+            self.expect = _EXPECT_COLON
+        else:
+            self._end_value(end)
 
+    def _finish_literal(self, end: int) -> None:
+        literal = "".join(self._literal)
+        self._literal = []
+        if literal not in ("true", "false", "null") and not _JSON_NUMBER.fullmatch(
+            literal
+        ):
+            raise self._error(f"Invalid literal {literal!r}", end - len(literal))
+        self._end_value(end)
 
-# --------------------------------------------------------------------------- #
-#  Model classes                                                              #
-# --------------------------------------------------------------------------- #
-@dataclass(frozen=True)
-class ChatRequest:
-    url: str
-    payload: dict[str, Any]
-    stream: bool
-    timeout: float
+    def _end_value(self, end: int) -> None:
+        self.expect = _EXPECT_COMMA if self.stack else _EXPECT_END
 
+    def _close_container(self, ch: str, i: int) -> None:
+        opener = "{" if ch == "}" else "["
+        if not self.stack or self.stack[-1] != opener:
+            raise self._error(f"Unexpected {ch!r}", i)
+        self.stack.pop()
+        self._end_value(i + 1)
 
-@dataclass
-class StreamState:
-    chunks: list[dict[str, Any]] = field(default_factory=list)
-    tool_calls: list[dict[str, Any]] = field(default_factory=list)
-    usage: dict[str, Any] | None = None
+    def _structural(self, ch: str, i: int) -> None:
+        expect = self.expect
+        if expect == _EXPECT_END:
+            raise self._error("Extra data", i)
+        if expect == _EXPECT_COLON:
+            if ch != ":":
+                raise self._error("Expected ':'", i)
+            self.expect = _EXPECT_VALUE
+        elif expect == _EXPECT_COMMA:
+            if ch == ",":
+                self.expect = _EXPECT_KEY if self.stack[-1] == "{" else _EXPECT_VALUE
+            elif ch in "}]":
+                self._close_container(ch, i)
+            else:
+                raise self._error("Expected ',' or closing bracket", i)
+        elif expect in (_EXPECT_FIRST_KEY, _EXPECT_KEY):
+            if ch == '"':
+                self._start_key(i)
+            elif ch == "}" and expect == _EXPECT_FIRST_KEY:
+                self._close_container(ch, i)
+            else:
+                raise self._error("Expected object key", i)
+        elif ch == "]" and expect == _EXPECT_FIRST_ITEM:
+            self._close_container(ch, i)
+        else:
+            self._start_value(ch, i)
 
+    def _start_key(self, i: int) -> None:
+        self._in_string = True
+        self._string_is_key = True
 
-class LMStudioBaseModel:
-    """Base class for common LMStudio model attributes."""
+    def _start_value(self, ch: str, i: int) -> None:
+        if ch in "{[":
+            self.stack.append(ch)
+            self.expect = _EXPECT_FIRST_KEY if ch == "{" else _EXPECT_FIRST_ITEM
+        elif ch == '"':
+            self._in_string = True
+            self._string_is_key = False
+        elif ch in _JSON_LITERAL_CHARS:
+            self._literal.append(ch)
+        else:
+            raise self._error(f"Unexpected {ch!r}", i)
 
-    can_stream: bool = True
-    supports_tools: bool = True
-    attachment_types: ClassVar[set[str]] = {
-        "image/png",
-        "image/jpeg",
-        "image/gif",
-        "image/webp",
-    }
 
-    def __init__(
-        self,
-        model_id: str,
-        base_url: str,
-        raw_id: str,
-        api_path_prefix: str,
-        *,
-        supports_images: bool = False,
-        metadata: dict | None = None,
-        display_suffix: str = "",
-    ):
-        self.model_id = model_id
-        self.raw_id = raw_id
-        self.base = base_url
-        self.api_path_prefix = api_path_prefix
-        self.supports_images = supports_images
-        self.metadata = metadata or {}
-        self.supports_schema = True
-        self.display_suffix = display_suffix
+class JSONItemParser(_JSONScanner):
+    """Parse a JSON document incrementally, returning values as they close.
 
-    class Options(llm.Options):
-        temperature: float | None = Field(None, description="Sampling temperature")
-        top_p: float | None = Field(None, description="Nucleus sampling")
-        max_tokens: int | None = Field(None, description="Maximum tokens")
-        stop: list[str] | None = Field(None, description="Stop sequences")
+    Values nested ``depth`` levels deep are returned as soon as their last
+    character arrives, together with their path of object keys and array
+    indices. A depth of 1 returns the fields of a top-level object or the
+    items of a top-level array. A depth of 2 returns the records of
+    ``{"items": [...]}``, the shape ``llm --schema-multi`` asks for.
+    """
 
-    def _prepare_chat_request(
-        self,
-        prompt: llm.Prompt,
-        stream: bool,
-        conversation=None,
-    ) -> ChatRequest:
-        has_schema = bool(getattr(prompt, "schema", None))
-        has_tools = bool(getattr(prompt, "tools", None))
+    __slots__ = (
+        "depth",
+        "_path",
+        "_text",
+        "_key_parts",
+        "_key_start",
+        "_value_parts",
+        "_value_start",
+        "_items",
+    )
 
-        url = (
-            f"{self.base}/v1/chat/completions"
-            if has_schema
-            else f"{self.base}{self.api_path_prefix}/chat/completions"
-        )
-        payload: dict[str, Any] = {
-            "model": self.raw_id,
-            "messages": self._build_messages(prompt, conversation),
-        }
+    def __init__(self, depth: int = 1) -> None:
+        super().__init__()
+        self.depth = depth
+        self._path: list[str | int | None] = []
+        self._text = ""
+        self._key_parts: list[str] = []
+        self._key_start: int | None = None
+        self._value_parts: list[str] = []
+        self._value_start: int | None = None
+        self._items: list[tuple[tuple[str | int, ...], Any]] = []
 
-        if has_tools:
-            payload["tools"] = self._encode_tools(prompt.tools)
+    def feed(  # type: ignore[override]
+        self, text: str
+    ) -> list[tuple[tuple[str | int, ...], Any]]:
+        self._text = text
+        try:
+            super().feed(text)
+        finally:
+            # Keep the unfinished key or value for the next fragment.
+            if self._key_start is not None:
+                self._key_parts.append(text[self._key_start :])
+                self._key_start = 0
+            if self._value_start is not None:
+                self._value_parts.append(text[self._value_start :])
+                self._value_start = 0
+            self._text = ""
+        items, self._items = self._items, []
+        return items
 
-        if prompt.options:
+    def close(  # type: ignore[override]
+        self,
+    ) -> list[tuple[tuple[str | int, ...], Any]]:
+        super().close()
+        items, self._items = self._items, []
+        return items
+
+    def _start_key(self, i: int) -> None:
+        super()._start_key(i)
+        if len(self.stack) <= self.depth:
+            self._key_start = i
+
+    def _end_string(self, end: int) -> None:
+        if self._string_is_key and self._key_start is not None:
+            raw = "".join(self._key_parts) + self._text[self._key_start : end]
+            self._key_parts = []
+            self._key_start = None
+            self._path[-1] = json.loads(raw)
+        super()._end_string(end)
+
+    def _start_value(self, ch: str, i: int) -> None:
+        if self.stack and self.stack[-1] == "[":
+            self._path[-1] = cast(int, self._path[-1]) + 1
+        if len(self.stack) == self.depth:
+            self._value_start = i
+        super()._start_value(ch, i)
+        if ch in "{[":
+            self._path.append(-1 if ch == "[" else None)
+
+    def _close_container(self, ch: str, i: int) -> None:
+        if self.stack and self.stack[-1] == ("{" if ch == "}" else "["):
+            self._path.pop()
+        super()._close_container(ch, i)
+
+    def _end_value(self, end: int) -> None:
+        super()._end_value(end)
+        if self._value_start is not None and len(self.stack) == self.depth:
+            raw = "".join(self._value_parts) + self._text[self._value_start : end]
+            self._value_parts = []
+            self._value_start = None
+            path = cast(tuple[str | int, ...], tuple(self._path))
+            self._items.append((path, _codec.loads(raw)))
+
+
+def iter_json_items(
+    chunks: Iterable[str | StreamEvent], depth: int = 1
+) -> Iterator[tuple[tuple[str | int, ...], Any]]:
+    """Yield ``(path, value)`` for each JSON value that closes at ``depth``.
+
+    ``chunks`` is usually a streamed response to a schema prompt::
+
+        response = model.prompt("...", schema=schema)
+        for path, record in iter_json_items(response, depth=2):
+            ...
+
+    ``StreamEvent`` objects other than text events are skipped. A
+    ``ValueError`` is raised as soon as the text stops being valid JSON.
+    """
+    parser = JSONItemParser(depth)
+    for chunk in chunks:
+        if isinstance(chunk, StreamEvent):
+            if chunk.type != "text":
+                continue
+            chunk = chunk.chunk
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+async def aiter_json_items(
+    chunks: AsyncIterator[str | StreamEvent], depth: int = 1
+) -> AsyncGenerator[tuple[tuple[str | int, ...], Any], None]:
+    """Async version of ``iter_json_items``."""
+    parser = JSONItemParser(depth)
+    async for chunk in chunks:
+        if isinstance(chunk, StreamEvent):
+            if chunk.type != "text":
+                continue
+            chunk = chunk.chunk
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+
+
+class SSEParser:
+    """Incremental Server-Sent Events parser that works on raw response bytes.
+
+    ``feed`` accepts byte chunks as they arrive and returns the data of each
+    event completed so far. Lines may end in LF, CR or CRLF, even when a CRLF
+    pair is split across chunks. Multi-line ``data:`` fields are joined with
+    newlines. Lines are only decoded once complete, so UTF-8 sequences split
+    across chunks decode correctly. Events containing invalid UTF-8 are
+    dropped.
+    """
+
+    __slots__ = ("_buffer", "_data", "_skip_lf")
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._data: list[bytes] = []
+        self._skip_lf = False
+
+    def feed(self, chunk: bytes) -> list[str]:
+        if self._skip_lf:
+            self._skip_lf = False
+            if chunk[:1] == b"\n":
+                chunk = chunk[1:]
+        if b"\r" in chunk:
+            self._skip_lf = chunk.endswith(b"\r")
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        buffer = self._buffer
+        buffer += chunk
+        end = buffer.rfind(b"\n")
+        if end < 0:
+            return []
+        lines = bytes(buffer[:end]).split(b"\n")
+        del buffer[: end + 1]
+        events: list[str] = []
+        data = self._data
+        for line in lines:
+            if not line:
+                if data:
+                    self._dispatch(events)
+                    data = self._data
+            elif line[:5] == b"data:":
+                data.append(line[6:] if line[5:6] == b" " else line[5:])
+            # Comments and the event, id and retry fields are not used by
+            # LM Studio.
+        return events
+
+    def close(self) -> list[str]:
+        """Flush a final event that was not followed by a blank line."""
+        if self._buffer:
+            self.feed(b"\n")
+        events: list[str] = []
+        self._dispatch(events)
+        return events
+
+    def _dispatch(self, events: list[str]) -> None:
+        if not self._data:
+            return
+        data = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+        self._data = []
+        try:
+            events.append(data.decode("utf-8"))
+        except UnicodeDecodeError as e:
+            _debug("Ignoring invalid UTF-8 stream event: %s", e)
+
+
+# --------------------------------------------------------------------------- #
+#  Profiling                                                                  #
+# --------------------------------------------------------------------------- #
+@dataclass(slots=True)
+class ProfileSpan:
+    name: str
+    start: float
+    duration: float
+
+
+class RequestProfile:
+    """Named phase timings for one ``execute`` call.
+
+    Spans are collected in memory and handed to the configured sink when the
+    request finishes. When profiling is disabled, ``_start_profile`` returns
+    ``_NULL_PROFILE``, whose methods do nothing.
+    """
+
+    __slots__ = (
+        "model_id",
+        "request_id",
+        "started",
+        "started_ns",
+        "spans",
+        "_iters",
+    )
+
+    def __init__(self, model_id: str) -> None:
+        self.model_id = model_id
+        self.request_id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.started_ns = time.time_ns()
+        self.spans: list[ProfileSpan] = []
+        self._iters: list[Any] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append(ProfileSpan(name, start, time.perf_counter() - start))
+
+    def iter(self, name: str, iterable: Any, exclude: Any = None) -> Any:
+        """Wrap a (possibly async) iterator and record the time spent in it.
+
+        Time spent by the consumer between items is not counted. Time spent
+        inside ``exclude``, another wrapped iterator consumed by this one, is
+        subtracted.
+        """
+        if hasattr(iterable, "__anext__"):
+            wrapped = _AsyncProfiledIterator(self, name, iterable, exclude)
+        else:
+            wrapped = _ProfiledIterator(self, name, iterable, exclude)
+        self._iters.append(wrapped)
+        return wrapped
+
+    def finish(self) -> None:
+        for wrapped in self._iters:
+            wrapped.finish()
+        self._iters = []
+        if _profile_sink is not None:
+            _profile_sink(self)
+
+
+class _NullProfile:
+    __slots__ = ()
+
+    def span(self, name: str) -> contextlib.AbstractContextManager[None]:
+        return _NULL_SPAN
+
+    def iter(self, name: str, iterable: Any, exclude: Any = None) -> Any:
+        return iterable
+
+    def finish(self) -> None:
+        pass
+
+
+_NULL_SPAN = contextlib.nullcontext()
+_NULL_PROFILE = _NullProfile()
+
+
+class _ProfiledIterator:
+    __slots__ = (
+        "_profile",
+        "_name",
+        "_iterator",
+        "_exclude",
+        "_first",
+        "total",
+        "_done",
+    )
+
+    def __init__(self, profile, name, iterable, exclude) -> None:
+        self._profile = profile
+        self._name = name
+        self._iterator = iter(iterable)
+        self._exclude = exclude
+        self._first: float | None = None
+        self.total = 0.0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        if self._first is None:
+            self._first = start
+        try:
+            item = next(self._iterator)
+        except StopIteration:
+            self.total += time.perf_counter() - start
+            self.finish()
+            raise
+        self.total += time.perf_counter() - start
+        return item
+
+    def finish(self) -> None:
+        if self._done or self._first is None:
+            return
+        self._done = True
+        duration = self.total - (self._exclude.total if self._exclude else 0.0)
+        self._profile.spans.append(ProfileSpan(self._name, self._first, duration))
+
+
+class _AsyncProfiledIterator(_ProfiledIterator):
+    __slots__ = ()
+
+    def __init__(self, profile, name, iterable, exclude) -> None:
+        super().__init__(profile, name, (), exclude)
+        self._iterator = iterable
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        start = time.perf_counter()
+        if self._first is None:
+            self._first = start
+        try:
+            item = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self.total += time.perf_counter() - start
+            self.finish()
+            raise
+        self.total += time.perf_counter() - start
+        return item
+
+
+def _stderr_profile_sink(profile: RequestProfile) -> None:
+    phases = " ".join(
+        f"{span.name}={span.duration * 1000:.1f}ms" for span in profile.spans
+    )
+    total = (time.perf_counter() - profile.started) * 1000
+    print(
+        f"LMSTUDIO PROFILE: {profile.model_id} total={total:.1f}ms {phases}",
+        file=sys.stderr,
+    )
+
+
+def _jsonl_profile_sink(path: str) -> Callable[[RequestProfile], None]:
+    def sink(profile: RequestProfile) -> None:
+        record = {
+            "request_id": profile.request_id,
+            "model": profile.model_id,
+            "started_ns": profile.started_ns,
+            "total_ms": round((time.perf_counter() - profile.started) * 1000, 3),
+            "spans": [
+                {
+                    "name": span.name,
+                    "offset_ms": round((span.start - profile.started) * 1000, 3),
+                    "duration_ms": round(span.duration * 1000, 3),
+                }
+                for span in profile.spans
+            ],
+        }
+        with open(path, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(record) + "\n")
+
+    return sink
+
+
+def _otel_profile_sink() -> Callable[[RequestProfile], None]:
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("llm_lmstudio")
+
+    def sink(profile: RequestProfile) -> None:
+        def ns(offset: float) -> int:
+            return profile.started_ns + int((offset - profile.started) * 1e9)
+
+        root = tracer.start_span(
+            "lmstudio.execute",
+            start_time=profile.started_ns,
+            attributes={"llm.model": profile.model_id},
+        )
+        context = trace.set_span_in_context(root)
+        for span in profile.spans:
+            child = tracer.start_span(
+                f"lmstudio.{span.name}", context=context, start_time=ns(span.start)
+            )
+            child.end(end_time=ns(span.start + span.duration))
+        root.end(end_time=ns(time.perf_counter()))
+
+    return sink
+
+
+def _select_profile_sink(spec: str) -> Callable[[RequestProfile], None] | None:
+    if not spec:
+        return None
+    if spec == "stderr":
+        return _stderr_profile_sink
+    if spec.startswith("jsonl:"):
+        return _jsonl_profile_sink(spec[len("jsonl:") :])
+    if spec == "otel":
+        try:
+            return _otel_profile_sink()
+        except ImportError:
+            print(
+                "LMSTUDIO WARN: LLM_LMSTUDIO_PROFILE=otel requires opentelemetry-api. "
+                "Profiling is disabled.",
+                file=sys.stderr,
+            )
+            return None
+    print(
+        f"LMSTUDIO WARN: Unknown LLM_LMSTUDIO_PROFILE value {spec!r}. "
+        "Expected stderr, jsonl:<path> or otel. Profiling is disabled.",
+        file=sys.stderr,
+    )
+    return None
+
+
+_profile_sink = _select_profile_sink(PROFILE)
+
+
+def _start_profile(model_id: str) -> RequestProfile | _NullProfile:
+    if _profile_sink is None:
+        return _NULL_PROFILE
+    return RequestProfile(model_id)
+
+
+# --------------------------------------------------------------------------- #
+#  Metrics                                                                    #
+# --------------------------------------------------------------------------- #
+_LATENCY_BUCKETS = (
+    0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0
+)  # fmt: skip
+
+# name -> (type, help text)
+_METRICS: dict[str, tuple[str, str]] = {
+    "lmstudio_requests_total": (
+        "counter",
+        "Chat requests by server, model, mode and outcome.",
+    ),
+    "lmstudio_request_duration_seconds": (
+        "histogram",
+        "Chat request duration, including streaming.",
+    ),
+    "lmstudio_time_to_first_token_seconds": (
+        "histogram",
+        "Time from sending a chat request to its first streamed token.",
+    ),
+    "lmstudio_tokens_total": ("counter", "Tokens reported by LM Studio usage."),
+    "lmstudio_model_loads_total": ("counter", "Model load attempts by outcome."),
+    "lmstudio_model_load_duration_seconds": (
+        "histogram",
+        "Model load request duration.",
+    ),
+    "lmstudio_embedding_requests_total": (
+        "counter",
+        "Embedding requests by outcome.",
+    ),
+    "lmstudio_embedding_inputs_total": ("counter", "Inputs sent for embedding."),
+    "lmstudio_embedding_duration_seconds": (
+        "histogram",
+        "Embedding request duration.",
+    ),
+    "lmstudio_response_cache_total": (
+        "counter",
+        "Response cache lookups (hit, miss) and stores.",
+    ),
+    "lmstudio_embedding_splits_total": (
+        "counter",
+        "Embedding batches split in two after a size error.",
+    ),
+    "lmstudio_embedding_failovers_total": (
+        "counter",
+        "Pooled embedding batches retried on another server after a failure.",
+    ),
+    "lmstudio_embedding_cache_total": (
+        "counter",
+        "Embedding inputs found (hit) or not found (miss) in the cache.",
+    ),
+    "lmstudio_semantic_cache_total": (
+        "counter",
+        "Semantic cache lookups (hit, miss, error) and stores.",
+    ),
+    "lmstudio_deduplicated_requests_total": (
+        "counter",
+        "Requests served by joining an identical in-flight request.",
+    ),
+    "lmstudio_discovery_total": ("counter", "Model discovery requests by outcome."),
+    "lmstudio_discovery_duration_seconds": (
+        "histogram",
+        "Model discovery duration.",
+    ),
+}
+
+_LabelKey = tuple[tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """Thread-safe counters and histograms rendered in Prometheus text format.
+
+    Updates happen once per request, model load, embedding batch or discovery
+    call, never per streamed token.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[_LabelKey, float]] = {}
+        # Per label set: one count per bucket, then sum and count.
+        self._histograms: dict[str, dict[_LabelKey, list[float]]] = {}
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(_LATENCY_BUCKETS, value)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            buckets = series.get(key)
+            if buckets is None:
+                buckets = series[key] = [0.0] * (len(_LATENCY_BUCKETS) + 2)
+            if index < len(_LATENCY_BUCKETS):
+                buckets[index] += 1
+            buckets[-2] += value
+            buckets[-1] += 1
+
+    def value(self, name: str, **labels: str) -> float:
+        """Return a counter value, or a histogram's observation count."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name in self._histograms:
+                return self._histograms[name].get(key, [0.0])[-1]
+            return self._counters.get(name, {}).get(key, 0.0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        lines: list[str] = []
+        with self._lock:
+            for name, (kind, help_text) in _METRICS.items():
+                series = (
+                    self._histograms if kind == "histogram" else self._counters
+                ).get(name)
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(series.items()):
+                    if kind == "counter":
+                        lines.append(f"{name}{_format_labels(key)} {value:g}")
+                        continue
+                    cumulative = 0.0
+                    for bound, count in zip(_LATENCY_BUCKETS, value):
+                        cumulative += count
+                        labels = _format_labels(key + (("le", f"{bound:g}"),))
+                        lines.append(f"{name}_bucket{labels} {cumulative:g}")
+                    labels = _format_labels(key + (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{labels} {value[-1]:g}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {value[-2]:g}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value[-1]:g}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def _format_labels(key: _LabelKey) -> str:
+    if not key:
+        return ""
+    pairs = (f'{name}="{_escape_label(value)}"' for name, value in key)
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
+
+
+def _error_outcome(error: BaseException) -> str:
+    """Classify a failed request as ``timeout`` or ``error``."""
+    cause = error.__cause__ or error.__context__
+    timeouts = _loaded_exception_types("requests.Timeout", "httpx.TimeoutException")
+    if isinstance(error, TimeoutError) or isinstance(cause, timeouts):
+        return "timeout"
+    return "error"
+
+
+def render_prometheus() -> str:
+    """Return all plugin metrics in the Prometheus text exposition format."""
+    return metrics.render()
+
+
+def write_metrics(path: str) -> None:
+    """Atomically write the metrics to ``path``, e.g. for a textfile collector."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as fp:
+        fp.write(render_prometheus())
+    os.replace(temporary, path)
+
+
+def start_metrics_server(
+    port: int = 9464, host: str = "127.0.0.1"
+) -> http.server.ThreadingHTTPServer:
+    """Serve ``/metrics`` from a daemon thread and return the server.
+
+    Intended for long-running processes. Call ``shutdown()`` on the returned
+    server to stop it.
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            _debug("metrics server: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="lmstudio-metrics", daemon=True
+    )
+    thread.start()
+    return server
+
+
+if METRICS_FILE:
+    atexit.register(write_metrics, METRICS_FILE)
+
+
+# --------------------------------------------------------------------------- #
+#  Response cache                                                             #
+# --------------------------------------------------------------------------- #
+# Bump when the stored format or the key derivation changes.
+_RESPONSE_CACHE_VERSION = 1
+
+
+@dataclass(slots=True)
+class CachedResponse:
+    """Everything a finished response produced, in a JSON-friendly form."""
+
+    events: list[dict[str, Any]] = field(default_factory=list)
+    tool_calls: list[dict[str, Any]] = field(default_factory=list)
+    usage: dict[str, Any] | None = None
+    resolved_model: str | None = None
+    response_json: Any = None
+
+    def add_event(self, event: str | StreamEvent) -> None:
+        if isinstance(event, str):
+            self.events.append({"text": event})
+            return
+        self.events.append(
+            {
+                name: value
+                for name, value in asdict(event).items()
+                if value is not None and value is not False
+            }
+        )
+
+    def replay(self, response, **flags: Any) -> Iterator[str | StreamEvent]:
+        """Yield the stored events and apply the stored side effects."""
+        for event in self.events:
+            yield event["text"] if "text" in event else StreamEvent(**event)
+        self.apply(response, cached=True, **flags)
+
+    def apply(self, response, **flags: Any) -> None:
+        """Set the resolved model, tool calls, usage and ``response_json``.
+
+        ``flags`` are added to ``response_json`` when it is a dict.
+        """
+        if self.resolved_model:
+            response.set_resolved_model(self.resolved_model)
+        for tool_call in self.tool_calls:
+            response.add_tool_call(llm.ToolCall(**tool_call))
+        if self.usage is not None:
+            response.set_usage(**self.usage)
+        response_json = self.response_json
+        if flags and isinstance(response_json, dict):
+            response_json = {**response_json, **flags}
+        response.response_json = response_json
+
+
+class _ResponseRecorder:
+    """Stand-in for an ``llm`` response that records what the plugin sets.
+
+    Attribute reads and everything else are forwarded to the real response.
+    With ``response=None`` the side effects are only recorded.
+    """
+
+    def __init__(self, response=None) -> None:
+        self.__dict__["_response"] = response
+        self.__dict__["entry"] = CachedResponse()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._response, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name == "response_json":
+            self.entry.response_json = value
+        if self._response is not None:
+            setattr(self._response, name, value)
+
+    def set_usage(self, **kwargs: Any) -> None:
+        self.entry.usage = kwargs
+        if self._response is not None:
+            self._response.set_usage(**kwargs)
+
+    def set_resolved_model(self, model_id: str) -> None:
+        self.entry.resolved_model = model_id
+        if self._response is not None:
+            self._response.set_resolved_model(model_id)
+
+    def add_tool_call(self, tool_call: llm.ToolCall) -> None:
+        self.entry.tool_calls.append(
+            {
+                "name": tool_call.name,
+                "arguments": tool_call.arguments,
+                "tool_call_id": tool_call.tool_call_id,
+            }
+        )
+        if self._response is not None:
+            self._response.add_tool_call(tool_call)
+
+    def record(
+        self, events: Iterable[str | StreamEvent]
+    ) -> Iterator[str | StreamEvent]:
+        for event in events:
+            self.entry.add_event(event)
+            yield event
+
+    async def arecord(
+        self, events: AsyncIterator[str | StreamEvent]
+    ) -> AsyncGenerator[str | StreamEvent, None]:
+        async for event in events:
+            self.entry.add_event(event)
+            yield event
+
+
+class _SQLiteLRU:
+    """Size-bounded LRU store of blobs in one table of a SQLite file.
+
+    Safe to share between threads and, through SQLite locking, between
+    processes. Storage errors are logged and treated as cache misses.
+    """
+
+    table: ClassVar[str]
+    # Bound parameters per statement; older SQLite builds allow 999.
+    _chunk = 500
+
+    def __init__(self, path: str, max_bytes: int) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        # Running estimate of the stored size. Other processes can change the
+        # table, so it is recomputed before evicting.
+        self._size = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            db.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_accessed "
+                f"ON {self.table} (accessed)"
+            )
+            db.commit()
+            self._size = self._stored_size(db)
+            self._db = db
+        return self._db
+
+    def _stored_size(self, db: sqlite3.Connection) -> int:
+        (size,) = db.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM {self.table}"
+        ).fetchone()
+        return size
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        """Return the stored values for ``keys`` and mark them as used."""
+        found: dict[str, bytes] = {}
+        try:
+            with self._lock:
+                db = self._connect()
+                for offset in range(0, len(keys), self._chunk):
+                    chunk = keys[offset : offset + self._chunk]
+                    marks = ",".join("?" * len(chunk))
+                    found.update(
+                        db.execute(
+                            f"SELECT key, value FROM {self.table} "
+                            f"WHERE key IN ({marks})",
+                            chunk,
+                        )
+                    )
+                if found:
+                    now = time.time()
+                    db.executemany(
+                        f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+                    db.commit()
+        except sqlite3.Error as e:
+            _debug("Ignoring unreadable %s cache: %s", self.table, e)
+            return {}
+        return found
+
+    def put_many(self, items: list[tuple[str, bytes]]) -> None:
+        items = [(key, value) for key, value in items if len(value) <= self.max_bytes]
+        if not items:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                db.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                    [(key, value, len(value), now) for key, value in items],
+                )
+                self._size += sum(len(value) for _, value in items)
+                if self._size > self.max_bytes:
+                    self._evict(db)
+                db.commit()
+        except sqlite3.Error as e:
+            _debug("Could not store entries in %s cache: %s", self.table, e)
+
+    def _evict(self, db: sqlite3.Connection) -> None:
+        total = self._stored_size(db)
+        evicted = []
+        if total > self.max_bytes:
+            for key, size in db.execute(
+                f"SELECT key, size FROM {self.table} ORDER BY accessed"
+            ):
+                evicted.append((key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            db.executemany(f"DELETE FROM {self.table} WHERE key = ?", evicted)
+        self._size = total
+
+    def clear(self) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute(f"DELETE FROM {self.table}")
+            db.commit()
+            self._size = 0
+
+
+class ResponseCache(_SQLiteLRU):
+    """Finished chat responses keyed on the request hash."""
+
+    table = "responses"
+
+    def get(self, key: str) -> CachedResponse | None:
+        value = self.get_many([key]).get(key)
+        if value is None:
+            return None
+        try:
+            return CachedResponse(**_codec.loads(value))
+        except (ValueError, TypeError) as e:
+            _debug("Ignoring unreadable response cache entry: %s", e)
+            return None
+
+    def put(self, key: str, entry: CachedResponse) -> None:
+        self.put_many([(key, _codec.dumps(asdict(entry)))])
+
+
+_response_cache = (
+    ResponseCache(RESPONSE_CACHE, int(RESPONSE_CACHE_MAX_MB * 1024 * 1024))
+    if RESPONSE_CACHE
+    else None
+)
+
+
+def _request_key(request: ChatRequest) -> str | None:
+    """Hash the final payload of a temperature-0 request; ``None`` otherwise.
+
+    Only those requests are deterministic enough to share a response. The
+    stream flags are left out, so streaming and non-streaming calls match.
+    """
+    if request.payload.get("temperature") != 0:
+        return None
+    material = {
+        key: value
+        for key, value in request.payload.items()
+        if key not in ("stream", "stream_options")
+    }
+    material["_endpoint"] = urlparse(request.url).path
+    return _material_hash(material)
+
+
+def _material_hash(material: dict[str, Any]) -> str:
+    material["_version"] = _RESPONSE_CACHE_VERSION
+    canonical = json.dumps(
+        material, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _response_cache_lookup(key: str | None) -> CachedResponse | None:
+    if key is None or _response_cache is None:
+        return None
+    cached = _response_cache.get(key)
+    metrics.inc(
+        "lmstudio_response_cache_total", outcome="miss" if cached is None else "hit"
+    )
+    return cached
+
+
+def _response_cache_store(key: str, entry: CachedResponse) -> None:
+    if _response_cache is not None:
+        _response_cache.put(key, entry)
+        metrics.inc("lmstudio_response_cache_total", outcome="store")
+
+
+# --------------------------------------------------------------------------- #
+#  Semantic response cache                                                    #
+# --------------------------------------------------------------------------- #
+_numpy_module: Any = None  # False once NumPy is known to be missing
+
+
+def _numpy() -> Any:
+    """NumPy if it is installed, else ``None``; imported on first use."""
+    global _numpy_module
+    if _numpy_module is None:
+        try:
+            _numpy_module = importlib.import_module("numpy")
+        except ImportError:
+            _numpy_module = False
+    return _numpy_module or None
+
+
+def _unit_vector(vector: list[float]) -> array:
+    norm = sum(x * x for x in vector) ** 0.5
+    return array("f", [x / norm for x in vector] if norm else vector)
+
+
+class _VectorIndex:
+    """Unit vectors in insertion order, searched by brute force.
+
+    Uses NumPy when it is installed and plain Python otherwise.
+    """
+
+    def __init__(self) -> None:
+        self.keys: list[str] = []
+        self.created: list[float] = []
+        self.vectors: list[array] = []
+        self._matrix: Any = None  # NumPy copy of ``vectors``, built on demand
+
+    def add(self, key: str, vector: array, created: float) -> None:
+        self.keys.append(key)
+        self.created.append(created)
+        self.vectors.append(vector)
+        self._matrix = None
+
+    def expire(self, cutoff: float) -> None:
+        """Drop the entries created before ``cutoff``."""
+        count = bisect.bisect_left(self.created, cutoff)
+        if count:
+            del self.keys[:count], self.created[:count], self.vectors[:count]
+            self._matrix = None
+
+    def nearest(self, vector: array) -> tuple[str, float] | None:
+        """Return the key most similar to ``vector`` and its cosine similarity."""
+        if not self.vectors:
+            return None
+        numpy = _numpy()
+        if numpy is None:
+            scores = [sum(map(float.__mul__, row, vector)) for row in self.vectors]
+            best = max(range(len(scores)), key=scores.__getitem__)
+            return self.keys[best], scores[best]
+        if self._matrix is None:
+            self._matrix = numpy.frombuffer(
+                b"".join(row.tobytes() for row in self.vectors), dtype=numpy.float32
+            ).reshape(len(self.vectors), -1)
+        scores = self._matrix @ numpy.frombuffer(vector, dtype=numpy.float32)
+        best = int(scores.argmax())
+        return self.keys[best], float(scores[best])
+
+
+@dataclass(slots=True)
+class _SemanticQuery:
+    """A request's final user message, embedded, and the entry it matched."""
+
+    scope: str
+    text: str
+    vector: array
+    hit: CachedResponse | None = None
+    similarity: float | None = None
+
+
+class SemanticCache:
+    """Finished chat responses found by the meaning of the final user message.
+
+    A request only matches entries from the same scope: the same model,
+    options and earlier messages, which are hashed together. Entries are
+    stored in SQLite and searched in memory, one index per scope, loaded the
+    first time the scope is used. Storage and embedding errors are logged
+    and treated as misses.
+    """
+
+    def __init__(self, path: str, model_id: str, threshold: float, ttl: float):
+        self.path = path
+        self.model_id = model_id
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._indexes: dict[str, _VectorIndex] = {}
+        self._model: llm.EmbeddingModel | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic ("
+                "key TEXT PRIMARY KEY, scope TEXT NOT NULL, vector BLOB NOT NULL, "
+                "value BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS semantic_scope ON semantic (scope, created)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _cutoff(self) -> float:
+        return time.time() - self.ttl if self.ttl > 0 else float("-inf")
+
+    def _index(self, db: sqlite3.Connection, scope: str) -> _VectorIndex:
+        index = self._indexes.get(scope)
+        if index is None:
+            index = self._indexes[scope] = _VectorIndex()
+            for key, vector, created in db.execute(
+                "SELECT key, vector, created FROM semantic "
+                "WHERE scope = ? AND created >= ? ORDER BY created",
+                (scope, self._cutoff()),
+            ):
+                index.add(key, array("f", _unpack_float32(vector)), created)
+        index.expire(self._cutoff())
+        return index
+
+    def _subject(self, request: ChatRequest) -> tuple[str, str] | None:
+        """Split ``request`` into its scope hash and final user message.
+
+        ``None`` unless the request ends with a text-only user message.
+        """
+        messages = request.payload.get("messages") or []
+        if not messages or messages[-1].get("role") != "user":
+            return None
+        text = messages[-1].get("content")
+        if not isinstance(text, str) or not text:
+            return None
+        material = {
+            key: value
+            for key, value in request.payload.items()
+            if key not in ("stream", "stream_options", "messages")
+        }
+        material["messages"] = messages[:-1]
+        material["_endpoint"] = urlparse(request.url).path
+        material["_embedding_model"] = self.model_id
+        return _material_hash(material), text
+
+    def _embed(self, text: str) -> array:
+        if self._model is None:
+            self._model = llm.get_embedding_model(self.model_id)
+        return _unit_vector(self._model.embed(text))
+
+    def lookup(self, request: ChatRequest) -> _SemanticQuery | None:
+        """Embed the final user message and look for a close enough entry.
+
+        ``None`` when the request cannot be cached semantically.
+        """
+        subject = self._subject(request)
+        if subject is None:
+            return None
+        scope, text = subject
+        try:
+            query = _SemanticQuery(scope, text, self._embed(text))
+        except Exception as e:
+            # Any failure of the embedding model, whatever its plugin raises,
+            # only skips the cache.
+            _debug("Semantic cache could not embed the prompt: %s", e)
+            metrics.inc("lmstudio_semantic_cache_total", outcome="error")
+            return None
+        try:
+            with self._lock:
+                db = self._connect()
+                match = self._index(db, scope).nearest(query.vector)
+                if match is not None and match[1] >= self.threshold:
+                    row = db.execute(
+                        "SELECT value FROM semantic WHERE key = ?", (match[0],)
+                    ).fetchone()
+                    if row is not None:
+                        query.hit = CachedResponse(**_codec.loads(row[0]))
+                        query.similarity = match[1]
+        except Exception as e:
+            _debug("Ignoring unreadable semantic cache: %s", e)
+        metrics.inc(
+            "lmstudio_semantic_cache_total",
+            outcome="miss" if query.hit is None else "hit",
+        )
+        return query
+
+    def store(self, query: _SemanticQuery, entry: CachedResponse) -> None:
+        key = hashlib.sha256(f"{query.scope}\0{query.text}".encode()).hexdigest()
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._connect()
+                db.execute(
+                    "INSERT OR REPLACE INTO semantic VALUES (?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        query.scope,
+                        _pack_float32(query.vector),
+                        _codec.dumps(asdict(entry)),
+                        now,
+                    ),
+                )
+                if self.ttl > 0:
+                    db.execute(
+                        "DELETE FROM semantic WHERE created < ?", (self._cutoff(),)
+                    )
+                db.commit()
+                index = self._indexes.get(query.scope)
+                if index is not None:
+                    index.add(key, query.vector, now)
+        except Exception as e:
+            _debug("Could not store entry in semantic cache: %s", e)
+            return
+        metrics.inc("lmstudio_semantic_cache_total", outcome="store")
+
+    def clear(self) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM semantic")
+            db.commit()
+            self._indexes.clear()
+
+
+def _select_semantic_cache(path: str, model_id: str) -> SemanticCache | None:
+    if not path:
+        return None
+    if not model_id:
+        print(
+            "LMSTUDIO WARN: LMSTUDIO_SEMANTIC_CACHE requires "
+            "LMSTUDIO_SEMANTIC_CACHE_MODEL. The semantic cache is disabled.",
+            file=sys.stderr,
+        )
+        return None
+    return SemanticCache(path, model_id, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL)
+
+
+_semantic_cache = _select_semantic_cache(SEMANTIC_CACHE, SEMANTIC_CACHE_MODEL)
+
+
+def _semantic_cache_lookup(request: ChatRequest) -> _SemanticQuery | None:
+    if _semantic_cache is None:
+        return None
+    return _semantic_cache.lookup(request)
+
+
+def _semantic_cache_store(query: _SemanticQuery | None, entry: CachedResponse) -> None:
+    if query is not None and _semantic_cache is not None:
+        _semantic_cache.store(query, entry)
+
+
+# --------------------------------------------------------------------------- #
+#  In-flight request sharing                                                  #
+# --------------------------------------------------------------------------- #
+class _SharedStream:
+    """One upstream request whose events go to every caller that joins it.
+
+    The upstream runs in its own task, so it does not depend on any single
+    caller; it is cancelled when the last caller stops listening early.
+    Callers that join late first receive the events they missed.
+    """
+
+    def __init__(
+        self,
+        key: tuple[asyncio.AbstractEventLoop, str],
+        events: AsyncIterator[str | StreamEvent],
+        recorder: _ResponseRecorder,
+        cache_key: str | None = None,
+        record: bool = False,
+    ) -> None:
+        self.key = key
+        self.entry = recorder.entry
+        self.events: list[str | StreamEvent] = []
+        self.error: BaseException | None = None
+        self.done = False
+        self.listeners = 0
+        self._changed = asyncio.Event()
+        # ``record`` keeps the events for a cache that stores the entry later.
+        if record or cache_key is not None:
+            events = recorder.arecord(events)
+        self._task = asyncio.create_task(self._run(events, cache_key))
+
+    async def _run(
+        self, events: AsyncIterator[str | StreamEvent], cache_key: str | None
+    ) -> None:
+        try:
+            async for event in events:
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = llm.ModelError("The shared LM Studio request was cancelled.")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            if _inflight.get(self.key) is self:
+                del _inflight[self.key]
+            self._notify()
+        if self.error is None and cache_key is not None:
+            await asyncio.to_thread(_response_cache_store, cache_key, self.entry)
+
+    def _notify(self) -> None:
+        # Wake current waiters; later waiters wait on a fresh event.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(
+        self, response, **flags: Any
+    ) -> AsyncGenerator[str | StreamEvent, None]:
+        """Yield every event of the request, then apply its side effects."""
+        self.listeners += 1
+        try:
+            index = 0
+            while True:
+                changed = self._changed
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    break
+                await changed.wait()
+        finally:
+            self.listeners -= 1
+            if not self.done and not self.listeners:
+                self._task.cancel()
+        if self.error is not None:
+            raise self.error
+        self.entry.apply(response, **flags)
+
+
+# False while every request must reach LM Studio, as in ``run_bench``: the
+# response cache, the semantic cache and in-flight sharing are skipped.
+_reuse_responses: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "lmstudio_reuse_responses", default=True
+)
+
+# Keyed on the event loop as well, because the tasks belong to one loop.
+_inflight: dict[tuple[asyncio.AbstractEventLoop, str], _SharedStream] = {}
+
+
+# --------------------------------------------------------------------------- #
+#  Registration hooks                                                         #
+# --------------------------------------------------------------------------- #
+@llm.hookimpl
+def register_models(register):
+    single_server = len(SERVER_LIST) == 1
+    for base in SERVER_LIST:
+        models, api_path = _fetch_models(base)
+        if not models and not api_path:  # Skip if fetch failed completely
+            continue
+        for m in models:
+            if m.get("type") == "embeddings":
+                continue  # handled in embedding hook
+
+            raw_id = m["id"]
+            if single_server:
+                model_id = f"lmstudio/{raw_id}"
+            else:
+                model_id = f"lmstudio@{_host_tag(base)}/{raw_id}"
+
+            # Check if model is loaded (only reliable via /api/v0)
+            is_loaded = m.get("state") == "loaded"
+            # display_model_id = f"{model_id} 🟢" if is_loaded else model_id
+
+            # Use the 'vision' flag that was calculated and refined by _fetch_models
+            supports_images_flag = m.get("vision", False)
+
+            # Modify the actual model_id that will be registered
+            # final_model_id_for_registration = model_id # This was the old approach
+            # The actual model_id should remain clean for lookup.
+
+            display_suffix_parts = []
+            if is_loaded:
+                display_suffix_parts.append("●")  # Black Circle for loaded
+            if supports_images_flag:
+                display_suffix_parts.append("👁")  # Eye for vision (U+1F441)
+            # Assuming schema support for these models, as it's a general capability of the endpoint
+            display_suffix_parts.append(
+                "⚒"
+            )  # Hammer and Pick for schema/tools (U+2692)
+
+            display_suffix = ""
+            if display_suffix_parts:
+                display_suffix = " " + " ".join(
+                    display_suffix_parts
+                )  # Join with spaces, add leading space
+
+            _debug(
+                "[register_models] Base model_id: '%s', Calculated display_suffix: '%s'",
+                model_id,
+                display_suffix,
+            )
+            _debug(
+                "[register_models] For %s, passing model_id='%s', supports_images=%s to constructor.",
+                raw_id,
+                model_id,
+                supports_images_flag,
+            )
+
+            current_metadata = {
+                "publisher": m.get("publisher"),
+                "arch": m.get(
+                    "arch"
+                ),  # Note: LM Studio API docs say 'architecture' but example shows 'arch'
+                "quantization": m.get("quantization"),
+                "max_context_length": m.get("max_context_length"),
+                "state": m.get(
+                    "state", "unknown"
+                ),  # Default to unknown if not available
+                "api_path": api_path,  # Store the API path used
+                "base_url": base,  # Store the base URL
+                "vision": supports_images_flag,  # Ensure our calculated flag is in metadata
+                "raw_lmstudio_type": m.get(
+                    "type"
+                ),  # Store original type for debugging/inspection
+            }
+            # Filter out None values for cleaner inspection, but keep 'vision' as it's boolean
+            current_metadata = {
+                k: v
+                for k, v in current_metadata.items()
+                if v is not None or k == "vision"
+            }
+
+            register(
+                LMStudioModel(
+                    model_id,
+                    base,
+                    raw_id,
+                    api_path,
+                    supports_images=supports_images_flag,
+                    metadata=current_metadata,
+                    display_suffix=display_suffix,
+                ),
+                LMStudioAsyncModel(
+                    model_id,
+                    base,
+                    raw_id,
+                    api_path,
+                    supports_images=supports_images_flag,
+                    metadata=current_metadata,
+                    display_suffix=display_suffix,
+                ),
+            )
+    if _errors and _debug_enabled:
+        _debug(
+            "Some LM Studio servers were unreachable:\n  %s",
+            "\n  ".join(f"{k}: {v}" for k, v in _errors.items()),
+        )
+
+
+@llm.hookimpl
+def register_embedding_models(register):
+    single_server = len(SERVER_LIST) == 1
+    # (raw_id, quantization) -> the same model on every server that has it
+    shared: dict[tuple[str, str | None], list[LMStudioAsyncEmbeddingModel]] = {}
+    # Reduced vectors are registered under their own ids, next to the full
+    # ones, so that a collection never mixes the two. The ids never depend on
+    # the server's answer; see ``LMStudioEmbeddingModel._reduce``.
+    suffix = _embedding_suffix(EMBED_DIMENSIONS, EMBED_PRECISION)
+    reduced = {"dimensions": EMBED_DIMENSIONS, "precision": EMBED_PRECISION}
+    for base in SERVER_LIST:
+        models, api_path = _fetch_models(base)
+        if not models and not api_path:  # Skip if fetch failed completely
+            continue
+        for m in models:
+            if m.get("type") == "embeddings":
+                raw_id = m["id"]
+                if single_server:
+                    model_id = raw_id
+                else:
+                    model_id = f"lmstudio@{_host_tag(base)}/{raw_id}"
+                metadata = {
+                    "publisher": m.get("publisher"),
+                    "arch": m.get("arch"),
+                    "quantization": m.get("quantization"),
+                    "max_context_length": m.get("max_context_length"),
+                }
+                model = LMStudioAsyncEmbeddingModel(
+                    model_id, base, raw_id, api_path, metadata
+                )
+                register(model)
+                if suffix:
+                    register(
+                        LMStudioAsyncEmbeddingModel(
+                            model_id + suffix,
+                            base,
+                            raw_id,
+                            api_path,
+                            metadata,
+                            **reduced,
+                        )
+                    )
+                shared.setdefault((raw_id, metadata["quantization"]), []).append(
+                    model
+                )
+    # Models with different quantizations give different vectors, so only
+    # identical ones are pooled.
+    for (raw_id, _), members in shared.items():
+        if len(members) > 1:
+            model_id = f"lmstudio@pool/{raw_id}"
+            register(LMStudioPooledEmbeddingModel(model_id, members))
+            if suffix:
+                register(
+                    LMStudioPooledEmbeddingModel(model_id + suffix, members, **reduced)
+                )
+
+
+@llm.hookimpl
+def register_commands(cli):
+    @cli.group(name="lmstudio")
+    def lmstudio_group():
+        "Commands for models served by LM Studio"
+
+    @lmstudio_group.command(name="bench")
+    @click.argument("model_ids", nargs=-1)
+    @click.option(
+        "--server",
+        "servers",
+        multiple=True,
+        help="Only benchmark models served by this base URL",
+    )
+    @click.option("-p", "--prompt", "prompts", multiple=True, help="Prompt to send")
+    @click.option(
+        "--prompts-file",
+        type=click.File("r"),
+        help="File with one prompt per line",
+    )
+    @click.option(
+        "-c",
+        "--concurrency",
+        default="1",
+        show_default=True,
+        help="Comma-separated concurrency levels",
+    )
+    @click.option(
+        "-n",
+        "--requests",
+        "request_count",
+        type=int,
+        help="Requests per concurrency level  [default: 4 x concurrency]",
+    )
+    @click.option(
+        "-o",
+        "--option",
+        "options",
+        type=(str, str),
+        multiple=True,
+        help="Model option, e.g. -o max_tokens 256",
+    )
+    @click.option("--json", "as_json", is_flag=True, help="Print results as JSON")
+    @click.option(
+        "--output",
+        type=click.Path(dir_okay=False, writable=True),
+        help="Also write JSON results to this file",
+    )
+    def bench(
+        model_ids,
+        servers,
+        prompts,
+        prompts_file,
+        concurrency,
+        request_count,
+        options,
+        as_json,
+        output,
+    ):
+        """Measure TTFT, throughput and latency of LM Studio models.
+
+        Runs the prompts through the plugin's async request path at each
+        concurrency level. Benchmarks every LM Studio chat model when no
+        MODEL_IDS are given.
+        """
+        prompt_list = list(prompts)
+        if prompts_file:
+            prompt_list += [line.strip() for line in prompts_file if line.strip()]
+        try:
+            levels = [int(level) for level in concurrency.split(",")]
+        except ValueError:
+            raise click.BadParameter(
+                "expected comma-separated integers", param_hint="--concurrency"
+            )
+        if any(level < 1 for level in levels):
+            raise click.BadParameter("must be at least 1", param_hint="--concurrency")
+        models = _bench_models(model_ids, servers)
+        if not models:
+            raise click.ClickException("No LM Studio chat models to benchmark.")
+
+        results = asyncio.run(
+            run_bench(
+                models,
+                prompt_list or list(BENCH_PROMPTS),
+                levels,
+                request_count,
+                dict(options),
+            )
+        )
+        if output:
+            with open(output, "w", encoding="utf-8") as fp:
+                json.dump(results, fp, indent=2)
+        if as_json:
+            click.echo(json.dumps(results, indent=2))
+        else:
+            click.echo(format_bench_table(results))
+
+
+# --------------------------------------------------------------------------- #
+#  Model classes                                                              #
+# --------------------------------------------------------------------------- #
+@dataclass(frozen=True)
+class ChatRequest:
+    url: str
+    payload: dict[str, Any]
+    stream: bool
+    timeout: float
+
+
+@dataclass(slots=True)
+class RequestTimer:
+    """Timestamps for one chat request, summarized in milliseconds.
+
+    ``headers`` is when the response headers arrived, ``first_byte`` when the
+    first body bytes of a stream arrived, and ``first_token``/``last_token``
+    bracket the streamed text and reasoning fragments.
+    """
+
+    started: float = field(default_factory=time.perf_counter)
+    headers: float | None = None
+    first_byte: float | None = None
+    first_token: float | None = None
+    last_token: float | None = None
+    token_events: int = 0
+
+    def mark_token(self) -> None:
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        self.last_token = now
+        self.token_events += 1
+
+    def finish(self, usage: dict[str, Any] | None) -> dict[str, float]:
+        """Return the timings, plus throughput when usage has token counts."""
+        finished = time.perf_counter()
+
+        def ms(start: float, end: float) -> float:
+            return round((end - start) * 1000, 3)
+
+        timing = {}
+        if self.headers is not None:
+            timing["headers_ms"] = ms(self.started, self.headers)
+        if self.first_byte is not None:
+            timing["ttfb_ms"] = ms(self.started, self.first_byte)
+        if self.first_token is not None and self.last_token is not None:
+            timing["ttft_ms"] = ms(self.started, self.first_token)
+            timing["decode_ms"] = ms(self.first_token, self.last_token)
+            if self.token_events > 1:
+                timing["inter_token_ms"] = round(
+                    timing["decode_ms"] / (self.token_events - 1), 3
+                )
+        timing["total_ms"] = ms(self.started, finished)
+
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        completion_tokens = usage.get("completion_tokens")
+        if self.first_token is not None and self.last_token is not None:
+            decode = self.last_token - self.first_token
+            if isinstance(completion_tokens, int) and completion_tokens > 1 and decode:
+                # The first token is produced by prefill, so it is excluded.
+                timing["tokens_per_second"] = round(
+                    (completion_tokens - 1) / decode, 2
+                )
+            prefill = self.first_token - self.started
+            if isinstance(prompt_tokens, int) and prompt_tokens > 0 and prefill:
+                timing["prefill_tokens_per_second"] = round(
+                    prompt_tokens / prefill, 2
+                )
+        return timing
+
+
+@dataclass(slots=True)
+class ToolCallBuffer:
+    """Fragments of one streamed tool call, joined once when the stream ends."""
+
+    id: str = ""
+    name: str = ""
+    arguments: list[str] = field(default_factory=list)
+    scanner: _JSONScanner | None = None
+    error: str | None = None
+
+    def add_arguments(self, fragment: str) -> None:
+        if not fragment:
+            return
+        self.arguments.append(fragment)
+        if self.scanner is None or self.error is not None:
+            return
+        try:
+            self.scanner.feed(fragment)
+        except ValueError as e:
+            self.error = str(e)
+            _debug("Tool call %r has malformed arguments: %s", self.name, e)
+
+    def finish(self) -> dict[str, Any]:
+        """Return the assembled tool call in Chat Completions format."""
+        arguments = "".join(self.arguments)
+        if self.scanner is not None and self.error is None and arguments.strip():
+            try:
+                self.scanner.close()
+            except ValueError as e:
+                self.error = str(e)
+        return {
+            "id": self.id,
+            "type": "function",
+            "function": {"name": self.name, "arguments": arguments},
+        }
+
+
+@dataclass(slots=True)
+class StreamState:
+    chunks: list[dict[str, Any]] = field(default_factory=list)
+    tool_calls: list[ToolCallBuffer] = field(default_factory=list)
+    usage: dict[str, Any] | None = None
+    model: str | None = None
+    finish_reason: str | None = None
+    chunk_count: int = 0
+    chunk_limit: int | None = None
+    validate_tool_arguments: bool = False
+
+    def record_chunk(self, chunk: dict[str, Any]) -> None:
+        """Keep a chunk, or only its summary fields in compact mode."""
+        self.chunk_count += 1
+        model = chunk.get("model")
+        if model and isinstance(model, str):
+            self.model = model
+        if self.chunk_limit is None or len(self.chunks) < self.chunk_limit:
+            self.chunks.append(chunk)
+
+    def response_json(self) -> dict[str, Any]:
+        if self.chunk_limit is None:
+            return {"chunks": self.chunks}
+        return {
+            "model": self.model,
+            "finish_reason": self.finish_reason,
+            "usage": self.usage,
+            "chunk_count": self.chunk_count,
+            "chunks": self.chunks,
+        }
+
+
+class EventCoalescer:
+    """Merge consecutive text or reasoning events into fewer, larger events.
+
+    Buffered text is released when it reaches ``max_bytes``, when the first
+    buffered fragment is older than ``max_delay`` seconds, when an event of
+    another type arrives, and when the stream ends. A limit of 0 disables
+    that check. The age is checked as events arrive, so buffered text waits
+    for the next event or the end of the stream.
+    """
+
+    __slots__ = ("max_bytes", "max_delay", "_type", "_parts", "_size", "_started")
+
+    def __init__(self, max_bytes: int = 0, max_delay: float = 0.0) -> None:
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._type: str | None = None
+        self._parts: list[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    def push(self, event: StreamEvent) -> list[StreamEvent]:
+        if event.type not in ("text", "reasoning"):
+            released = self.flush()
+            released.append(event)
+            return released
+        released = self.flush() if event.type != self._type else []
+        if not self._parts:
+            self._type = event.type
+            self._started = time.monotonic()
+        self._parts.append(event.chunk)
+        self._size += len(event.chunk.encode("utf-8"))
+        if (self.max_bytes and self._size >= self.max_bytes) or (
+            self.max_delay and time.monotonic() - self._started >= self.max_delay
+        ):
+            released.extend(self.flush())
+        return released
+
+    def flush(self) -> list[StreamEvent]:
+        if not self._parts:
+            return []
+        event = StreamEvent(type=cast(str, self._type), chunk="".join(self._parts))
+        self._type = None
+        self._parts = []
+        self._size = 0
+        return [event]
+
+    def coalesce(self, events: Iterable[StreamEvent]) -> Iterator[StreamEvent]:
+        for event in events:
+            yield from self.push(event)
+        yield from self.flush()
+
+    async def acoalesce(
+        self, events: AsyncGenerator[StreamEvent, None]
+    ) -> AsyncGenerator[StreamEvent, None]:
+        async for event in events:
+            for released in self.push(event):
+                yield released
+        for released in self.flush():
+            yield released
+
+
+def _event_coalescer() -> EventCoalescer | None:
+    if COALESCE_BYTES <= 0 and COALESCE_MS <= 0:
+        return None
+    return EventCoalescer(COALESCE_BYTES, COALESCE_MS / 1000)
+
+
+class LMStudioBaseModel:
+    """Base class for common LMStudio model attributes."""
+
+    can_stream: bool = True
+    supports_tools: bool = True
+    attachment_types: ClassVar[set[str]] = {
+        "image/png",
+        "image/jpeg",
+        "image/gif",
+        "image/webp",
+    }
+
+    def __init__(
+        self,
+        model_id: str,
+        base_url: str,
+        raw_id: str,
+        api_path_prefix: str,
+        *,
+        supports_images: bool = False,
+        metadata: dict | None = None,
+        display_suffix: str = "",
+    ):
+        self.model_id = model_id
+        self.raw_id = raw_id
+        self.base = base_url
+        self.api_path_prefix = api_path_prefix
+        self.supports_images = supports_images
+        self.metadata = metadata or {}
+        self.supports_schema = True
+        self.display_suffix = display_suffix
+
+    class Options(llm.Options):
+        temperature: float | None = Field(None, description="Sampling temperature")
+        top_p: float | None = Field(None, description="Nucleus sampling")
+        max_tokens: int | None = Field(None, description="Maximum tokens")
+        stop: list[str] | None = Field(None, description="Stop sequences")
+
+    def _prepare_chat_request(
+        self,
+        prompt: llm.Prompt,
+        stream: bool,
+        conversation=None,
+    ) -> ChatRequest:
+        has_schema = bool(getattr(prompt, "schema", None))
+        has_tools = bool(getattr(prompt, "tools", None))
+
+        url = (
+            f"{self.base}/v1/chat/completions"
+            if has_schema
+            else f"{self.base}{self.api_path_prefix}/chat/completions"
+        )
+        payload: dict[str, Any] = {
+            "model": self.raw_id,
+            "messages": self._build_messages(prompt, conversation),
+        }
+
+        if has_tools:
+            payload["tools"] = self._encode_tools(prompt.tools)
+
+        if prompt.options:
             payload.update(prompt.options.model_dump(exclude_none=True))
 
         if has_schema:
@@ -327,7 +2442,6 @@ class LMStudioBaseModel:
                     "schema": prompt.schema,
                 },
             }
-            stream = False
 
         payload["stream"] = stream
         if stream:
@@ -359,6 +2473,8 @@ class LMStudioBaseModel:
     # --------------------------------------------------------------------- #
     def _is_model_loaded(self) -> bool:
         """Check if the current model is loaded."""
+        import requests
+
         if self.api_path_prefix == "/api/v0":
             try:
                 # Use the specific model endpoint if available (/api/v0)
@@ -374,7 +2490,8 @@ class LMStudioBaseModel:
                     r.raise_for_status()  # Raise other errors
             except requests.RequestException as e:
                 _debug(
-                    f"LMSTUDIO DEBUG: Could not check model via /api/v0; falling back to /v1/models: {e}"
+                    "Could not check model via /api/v0; falling back to /v1/models: %s",
+                    e,
                 )
 
         # Fallback or if using /v1: Check the /v1/models list (only shows loaded models)
@@ -387,16 +2504,28 @@ class LMStudioBaseModel:
             loaded_models = r.json().get("data", [])
             return any(m.get("id") == self.raw_id for m in loaded_models)
         except (requests.RequestException, AttributeError, TypeError) as e:
-            _debug(
-                f"LMSTUDIO DEBUG: Could not check loaded models via /v1/models: {e}"
-            )
+            _debug("Could not check loaded models via /v1/models: %s", e)
             return False  # Assume not loaded if check fails
 
     def _attempt_load_model(self) -> bool:
         """Load the model through LM Studio's synchronous REST endpoint."""
-        _debug(
-            f"LMSTUDIO INFO: Model '{self.raw_id}' not loaded. Attempting to load..."
+        logger.info("Model '%s' not loaded. Attempting to load...", self.raw_id)
+
+        started = time.perf_counter()
+        loaded = self._load_model()
+        labels = {"server": self.base, "model": self.raw_id}
+        metrics.inc(
+            "lmstudio_model_loads_total", outcome="ok" if loaded else "error", **labels
+        )
+        metrics.observe(
+            "lmstudio_model_load_duration_seconds",
+            time.perf_counter() - started,
+            **labels,
         )
+        return loaded
+
+    def _load_model(self) -> bool:
+        import requests
 
         try:
             response = requests.post(
@@ -413,8 +2542,11 @@ class LMStudioBaseModel:
             duration_text = (
                 f" in {duration:.3f}s" if isinstance(duration, int | float) else ""
             )
-            _debug(
-                f"LMSTUDIO INFO: Model '{self.raw_id}' loaded{duration_text} as instance '{result.get('instance_id')}'."
+            logger.info(
+                "Model '%s' loaded%s as instance '%s'.",
+                self.raw_id,
+                duration_text,
+                result.get("instance_id"),
             )
             return True
         except requests.RequestException as e:
@@ -506,7 +2638,9 @@ class LMStudioBaseModel:
                             "type": "function",
                             "function": {
                                 "name": part.name,
-                                "arguments": json.dumps(part.arguments),
+                                "arguments": _codec.dumps(part.arguments).decode(
+                                    "utf-8"
+                                ),
                             },
                         }
                     )
@@ -574,9 +2708,10 @@ class LMStudioBaseModel:
             try:
                 if attachment.resolve_type() not in self.attachment_types:
                     continue
-            except (ValueError, OSError, TypeError, httpx.HTTPError) as e:
+            except (ValueError, OSError, TypeError, *_attachment_http_errors()) as e:
                 _debug(
-                    f"LMSTUDIO DEBUG: Could not resolve attachment type while checking model support: {e}"
+                    "Could not resolve attachment type while checking model support: %s",
+                    e,
                 )
             print(
                 f"LMSTUDIO WARN: Attachments provided, but the selected model '{self.model_id}' "
@@ -589,23 +2724,29 @@ class LMStudioBaseModel:
         """Encode one image attachment as an OpenAI image_url content part."""
         if not self.supports_images:
             _debug(
-                f"LMSTUDIO DEBUG: Model {self.model_id} does not support images, but attachment {attachment.path or attachment.url or 'content'} was provided. Ignoring."
+                "Model %s does not support images, but attachment %s was provided. Ignoring.",
+                self.model_id,
+                attachment.path or attachment.url or "content",
             )
             return []
         try:
             resolved_type = attachment.resolve_type()
             if resolved_type not in self.attachment_types:
                 _debug(
-                    f"LMSTUDIO DEBUG: Attachment type {resolved_type} not in model's supported image types. Skipping {attachment.path or attachment.url or 'content'}."
+                    "Attachment type %s not in model's supported image types. Skipping %s.",
+                    resolved_type,
+                    attachment.path or attachment.url or "content",
                 )
                 return []
             base64_content = attachment.base64_content()
             data_uri = f"data:{resolved_type};base64,{base64_content}"
             _debug(
-                f"LMSTUDIO DEBUG: Encoded image attachment: {attachment.path or attachment.url or 'content'} as {resolved_type}."
+                "Encoded image attachment: %s as %s.",
+                attachment.path or attachment.url or "content",
+                resolved_type,
             )
             return [{"type": "image_url", "image_url": {"url": data_uri}}]
-        except (ValueError, OSError, TypeError, httpx.HTTPError) as e:
+        except (ValueError, OSError, TypeError, *_attachment_http_errors()) as e:
             print(
                 f"LMSTUDIO WARN: Could not process attachment {attachment.path or attachment.url or 'content'}: {e}. Skipping.",
                 file=sys.stderr,
@@ -625,7 +2766,7 @@ class LMStudioBaseModel:
         return (
             llm.ToolCall(
                 name=function_data.get("name", ""),
-                arguments=json.loads(arguments_json),
+                arguments=_codec.loads(arguments_json),
                 tool_call_id=tool_call_data.get("id") or f"tc_{uuid.uuid4().hex}",
             ),
             arguments_json,
@@ -662,25 +2803,57 @@ class LMStudioBaseModel:
         if resolved_model:
             response.set_resolved_model(resolved_model)
 
-    def _set_usage(self, response, usage: dict | None) -> None:
-        if not usage:
+    def _set_usage(
+        self, response, usage: dict | None, timing: dict | None = None
+    ) -> None:
+        if not usage and not timing:
             return
+        usage = usage or {}
         details = {
             key: value
             for key, value in usage.items()
             if key not in {"prompt_tokens", "completion_tokens", "total_tokens"}
         }
+        if timing:
+            details["timing"] = timing
+        self._record_usage(usage, timing)
         response.set_usage(
             input=usage.get("prompt_tokens"),
             output=usage.get("completion_tokens"),
             details=details or None,
         )
 
+    def _record_request(self, stream: bool, outcome: str, duration: float) -> None:
+        labels = {"server": self.base, "model": self.raw_id}
+        metrics.inc(
+            "lmstudio_requests_total",
+            mode="stream" if stream else "non_stream",
+            outcome=outcome,
+            **labels,
+        )
+        metrics.observe("lmstudio_request_duration_seconds", duration, **labels)
+
+    def _record_usage(self, usage: dict, timing: dict | None) -> None:
+        labels = {"server": self.base, "model": self.raw_id}
+        for kind in ("prompt", "completion"):
+            count = usage.get(f"{kind}_tokens")
+            if isinstance(count, int) and count > 0:
+                metrics.inc("lmstudio_tokens_total", count, kind=kind, **labels)
+        ttft_ms = timing.get("ttft_ms") if timing else None
+        if ttft_ms is not None:
+            metrics.observe(
+                "lmstudio_time_to_first_token_seconds", ttft_ms / 1000, **labels
+            )
+
     def _process_non_streaming_response(
         self,
         response,
         payload: dict[str, Any],
+        timer: RequestTimer | None = None,
     ) -> Iterator[StreamEvent]:
+        timing = timer.finish(payload.get("usage")) if timer else None
+        if timing:
+            payload = {**payload, "timing": timing}
         self._set_response_metadata(response, payload)
         choice = payload.get("choices", [{}])[0]
         message = choice.get("message", {})
@@ -692,74 +2865,90 @@ class LMStudioBaseModel:
         for tool_call_data in message.get("tool_calls") or []:
             try:
                 yield from self._record_tool_call(response, tool_call_data)
-            except (json.JSONDecodeError, TypeError) as e:
-                _debug(f"LMSTUDIO DEBUG: Error processing tool call: {e}")
+            except (ValueError, TypeError) as e:
+                _debug("Error processing tool call: %s", e)
 
         if message.get("content"):
             yield StreamEvent(type="text", chunk=message["content"])
 
-        self._set_usage(response, payload.get("usage"))
+        self._set_usage(response, payload.get("usage"), timing)
+
+    def _new_stream_state(self) -> StreamState:
+        return StreamState(
+            chunk_limit=STREAM_CHUNK_LIMIT,
+            validate_tool_arguments=VALIDATE_TOOL_ARGUMENTS,
+        )
 
     def _process_stream_line(
         self,
         line: str,
         state: StreamState,
     ) -> Iterator[StreamEvent]:
-        if not line or line == "data: [DONE]" or not line.startswith("data:"):
+        """Process one decoded ``data:`` line; see ``_process_stream_data``."""
+        if not line or not line.startswith("data:"):
             return
+        yield from self._process_stream_data(line[5:].strip(), state)
 
-        chunk_data = line[5:].strip()
-        if not chunk_data:
+    def _process_stream_data(
+        self,
+        data: str,
+        state: StreamState,
+    ) -> Iterator[StreamEvent]:
+        if not data or data == "[DONE]":
             return
         try:
-            chunk = json.loads(chunk_data)
-        except json.JSONDecodeError as e:
-            _debug(f"LMSTUDIO DEBUG: Ignoring malformed stream JSON: {e}")
+            chunk = _codec.loads_chunk(data)
+        except ValueError as e:
+            _debug("Ignoring malformed stream JSON: %s", e)
             return
         if not isinstance(chunk, dict):
-            _debug("LMSTUDIO DEBUG: Ignoring non-object stream chunk")
+            _debug("Ignoring non-object stream chunk")
             return
 
-        state.chunks.append(chunk)
+        state.record_chunk(chunk)
         usage = chunk.get("usage")
         if isinstance(usage, dict):
             state.usage = usage
         elif usage is not None:
-            _debug("LMSTUDIO DEBUG: Ignoring malformed stream usage")
+            _debug("Ignoring malformed stream usage")
 
         choices = chunk.get("choices")
         if not choices:
             return
         if not isinstance(choices, list) or not isinstance(choices[0], dict):
-            _debug("LMSTUDIO DEBUG: Ignoring malformed stream choices")
+            _debug("Ignoring malformed stream choices")
             return
 
+        finish_reason = choices[0].get("finish_reason")
+        if isinstance(finish_reason, str):
+            state.finish_reason = finish_reason
+
         delta = choices[0].get("delta", {})
         if not isinstance(delta, dict):
-            _debug("LMSTUDIO DEBUG: Ignoring malformed stream delta")
+            _debug("Ignoring malformed stream delta")
             return
 
         reasoning = delta.get("reasoning_content") or delta.get("reasoning")
         if isinstance(reasoning, str) and reasoning:
             yield StreamEvent(type="reasoning", chunk=reasoning)
         elif reasoning is not None and not isinstance(reasoning, str):
-            _debug("LMSTUDIO DEBUG: Ignoring malformed reasoning fragment")
+            _debug("Ignoring malformed reasoning fragment")
 
         token = delta.get("content")
         if isinstance(token, str) and token:
             yield StreamEvent(type="text", chunk=token)
         elif token is not None and not isinstance(token, str):
-            _debug("LMSTUDIO DEBUG: Ignoring malformed text fragment")
+            _debug("Ignoring malformed text fragment")
 
         tool_call_deltas = delta.get("tool_calls") or []
         if not isinstance(tool_call_deltas, list):
-            _debug("LMSTUDIO DEBUG: Ignoring malformed tool-call list")
+            _debug("Ignoring malformed tool-call list")
             return
         for tool_call_delta in tool_call_deltas:
             try:
                 self._apply_tool_call_delta(tool_call_delta, state)
             except (TypeError, ValueError) as e:
-                _debug(f"LMSTUDIO DEBUG: Ignoring malformed tool-call delta: {e}")
+                _debug("Ignoring malformed tool-call delta: %s", e)
 
     def _apply_tool_call_delta(
         self,
@@ -794,30 +2983,37 @@ class LMStudioBaseModel:
 
         while len(state.tool_calls) <= index:
             state.tool_calls.append(
-                {
-                    "id": "",
-                    "type": "function",
-                    "function": {"name": "", "arguments": ""},
-                }
+                ToolCallBuffer(
+                    scanner=_JSONScanner() if state.validate_tool_arguments else None
+                )
             )
 
         tool_call = state.tool_calls[index]
-        tool_call["id"] += tool_call_id
-        tool_call["function"]["name"] += name
-        tool_call["function"]["arguments"] += arguments
+        tool_call.id += tool_call_id
+        tool_call.name += name
+        tool_call.add_arguments(arguments)
 
     def _finalize_stream(
         self,
         response,
         state: StreamState,
+        timer: RequestTimer | None = None,
     ) -> Iterator[StreamEvent]:
-        self._set_response_metadata(response, {"chunks": state.chunks})
-        self._set_usage(response, state.usage)
-        for tool_call_data in state.tool_calls:
+        payload = state.response_json()
+        timing = timer.finish(state.usage) if timer else None
+        if timing:
+            payload["timing"] = timing
+        self._set_response_metadata(response, payload)
+        self._set_usage(response, state.usage, timing)
+        for tool_call in state.tool_calls:
+            tool_call_data = tool_call.finish()
+            if tool_call.error is not None:
+                _debug("Skipping tool call %r: %s", tool_call.name, tool_call.error)
+                continue
             try:
                 yield from self._record_tool_call(response, tool_call_data)
-            except (json.JSONDecodeError, TypeError) as e:
-                _debug(f"LMSTUDIO DEBUG: Error processing tool call: {e}")
+            except (ValueError, TypeError) as e:
+                _debug("Error processing tool call: %s", e)
 
 
 class LMStudioModel(LMStudioBaseModel, llm.Model):
@@ -833,27 +3029,88 @@ class LMStudioModel(LMStudioBaseModel, llm.Model):
         response: llm.Response,
         conversation=None,
     ) -> Iterator[str | StreamEvent]:
-        # --- Auto-loading Logic ---
-        if not self._is_model_loaded():
-            if not self._attempt_load_model():
-                raise llm.ModelError(
-                    f"Failed to load model '{self.raw_id}' through the LM Studio API."
+        profile = _start_profile(self.model_id)
+        started = time.perf_counter()
+        outcome = "cancelled"
+        # Cache hits never reach the server, so they are left out of the
+        # request metrics; the cache metrics count them.
+        replayed = False
+        try:
+            with profile.span("prepare_request"):
+                request = self._prepare_chat_request(prompt, stream, conversation)
+            reuse = _reuse_responses.get()
+            cache_key = (
+                _request_key(request) if reuse and _response_cache is not None else None
+            )
+            cached = _response_cache_lookup(cache_key)
+            semantic = None
+            if cached is None and reuse and _semantic_cache is not None:
+                with profile.span("semantic_cache"):
+                    semantic = _semantic_cache_lookup(request)
+            if cached is not None:
+                replayed = True
+                yield from cached.replay(response)
+            elif semantic is not None and semantic.hit is not None:
+                replayed = True
+                yield from semantic.hit.replay(
+                    response, semantic_similarity=semantic.similarity
+                )
+            elif cache_key is not None or semantic is not None:
+                recorder = _ResponseRecorder(response)
+                yield from recorder.record(
+                    self._execute(prompt, request, recorder, profile)
                 )
+                if cache_key is not None:
+                    _response_cache_store(cache_key, recorder.entry)
+                _semantic_cache_store(semantic, recorder.entry)
             else:
+                yield from self._execute(prompt, request, response, profile)
+            outcome = "ok"
+        except Exception as e:
+            outcome = _error_outcome(e)
+            raise
+        finally:
+            profile.finish()
+            if not replayed:
+                self._record_request(stream, outcome, time.perf_counter() - started)
+
+    def _execute(
+        self,
+        prompt: llm.Prompt,
+        request: ChatRequest,
+        response: llm.Response,
+        profile: RequestProfile | _NullProfile,
+    ) -> Iterator[str | StreamEvent]:
+        import requests
+
+        # --- Auto-loading Logic ---
+        with profile.span("is_model_loaded"):
+            is_loaded = self._is_model_loaded()
+        if not is_loaded:
+            with profile.span("load_model"):
+                if not self._attempt_load_model():
+                    raise llm.ModelError(
+                        f"Failed to load model '{self.raw_id}' through the LM Studio API."
+                    )
                 time.sleep(1)  # Add a small delay after successful load confirmation
         # --- End Auto-loading Logic ---
 
-        request = self._prepare_chat_request(prompt, stream, conversation)
         stream = request.stream
+        with profile.span("serialize"):
+            body = _codec.dumps(request.payload)
 
         # --- Execute API Call --- #
+        timer = RequestTimer()
         try:
-            r = requests.post(
-                request.url,
-                json=request.payload,
-                stream=request.stream,
-                timeout=request.timeout,
-            )
+            with profile.span("request"):
+                r = requests.post(
+                    request.url,
+                    data=body,
+                    headers=JSON_HEADERS,
+                    stream=request.stream,
+                    timeout=request.timeout,
+                )
+            timer.headers = time.perf_counter()
             r.raise_for_status()
         except requests.exceptions.Timeout:
             # Specific handling for timeout error
@@ -879,9 +3136,7 @@ class LMStudioModel(LMStudioBaseModel, llm.Model):
                     ):
                         is_model_not_found = True
             except (requests.exceptions.JSONDecodeError, AttributeError) as parse_error:
-                _debug(
-                    f"LMSTUDIO DEBUG: Could not parse LM Studio error response: {parse_error}"
-                )
+                _debug("Could not parse LM Studio error response: %s", parse_error)
 
             if is_model_not_found:
                 raise llm.ModelError(
@@ -893,94 +3148,246 @@ class LMStudioModel(LMStudioBaseModel, llm.Model):
 
         # --- Process Response --- #
         if stream:
-            state = StreamState()
-            for line in r.iter_lines():
-                try:
-                    decoded_line = line.decode("utf-8")
-                except UnicodeDecodeError as e:
-                    _debug(
-                        f"LMSTUDIO DEBUG: Ignoring invalid UTF-8 stream line: {e}"
-                    )
-                    continue
-                yield from self._process_stream_line(decoded_line, state)
-            yield from self._finalize_stream(response, state)
+            raw_chunks = profile.iter("network", r.iter_content(chunk_size=None))
+            events = self._iter_stream(raw_chunks, response, timer)
+            coalescer = _event_coalescer()
+            if coalescer:
+                events = coalescer.coalesce(events)
+            yield from profile.iter("parse", events, exclude=raw_chunks)
 
         else:  # Non-streaming
             try:
-                raw_text = r.text  # Get raw text first
-                res = r.json()
-            except json.JSONDecodeError as e:
+                with profile.span("parse"):
+                    res = _codec.loads(r.content)
+            except ValueError as e:
                 print(
                     f"LMSTUDIO ERROR: Failed to decode JSON response: {e}",
                     file=sys.stderr,
                 )
-                _debug(f"LMSTUDIO DEBUG: Failing raw text was: {raw_text}")
+                if _debug_enabled:
+                    _debug("Failing raw text was: %s", r.text)
                 raise llm.ModelError("Failed to decode JSON response from LM Studio.")
 
-            yield from self._process_non_streaming_response(response, res)
+            yield from self._process_non_streaming_response(response, res, timer)
 
         # --- End Process Response --- #
 
+    def _iter_stream(
+        self,
+        raw_chunks: Iterable[bytes],
+        response: llm.Response,
+        timer: RequestTimer,
+    ) -> Iterator[StreamEvent]:
+        state = self._new_stream_state()
+        parser = SSEParser()
+        for raw_chunk in raw_chunks:
+            if timer.first_byte is None:
+                timer.first_byte = time.perf_counter()
+            for data in parser.feed(raw_chunk):
+                for event in self._process_stream_data(data, state):
+                    timer.mark_token()
+                    yield event
+        for data in parser.close():
+            for event in self._process_stream_data(data, state):
+                timer.mark_token()
+                yield event
+        yield from self._finalize_stream(response, state, timer)
+
+
+# ------------------------  Async Model  ------------------------------------ #
+class LMStudioAsyncModel(LMStudioBaseModel, llm.AsyncModel):
+    """Async version of the chat/completion model class."""
+
+    async def execute(
+        self,
+        prompt: llm.Prompt,
+        stream: bool,
+        response: llm.AsyncResponse,
+        conversation: llm.AsyncConversation | None,
+    ) -> AsyncGenerator[str | StreamEvent, None]:
+        profile = _start_profile(self.model_id)
+        started = time.perf_counter()
+        outcome = "cancelled"
+        # Cache hits never reach the server, so they are left out of the
+        # request metrics; the cache metrics count them.
+        replayed = False
+        try:
+            with profile.span("prepare_request"):
+                request = self._prepare_chat_request(prompt, stream, conversation)
+            reuse = _reuse_responses.get()
+            key = (
+                _request_key(request)
+                if reuse and (_response_cache is not None or DEDUPLICATE_REQUESTS)
+                else None
+            )
+            cache_key = key if _response_cache is not None else None
+            cached = (
+                await asyncio.to_thread(_response_cache_lookup, cache_key)
+                if cache_key is not None
+                else None
+            )
+            semantic = None
+            if cached is None and reuse and _semantic_cache is not None:
+                with profile.span("semantic_cache"):
+                    semantic = await asyncio.to_thread(_semantic_cache_lookup, request)
+            if cached is not None:
+                replayed = True
+                for event in cached.replay(response):
+                    yield event
+            elif semantic is not None and semantic.hit is not None:
+                replayed = True
+                for event in semantic.hit.replay(
+                    response, semantic_similarity=semantic.similarity
+                ):
+                    yield event
+            elif key is not None and DEDUPLICATE_REQUESTS:
+                shared, flags = self._share_request(
+                    prompt, request, key, cache_key, profile, semantic is not None
+                )
+                async for event in shared.follow(response, **flags):
+                    yield event
+                if semantic is not None and not flags:
+                    await asyncio.to_thread(
+                        _semantic_cache_store, semantic, shared.entry
+                    )
+            elif cache_key is not None or semantic is not None:
+                recorder = _ResponseRecorder(response)
+                async for event in recorder.arecord(
+                    self._execute(prompt, request, recorder, profile)
+                ):
+                    yield event
+                if cache_key is not None:
+                    await asyncio.to_thread(
+                        _response_cache_store, cache_key, recorder.entry
+                    )
+                if semantic is not None:
+                    await asyncio.to_thread(
+                        _semantic_cache_store, semantic, recorder.entry
+                    )
+            else:
+                async for event in self._execute(prompt, request, response, profile):
+                    yield event
+            outcome = "ok"
+        except Exception as e:
+            outcome = _error_outcome(e)
+            raise
+        finally:
+            profile.finish()
+            if not replayed:
+                self._record_request(stream, outcome, time.perf_counter() - started)
+
+    def _share_request(
+        self,
+        prompt: llm.Prompt,
+        request: ChatRequest,
+        key: str,
+        cache_key: str | None,
+        profile: RequestProfile | _NullProfile,
+        record: bool = False,
+    ) -> tuple[_SharedStream, dict[str, Any]]:
+        """Join the identical request in flight, or start it for others to join.
 
-# ------------------------  Async Model  ------------------------------------ #
-class LMStudioAsyncModel(LMStudioBaseModel, llm.AsyncModel):
-    """Async version of the chat/completion model class."""
+        With ``record``, the events are kept in ``entry`` even without a
+        ``cache_key``.
+        """
+        # Streaming and non-streaming callers get different response_json
+        # and timings, so they never share a request.
+        inflight_key = (asyncio.get_running_loop(), key, request.stream)
+        shared = _inflight.get(inflight_key)
+        if shared is not None:
+            metrics.inc(
+                "lmstudio_deduplicated_requests_total",
+                server=self.base,
+                model=self.raw_id,
+            )
+            return shared, {"deduplicated": True}
+        recorder = _ResponseRecorder()
+        shared = _SharedStream(
+            inflight_key,
+            self._execute(prompt, request, recorder, profile),
+            recorder,
+            cache_key,
+            record,
+        )
+        _inflight[inflight_key] = shared
+        return shared, {}
 
-    async def execute(
+    async def _execute(
         self,
         prompt: llm.Prompt,
-        stream: bool,
+        request: ChatRequest,
         response: llm.AsyncResponse,
-        conversation: llm.AsyncConversation | None,
+        profile: RequestProfile | _NullProfile,
     ) -> AsyncGenerator[str | StreamEvent, None]:
+        import httpx
+
         # --- Auto-loading Logic (using sync helper) ---
-        if not self._is_model_loaded():
-            if not self._attempt_load_model():
-                raise llm.ModelError(
-                    f"Failed to load model '{self.raw_id}' through the LM Studio API."
-                )
-            else:
+        with profile.span("is_model_loaded"):
+            is_loaded = self._is_model_loaded()
+        if not is_loaded:
+            with profile.span("load_model"):
+                if not self._attempt_load_model():
+                    raise llm.ModelError(
+                        f"Failed to load model '{self.raw_id}' through the LM Studio API."
+                    )
                 # No async sleep needed here as load itself is sync
-                pass
         # --- End Auto-loading Logic ---
 
-        request = self._prepare_chat_request(prompt, stream, conversation)
         stream = request.stream
 
         # --- Execute API Call (Async) ---
         try:
+            with profile.span("serialize"):
+                body = _codec.dumps(request.payload)
             async with httpx.AsyncClient(timeout=request.timeout) as client:
+                timer = RequestTimer()
                 if request.stream:
-                    async with client.stream(
-                        "POST", request.url, json=request.payload
-                    ) as r:
+                    async with contextlib.AsyncExitStack() as stack:
+                        with profile.span("request"):
+                            r = await stack.enter_async_context(
+                                client.stream(
+                                    "POST",
+                                    request.url,
+                                    content=body,
+                                    headers=JSON_HEADERS,
+                                )
+                            )
+                        timer.headers = time.perf_counter()
                         r.raise_for_status()
-                        state = StreamState()
-                        async for line in r.aiter_lines():
-                            for event in self._process_stream_line(line, state):
-                                yield event
-                        for event in self._finalize_stream(response, state):
+                        raw_chunks = profile.iter("network", r.aiter_bytes())
+                        events = self._aiter_stream(raw_chunks, response, timer)
+                        coalescer = _event_coalescer()
+                        if coalescer:
+                            events = coalescer.acoalesce(events)
+                        async for event in profile.iter(
+                            "parse", events, exclude=raw_chunks
+                        ):
                             yield event
 
                 else:  # Non-streaming async
-                    r = await client.post(request.url, json=request.payload)
+                    with profile.span("request"):
+                        r = await client.post(
+                            request.url, content=body, headers=JSON_HEADERS
+                        )
+                    timer.headers = time.perf_counter()
                     r.raise_for_status()
                     try:
-                        raw_text = r.text
-                        res = r.json()
-                    except json.JSONDecodeError as e:
+                        with profile.span("parse"):
+                            res = _codec.loads(r.content)
+                    except ValueError as e:
                         print(
                             f"LMSTUDIO ERROR: Failed to decode JSON response: {e}",
                             file=sys.stderr,
                         )
-                        _debug(
-                            f"LMSTUDIO DEBUG: Failing raw text was: {raw_text}"
-                        )
+                        if _debug_enabled:
+                            _debug("Failing raw text was: %s", r.text)
                         raise llm.ModelError(
                             "Failed to decode JSON response from LM Studio."
                         )
 
-                    for event in self._process_non_streaming_response(response, res):
+                    for event in self._process_non_streaming_response(
+                        response, res, timer
+                    ):
                         yield event
 
         except httpx.TimeoutException:
@@ -999,27 +3406,1038 @@ class LMStudioAsyncModel(LMStudioBaseModel, llm.AsyncModel):
             # Basic error handling, could be refined like the sync version
             raise llm.ModelError(f"LM Studio async request failed: {e}")
 
+    async def _aiter_stream(
+        self,
+        raw_chunks: AsyncIterator[bytes],
+        response: llm.AsyncResponse,
+        timer: RequestTimer,
+    ) -> AsyncGenerator[StreamEvent, None]:
+        state = self._new_stream_state()
+        parser = SSEParser()
+        async for raw_chunk in raw_chunks:
+            if timer.first_byte is None:
+                timer.first_byte = time.perf_counter()
+            for data in parser.feed(raw_chunk):
+                for event in self._process_stream_data(data, state):
+                    timer.mark_token()
+                    yield event
+        for data in parser.close():
+            for event in self._process_stream_data(data, state):
+                timer.mark_token()
+                yield event
+        for event in self._finalize_stream(response, state, timer):
+            yield event
+
 
 # ------------------------  Embedding  ------------------------------------- #
+_embedding_pools: dict[str, ThreadPoolExecutor] = {}
+_embedding_pools_lock = threading.Lock()
+
+
+def _embedding_pool(base: str) -> ThreadPoolExecutor:
+    """The shared pool that bounds in-flight embeddings requests to ``base``."""
+    with _embedding_pools_lock:
+        pool = _embedding_pools.get(base)
+        if pool is None:
+            pool = _embedding_pools[base] = ThreadPoolExecutor(
+                max_workers=EMBED_CONCURRENCY,
+                thread_name_prefix=f"lmstudio-embed-{_host_tag(base)}",
+            )
+        return pool
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _run_now(function: Callable[..., Any], *args: Any) -> Future[Any]:
+    """Call ``function`` in this thread; same interface as ``pool.submit``."""
+    future: Future[Any] = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _estimate_tokens(item: str | bytes) -> int:
+    return len(item) // 4 + 1
+
+
+@dataclass(slots=True)
+class _WindowResults:
+    """The vectors of one window, released in input order as they arrive."""
+
+    vectors: list[list[float] | None]
+    released: int = 0
+
+    def release(self) -> list[list[float]]:
+        """Return the vectors after the last release that are all present."""
+        start = end = self.released
+        while end < len(self.vectors) and self.vectors[end] is not None:
+            end += 1
+        self.released = end
+        return cast(list[list[float]], self.vectors[start:end])
+
+
+@dataclass(slots=True)
+class _PackedBatch:
+    """The inputs of one request and where their vectors go in the window."""
+
+    inputs: list[str | bytes]
+    positions: list[int]
+    window: _WindowResults
+
+    def fill(self, vectors: list[list[float]]) -> list[list[float]]:
+        """Store ``vectors``; return whatever can now be yielded in order.
+
+        Batches are collected in submission order, so earlier windows are
+        always complete by the time a later window releases anything.
+        """
+        for position, vector in zip(self.positions, vectors):
+            self.window.vectors[position] = vector
+        return self.window.release()
+
+
+def _pack_window(
+    window: list[str | bytes], max_items: int, max_tokens: int
+) -> list[_PackedBatch]:
+    """Sort ``window`` by length and pack it into batches within both limits.
+
+    Similar lengths share a batch, which avoids padding short inputs to the
+    longest one. An input over the token limit gets a batch of its own.
+    """
+    order = sorted(range(len(window)), key=lambda i: _estimate_tokens(window[i]))
+    results = _WindowResults([None] * len(window))
+    groups: list[list[int]] = []
+    tokens = 0
+    for position in order:
+        cost = _estimate_tokens(window[position])
+        if not groups or len(groups[-1]) >= max_items or tokens + cost > max_tokens:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(position)
+        tokens += cost
+    return [
+        _PackedBatch([window[position] for position in group], group, results)
+        for group in groups
+    ]
+
+
+# Status codes and messages with which servers reject an oversized batch.
+_SIZE_ERROR = re.compile(
+    r"context (?:length|size|window)|too (?:long|large|many tokens)|exceed", re.I
+)
+
+
+def _is_size_error(status_code: int, text: str) -> bool:
+    return status_code == 413 or (
+        status_code in (400, 422, 500) and bool(_SIZE_ERROR.search(text))
+    )
+
+
+class _BatchTooLarge(llm.ModelError):
+    """The server refused an embeddings batch because of its size."""
+
+
+def _unpack_float32(data: bytes) -> list[float]:
+    """Little-endian packed float32, as in base64 embeddings, to floats."""
+    vector = array("f", data)
+    if sys.byteorder == "big":
+        vector.byteswap()
+    return vector.tolist()
+
+
+def _pack_float32(vector: list[float]) -> bytes:
+    packed = array("f", vector)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _decode_embedding(value: list[float] | str) -> list[float]:
+    """Accept a JSON float list or a base64 string of packed float32."""
+    if isinstance(value, str):
+        return _unpack_float32(base64.b64decode(value))
+    return value
+
+
+_EMBEDDING_PRECISIONS = ("float32", "float16", "int8")
+
+
+def _select_embed_precision(value: str) -> str:
+    if value in _EMBEDDING_PRECISIONS:
+        return value
+    print(
+        f"LMSTUDIO WARN: Unknown LMSTUDIO_EMBED_PRECISION value {value!r}. "
+        f"Expected {', '.join(_EMBEDDING_PRECISIONS)}. Using float32.",
+        file=sys.stderr,
+    )
+    return "float32"
+
+
+EMBED_PRECISION = _select_embed_precision(EMBED_PRECISION)
+
+
+def _embedding_suffix(dimensions: int | None, precision: str) -> str:
+    """Model id suffix for reduced embeddings, such as ``-256d-int8``."""
+    suffix = f"-{dimensions}d" if dimensions else ""
+    if precision != "float32":
+        suffix += "-f16" if precision == "float16" else f"-{precision}"
+    return suffix
+
+
+def _reduce_embedding(
+    vector: list[float], dimensions: int | None, precision: str
+) -> list[float]:
+    """Truncate ``vector`` to ``dimensions`` and lower its precision."""
+    if dimensions and dimensions < len(vector):
+        vector = vector[:dimensions]
+        norm = sum(x * x for x in vector) ** 0.5
+        if norm:
+            vector = [x / norm for x in vector]
+    if precision == "float16":
+        layout = f"<{len(vector)}e"
+        return list(struct.unpack(layout, struct.pack(layout, *vector)))
+    if precision == "int8":
+        # Uniform scaling keeps cosine similarity; the largest component is
+        # mapped to +/-127 so no precision is wasted.
+        peak = max(map(abs, vector), default=0.0)
+        scale = 127 / peak if peak else 0.0
+        return [float(round(x * scale)) for x in vector]
+    return vector
+
+
+# Servers that answered an ``encoding_format: base64`` request with an error.
+_float_only_servers: set[str] = set()
+
+
+class EmbeddingCache(_SQLiteLRU):
+    """Embedding vectors keyed on model identity and content, as float32."""
+
+    table = "embeddings"
+
+    def get_vectors(self, keys: list[str]) -> dict[str, list[float]]:
+        return {
+            key: _unpack_float32(value) for key, value in self.get_many(keys).items()
+        }
+
+    def put_vectors(self, items: list[tuple[str, list[float]]]) -> None:
+        self.put_many([(key, _pack_float32(vector)) for key, vector in items])
+
+
+_embedding_cache = (
+    EmbeddingCache(EMBED_CACHE, int(EMBED_CACHE_MAX_MB * 1024 * 1024))
+    if EMBED_CACHE
+    else None
+)
+
+
 class LMStudioEmbeddingModel(llm.EmbeddingModel):
-    def __init__(self, model_id: str, base_url: str, raw_id: str, api_path_prefix: str):
+    def __init__(
+        self,
+        model_id: str,
+        base_url: str,
+        raw_id: str,
+        api_path_prefix: str,
+        metadata: dict[str, Any] | None = None,
+        dimensions: int | None = None,
+        precision: str = "float32",
+    ):
+        if precision not in _EMBEDDING_PRECISIONS:
+            raise ValueError(
+                f"Unknown embedding precision {precision!r}; "
+                f"expected {', '.join(_EMBEDDING_PRECISIONS)}"
+            )
         self.model_id = model_id
         self.raw_id = raw_id
         self.base = base_url
         self.api_path_prefix = api_path_prefix
+        self.metadata = metadata or {}
+        # Applied to vectors on the way out, so the embedding cache holds the
+        # full vectors and every variant of a model shares it.
+        self.dimensions = dimensions or None
+        self.precision = precision
+        # ``llm`` hands over up to this many items at a time; ``embed_batch``
+        # splits them into requests that run concurrently.
+        self.batch_size = EMBED_BATCH_SIZE * EMBED_CONCURRENCY
 
     def embed_batch(self, items: Iterable[str | bytes]) -> Iterator[list[float]]:
+        """Embed ``items`` in order, reading them lazily.
+
+        Each window of ``batch_size`` items is sorted by length and packed into
+        requests of at most ``EMBED_BATCH_SIZE`` inputs and ``EMBED_BATCH_TOKENS``
+        estimated tokens, with up to ``EMBED_CONCURRENCY`` requests in flight.
+        Vectors are yielded as soon as every earlier one is available, so
+        memory use depends on the window size, not on the number of items.
+        """
+        limit = self._max_in_flight()
+        pending: deque[tuple[_PackedBatch, Future[list[list[float]]]]] = deque()
+        try:
+            for window in _batched(items, self.batch_size):
+                for batch in _pack_window(window, EMBED_BATCH_SIZE, EMBED_BATCH_TOKENS):
+                    pending.append((batch, self._submit_batch(batch.inputs)))
+                    if len(pending) >= limit:
+                        batch, future = pending.popleft()
+                        yield from batch.fill(self._reduce(future.result()))
+            while pending:
+                batch, future = pending.popleft()
+                yield from batch.fill(self._reduce(future.result()))
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def _reduce(self, vectors: list[list[float]]) -> list[list[float]]:
+        if self.dimensions is not None and vectors:
+            self._check_dimensions(len(vectors[0]))
+        if self.dimensions is None and self.precision == "float32":
+            return vectors
+        return [
+            _reduce_embedding(vector, self.dimensions, self.precision)
+            for vector in vectors
+        ]
+
+    def _check_dimensions(self, native: int) -> None:
+        """Stop truncating once the first vector shows that it keeps them all.
+
+        LM Studio does not list embedding sizes, so this is only known once
+        vectors arrive; the model keeps its ``-<N>d`` id either way.
+        """
+        if self.dimensions >= native:
+            print(
+                f"LMSTUDIO WARN: LMSTUDIO_EMBED_DIMENSIONS={self.dimensions} is not "
+                f"smaller than the {native} dimensions of {self.model_id}. "
+                "Vectors are not truncated.",
+                file=sys.stderr,
+            )
+            self.dimensions = None
+
+    def _max_in_flight(self) -> int:
+        return EMBED_CONCURRENCY
+
+    def _submit_batch(self, inputs: list[str | bytes]) -> Future[list[list[float]]]:
+        if EMBED_CONCURRENCY == 1:
+            return _run_now(self._embed_cached, inputs)
+        return _embedding_pool(self.base).submit(self._embed_cached, inputs)
+
+    def _cache_keys(self, inputs: list[str | bytes]) -> list[str]:
+        """Hash each input together with the model name and quantization."""
+        identity = f"{self.raw_id}\0{self.metadata.get('quantization') or ''}\0"
+        prefix = identity.encode("utf-8")
+        return [
+            hashlib.sha256(
+                prefix + (item if isinstance(item, bytes) else item.encode("utf-8"))
+            ).hexdigest()
+            for item in inputs
+        ]
+
+    def _cached_vectors(
+        self, cache: EmbeddingCache, keys: list[str]
+    ) -> tuple[dict[str, list[float]], list[int]]:
+        """Look ``keys`` up; return the hits and the indexes of the misses."""
+        found = cache.get_vectors(keys)
+        missing = [index for index, key in enumerate(keys) if key not in found]
+        labels = {"server": self.base, "model": self.raw_id}
+        if found:
+            metrics.inc(
+                "lmstudio_embedding_cache_total",
+                len(keys) - len(missing),
+                outcome="hit",
+                **labels,
+            )
+        if missing:
+            metrics.inc(
+                "lmstudio_embedding_cache_total",
+                len(missing),
+                outcome="miss",
+                **labels,
+            )
+        return found, missing
+
+    def _merge_cached(
+        self,
+        cache: EmbeddingCache,
+        keys: list[str],
+        found: dict[str, list[float]],
+        missing: list[int],
+        fetched: list[list[float]],
+    ) -> list[list[float]]:
+        """Store the fetched vectors and return every vector in input order."""
+        new = [(keys[index], vector) for index, vector in zip(missing, fetched)]
+        cache.put_vectors(new)
+        found.update(new)
+        return [found[key] for key in keys]
+
+    def _embed_cached(self, inputs: list[str | bytes]) -> list[list[float]]:
+        cache = _embedding_cache
+        if cache is None:
+            return self._embed_split(inputs)
+        keys = self._cache_keys(inputs)
+        found, missing = self._cached_vectors(cache, keys)
+        fetched = (
+            self._embed_split([inputs[index] for index in missing]) if missing else []
+        )
+        return self._merge_cached(cache, keys, found, missing, fetched)
+
+    def _embed_split(self, inputs: list[str | bytes]) -> list[list[float]]:
+        """Embed ``inputs``, halving the batch while the server says it is too big."""
+        try:
+            return self._embed_request(inputs)
+        except _BatchTooLarge:
+            if len(inputs) == 1:
+                raise
+            middle = self._record_split(inputs)
+            head = self._embed_split(inputs[:middle])
+            return head + self._embed_split(inputs[middle:])
+
+    def _record_split(self, inputs: list[str | bytes]) -> int:
+        _debug("Splitting an embeddings batch of %d inputs", len(inputs))
+        metrics.inc(
+            "lmstudio_embedding_splits_total", server=self.base, model=self.raw_id
+        )
+        return len(inputs) // 2
+
+    def _embed_request(self, inputs: list[str | bytes]) -> list[list[float]]:
+        import requests
+
+        started = time.perf_counter()
+        outcome = "error"
+        encoding = self._embedding_encoding()
         try:
             r = requests.post(
-                f"{self.base}{self.api_path_prefix}/embeddings",
-                json={"model": self.raw_id, "input": items},
+                self._embeddings_url(),
+                data=self._embeddings_body(inputs, encoding),
+                headers=JSON_HEADERS,
                 timeout=TIMEOUT,
             )
-            r.raise_for_status()
-            data = r.json()
-
-            return (cast(list[float], item["embedding"]) for item in data["data"])
-        except requests.RequestException as e:
+            try:
+                r.raise_for_status()
+            except requests.HTTPError:
+                if not self._base64_rejected(encoding, r):
+                    raise
+                r = requests.post(
+                    self._embeddings_url(),
+                    data=self._embeddings_body(inputs, None),
+                    headers=JSON_HEADERS,
+                    timeout=TIMEOUT,
+                )
+                r.raise_for_status()
+                self._use_floats()
+            vectors = self._parse_embeddings(r.content, inputs)
+            outcome = "ok"
+            return vectors
+        except requests.Timeout as e:
+            outcome = "timeout"
             raise llm.ModelError(f"LM Studio embeddings request failed: {e}") from e
-        except (KeyError, TypeError) as e:
+        except requests.RequestException as e:
+            error = _BatchTooLarge if self._size_error(e.response) else llm.ModelError
+            raise error(f"LM Studio embeddings request failed: {e}") from e
+        finally:
+            self._record_embeddings(outcome, len(inputs), started)
+
+    def _size_error(self, response) -> bool:
+        """Whether an HTTP error ``response`` rejects the batch for its size."""
+        if response is None:
+            return False
+        return _is_size_error(response.status_code, response.text)
+
+    def _embeddings_url(self) -> str:
+        return f"{self.base}{self.api_path_prefix}/embeddings"
+
+    def _embedding_encoding(self) -> str | None:
+        if EMBED_ENCODING == "base64" and self.base not in _float_only_servers:
+            return "base64"
+        return None
+
+    def _base64_rejected(self, encoding: str | None, response) -> bool:
+        """Whether a base64 request may have failed for its encoding, so that
+        the same inputs should be retried as floats."""
+        return (
+            encoding == "base64"
+            and response.status_code in (400, 422)
+            and not self._size_error(response)
+        )
+
+    def _use_floats(self) -> None:
+        """Remember a server that accepted floats after refusing base64.
+
+        Called only once the float retry succeeds, so that an input the
+        server rejects either way does not turn base64 off.
+        """
+        _float_only_servers.add(self.base)
+        _debug("%s rejected base64 embeddings; using floats", self.base)
+
+    def _embeddings_body(
+        self, inputs: list[str | bytes], encoding: str | None
+    ) -> bytes:
+        body: dict[str, Any] = {"model": self.raw_id, "input": inputs}
+        if encoding:
+            body["encoding_format"] = encoding
+        return _codec.dumps(body)
+
+    def _parse_embeddings(
+        self, content: bytes, inputs: list[str | bytes]
+    ) -> list[list[float]]:
+        try:
+            data = _codec.loads(content)
+            vectors = [_decode_embedding(item["embedding"]) for item in data["data"]]
+            if len(vectors) != len(inputs):
+                raise ValueError(
+                    f"expected {len(inputs)} embeddings, got {len(vectors)}"
+                )
+        except (KeyError, TypeError, ValueError) as e:
             raise llm.ModelError(f"Unexpected embeddings response: {e}") from e
+        return vectors
+
+    def _record_embeddings(self, outcome: str, count: int, started: float) -> None:
+        labels = {"server": self.base, "model": self.raw_id}
+        metrics.inc("lmstudio_embedding_requests_total", outcome=outcome, **labels)
+        metrics.inc("lmstudio_embedding_inputs_total", count, **labels)
+        metrics.observe(
+            "lmstudio_embedding_duration_seconds",
+            time.perf_counter() - started,
+            **labels,
+        )
+
+
+# One httpx client and request limit per event loop and server, because
+# both belong to the loop that created them.
+_async_embedding_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[str, tuple[httpx.AsyncClient, asyncio.Semaphore]]
+] = weakref.WeakKeyDictionary()
+
+
+def _async_embedding_client(base: str) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    import httpx
+
+    clients = _async_embedding_clients.setdefault(asyncio.get_running_loop(), {})
+    if base not in clients:
+        clients[base] = (
+            httpx.AsyncClient(
+                timeout=TIMEOUT,
+                limits=httpx.Limits(max_connections=EMBED_CONCURRENCY),
+            ),
+            asyncio.Semaphore(EMBED_CONCURRENCY),
+        )
+    return clients[base]
+
+
+async def _abatched(
+    items: Iterable[Any] | AsyncIterable[Any], size: int
+) -> AsyncIterator[list[Any]]:
+    if not isinstance(items, AsyncIterable):
+        for batch in _batched(items, size):
+            yield batch
+        return
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class LMStudioAsyncEmbeddingModel(LMStudioEmbeddingModel):
+    """Embedding model with an asyncio API next to the synchronous one.
+
+    ``llm`` has no registry for async embedding models, so this class is
+    registered in place of ``LMStudioEmbeddingModel`` and keeps its methods.
+    """
+
+    async def aembed(self, item: str | bytes) -> list[float]:
+        self._check(item)
+        (vector,) = self._reduce(await self._aembed_batch([item]))
+        return vector
+
+    async def aembed_multi(
+        self, items: Iterable[str | bytes] | AsyncIterable[str | bytes]
+    ) -> AsyncIterator[list[float]]:
+        """Embed ``items`` in order, batched and packed like ``embed_batch``.
+
+        Input is read only as fast as the results are consumed.
+        """
+        limit = self._max_in_flight()
+        pending: deque[tuple[_PackedBatch, asyncio.Task[list[list[float]]]]] = deque()
+        try:
+            async for window in _abatched(items, self.batch_size):
+                for batch in _pack_window(window, EMBED_BATCH_SIZE, EMBED_BATCH_TOKENS):
+                    task = asyncio.create_task(self._aembed_batch(batch.inputs))
+                    pending.append((batch, task))
+                    if len(pending) >= limit:
+                        batch, task = pending.popleft()
+                        for vector in batch.fill(self._reduce(await task)):
+                            yield vector
+            while pending:
+                batch, task = pending.popleft()
+                for vector in batch.fill(self._reduce(await task)):
+                    yield vector
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def aclose(self) -> None:
+        """Close the shared client for this server on the running event loop."""
+        clients = _async_embedding_clients.get(asyncio.get_running_loop(), {})
+        if self.base in clients:
+            client, _ = clients.pop(self.base)
+            await client.aclose()
+
+    async def _aembed_batch(self, inputs: list[str | bytes]) -> list[list[float]]:
+        return await self._aembed_cached(inputs)
+
+    async def _aembed_cached(self, inputs: list[str | bytes]) -> list[list[float]]:
+        cache = _embedding_cache
+        if cache is None:
+            return await self._aembed_split(inputs)
+        keys = self._cache_keys(inputs)
+        found, missing = await asyncio.to_thread(self._cached_vectors, cache, keys)
+        fetched = (
+            await self._aembed_split([inputs[index] for index in missing])
+            if missing
+            else []
+        )
+        return await asyncio.to_thread(
+            self._merge_cached, cache, keys, found, missing, fetched
+        )
+
+    async def _aembed_split(self, inputs: list[str | bytes]) -> list[list[float]]:
+        try:
+            return await self._aembed_request(inputs)
+        except _BatchTooLarge:
+            if len(inputs) == 1:
+                raise
+            middle = self._record_split(inputs)
+            head = await self._aembed_split(inputs[:middle])
+            return head + await self._aembed_split(inputs[middle:])
+
+    async def _aembed_request(self, inputs: list[str | bytes]) -> list[list[float]]:
+        import httpx
+
+        client, limit = _async_embedding_client(self.base)
+        async with limit:
+            started = time.perf_counter()
+            outcome = "error"
+            encoding = self._embedding_encoding()
+            try:
+                r = await client.post(
+                    self._embeddings_url(),
+                    content=self._embeddings_body(inputs, encoding),
+                    headers=JSON_HEADERS,
+                )
+                try:
+                    r.raise_for_status()
+                except httpx.HTTPStatusError:
+                    if not self._base64_rejected(encoding, r):
+                        raise
+                    r = await client.post(
+                        self._embeddings_url(),
+                        content=self._embeddings_body(inputs, None),
+                        headers=JSON_HEADERS,
+                    )
+                    r.raise_for_status()
+                    self._use_floats()
+                vectors = self._parse_embeddings(r.content, inputs)
+                outcome = "ok"
+                return vectors
+            except httpx.TimeoutException as e:
+                outcome = "timeout"
+                raise llm.ModelError(
+                    f"LM Studio embeddings request failed: {e}"
+                ) from e
+            except httpx.HTTPError as e:
+                response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+                error = _BatchTooLarge if self._size_error(response) else llm.ModelError
+                raise error(f"LM Studio embeddings request failed: {e}") from e
+            finally:
+                self._record_embeddings(outcome, len(inputs), started)
+
+
+@dataclass(slots=True)
+class _ServerLoad:
+    """What a pooled embedding model knows about one of its servers."""
+
+    rate: float | None = None  # smoothed inputs per second
+    in_flight: int = 0  # inputs sent and not yet answered
+    failed_until: float = 0.0  # time.monotonic() before which to avoid it
+
+
+class LMStudioPooledEmbeddingModel(LMStudioAsyncEmbeddingModel):
+    """One embedding model served by several LM Studio servers.
+
+    Each batch goes to the server expected to finish it first, judged by its
+    observed throughput and the inputs already in flight there. A server that
+    fails is avoided for ``EMBED_SERVER_COOLDOWN`` seconds and the batch is
+    retried on the others. Vectors come back in input order.
+    """
+
+    # Weight of the newest throughput sample in the moving average.
+    smoothing = 0.3
+
+    def __init__(
+        self,
+        model_id: str,
+        members: list[LMStudioAsyncEmbeddingModel],
+        dimensions: int | None = None,
+        precision: str = "float32",
+    ):
+        first = members[0]
+        super().__init__(
+            model_id,
+            first.base,
+            first.raw_id,
+            first.api_path_prefix,
+            first.metadata,
+            dimensions,
+            precision,
+        )
+        self.members = members
+        self.batch_size = EMBED_BATCH_SIZE * self._max_in_flight()
+        self._lock = threading.Lock()
+        self._loads = {member.base: _ServerLoad() for member in members}
+
+    def _max_in_flight(self) -> int:
+        return EMBED_CONCURRENCY * len(self.members)
+
+    def _choose(
+        self, count: int, tried: Iterable[str] = ()
+    ) -> LMStudioAsyncEmbeddingModel:
+        """Pick the server for ``count`` inputs and count them as in flight."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [m for m in self.members if m.base not in tried]
+            healthy = [
+                m for m in candidates if self._loads[m.base].failed_until <= now
+            ]
+            rates = [load.rate for load in self._loads.values() if load.rate]
+            # Servers without a sample yet are assumed to be average.
+            default = sum(rates) / len(rates) if rates else 1.0
+
+            def finish_time(member: LMStudioAsyncEmbeddingModel) -> float:
+                load = self._loads[member.base]
+                return (load.in_flight + count) / (load.rate or default)
+
+            member = min(healthy or candidates, key=finish_time)
+            self._loads[member.base].in_flight += count
+        return member
+
+    def _release(
+        self,
+        member: LMStudioAsyncEmbeddingModel,
+        count: int,
+        duration: float | None = None,
+        failed: bool = False,
+    ) -> None:
+        """Record the end of a request and, given its ``duration``, its rate."""
+        with self._lock:
+            load = self._loads[member.base]
+            load.in_flight -= count
+            if failed:
+                load.failed_until = time.monotonic() + EMBED_SERVER_COOLDOWN
+                return
+            if duration is None:
+                return
+            load.failed_until = 0.0
+            rate = count / max(duration, 1e-6)
+            if load.rate is None:
+                load.rate = rate
+            else:
+                load.rate += self.smoothing * (rate - load.rate)
+
+    def _failover(
+        self,
+        member: LMStudioAsyncEmbeddingModel,
+        count: int,
+        tried: list[str],
+        error: llm.ModelError,
+    ) -> LMStudioAsyncEmbeddingModel:
+        """Give up on ``member`` for this batch; pick the next server or raise."""
+        self._release(member, count, failed=True)
+        tried.append(member.base)
+        if len(tried) == len(self.members):
+            raise error
+        _debug("Embeddings on %s failed, retrying elsewhere: %s", member.base, error)
+        metrics.inc("lmstudio_embedding_failovers_total", model=self.raw_id)
+        return self._choose(count, tried)
+
+    def _submit_batch(self, inputs: list[str | bytes]) -> Future[list[list[float]]]:
+        result: Future[list[list[float]]] = Future()
+        self._submit_to(self._choose(len(inputs)), inputs, [], result)
+        return result
+
+    def _submit_to(
+        self,
+        member: LMStudioAsyncEmbeddingModel,
+        inputs: list[str | bytes],
+        tried: list[str],
+        result: Future[list[list[float]]],
+    ) -> None:
+        """Run ``inputs`` on ``member``'s pool and complete ``result``.
+
+        A failed attempt is resubmitted to the next server's pool, so every
+        attempt counts against the limit of the server it runs on.
+        """
+        attempt = _embedding_pool(member.base).submit(self._embed_on, member, inputs)
+        result.add_done_callback(lambda future: future.cancelled() and attempt.cancel())
+
+        def done(attempt: Future[list[list[float]]]) -> None:
+            if attempt.cancelled():
+                self._release(member, len(inputs))
+                return
+            error = attempt.exception()
+            if isinstance(error, llm.ModelError) and not isinstance(
+                error, _BatchTooLarge
+            ):
+                try:
+                    retry = self._failover(member, len(inputs), tried, error)
+                except llm.ModelError:
+                    pass
+                else:
+                    self._submit_to(retry, inputs, tried, result)
+                    return
+            with contextlib.suppress(InvalidStateError):  # cancelled meanwhile
+                if error is None:
+                    result.set_result(attempt.result())
+                else:
+                    result.set_exception(error)
+
+        attempt.add_done_callback(done)
+
+    def _embed_on(
+        self, member: LMStudioAsyncEmbeddingModel, inputs: list[str | bytes]
+    ) -> list[list[float]]:
+        """Make one attempt on ``member``.
+
+        A failure that allows failover is released by ``_failover``; every
+        other outcome is released here.
+        """
+        started = time.perf_counter()
+        try:
+            vectors = member._embed_cached(inputs)
+        except _BatchTooLarge:
+            self._release(member, len(inputs))
+            raise
+        except llm.ModelError:
+            raise
+        except BaseException:
+            self._release(member, len(inputs))
+            raise
+        self._release(member, len(inputs), time.perf_counter() - started)
+        return vectors
+
+    async def _aembed_batch(self, inputs: list[str | bytes]) -> list[list[float]]:
+        member = self._choose(len(inputs))
+        tried: list[str] = []
+        while True:
+            started = time.perf_counter()
+            try:
+                vectors = await member._aembed_cached(inputs)
+            except _BatchTooLarge:
+                self._release(member, len(inputs))
+                raise
+            except llm.ModelError as e:
+                member = self._failover(member, len(inputs), tried, e)
+                continue
+            except BaseException:
+                self._release(member, len(inputs))
+                raise
+            self._release(member, len(inputs), time.perf_counter() - started)
+            return vectors
+
+    async def aclose(self) -> None:
+        for member in self.members:
+            await member.aclose()
+
+
+# --------------------------------------------------------------------------- #
+#  Benchmark command                                                          #
+# --------------------------------------------------------------------------- #
+BENCH_PROMPTS = (
+    "Write a haiku about the sea.",
+    "Explain how a hash map works in three sentences.",
+    "List five uses for a paperclip.",
+    "Summarize the plot of Romeo and Juliet in one paragraph.",
+)
+
+
+def _bench_models(
+    model_ids: Iterable[str], servers: Iterable[str]
+) -> list[LMStudioAsyncModel]:
+    bases = {server.rstrip("/") for server in servers}
+    if model_ids:
+        models = []
+        for model_id in model_ids:
+            try:
+                model = llm.get_async_model(model_id)
+            except llm.UnknownModelError:
+                raise click.ClickException(f"Unknown model: {model_id}")
+            if not isinstance(model, LMStudioAsyncModel):
+                raise click.ClickException(f"{model_id} is not an LM Studio model")
+            models.append(model)
+    else:
+        models = [
+            model
+            for model in llm.get_async_models()
+            if isinstance(model, LMStudioAsyncModel)
+        ]
+    return [model for model in models if not bases or model.base in bases]
+
+
+def _percentile(values: list[float], percent: float) -> float | None:
+    """Nearest-rank percentile; ``None`` for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, -(-len(ordered) * percent // 100) - 1)
+    return ordered[int(index)]
+
+
+async def _bench_request(
+    model: LMStudioAsyncModel, prompt: str, options: dict[str, Any]
+) -> dict[str, Any]:
+    import httpx
+
+    started = time.perf_counter()
+    try:
+        response = model.prompt(prompt, stream=True, **options)
+        async for _ in response:
+            pass
+        usage = await response.usage()
+    except (llm.ModelError, httpx.HTTPError, ValueError) as e:
+        return {"ok": False, "error": str(e)}
+    timing = (response.response_json or {}).get("timing", {})
+    return {
+        "ok": True,
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "ttft_ms": timing.get("ttft_ms"),
+        "tokens_per_second": timing.get("tokens_per_second"),
+        "output_tokens": usage.output or 0,
+    }
+
+
+async def _bench_level(
+    model: LMStudioAsyncModel,
+    prompts: list[str],
+    level: int,
+    count: int,
+    options: dict[str, Any],
+) -> dict[str, Any]:
+    semaphore = asyncio.Semaphore(level)
+
+    async def limited(prompt: str) -> dict[str, Any]:
+        async with semaphore:
+            return await _bench_request(model, prompt, options)
+
+    started = time.perf_counter()
+    runs = await asyncio.gather(
+        *(limited(prompts[i % len(prompts)]) for i in range(count))
+    )
+    wall = time.perf_counter() - started
+    ok = [run for run in runs if run["ok"]]
+    latencies = [run["latency_ms"] for run in ok]
+    ttfts = [run["ttft_ms"] for run in ok if run["ttft_ms"] is not None]
+    speeds = [run["tokens_per_second"] for run in ok if run["tokens_per_second"]]
+    return {
+        "concurrency": level,
+        "requests": count,
+        "errors": count - len(ok),
+        "error_messages": sorted({run["error"] for run in runs if not run["ok"]}),
+        "wall_s": wall,
+        "ttft_ms_p50": _percentile(ttfts, 50),
+        "ttft_ms_p95": _percentile(ttfts, 95),
+        "latency_ms_p50": _percentile(latencies, 50),
+        "latency_ms_p95": _percentile(latencies, 95),
+        "latency_ms_p99": _percentile(latencies, 99),
+        "stream_tokens_per_second": (
+            sum(speeds) / len(speeds) if speeds else None
+        ),
+        "aggregate_tokens_per_second": sum(run["output_tokens"] for run in ok) / wall,
+    }
+
+
+async def run_bench(
+    models: list[LMStudioAsyncModel],
+    prompts: list[str],
+    levels: list[int],
+    request_count: int | None = None,
+    options: dict[str, Any] | None = None,
+) -> list[dict[str, Any]]:
+    """Benchmark each model at each concurrency level and return one row each.
+
+    A model that is not loaded is loaded first, and its load time is reported
+    as ``load_s``. Every request reaches LM Studio: the response caches and
+    in-flight sharing are bypassed.
+    """
+    token = _reuse_responses.set(False)
+    try:
+        rows = []
+        for model in models:
+            load_s = None
+            if not await asyncio.to_thread(model._is_model_loaded):
+                started = time.perf_counter()
+                if not await asyncio.to_thread(model._attempt_load_model):
+                    rows.append(
+                        {
+                            "model": model.model_id,
+                            "server": model.base,
+                            "error": "model failed to load",
+                        }
+                    )
+                    continue
+                load_s = time.perf_counter() - started
+            for level in levels:
+                result = await _bench_level(
+                    model, prompts, level, request_count or 4 * level, options or {}
+                )
+                rows.append(
+                    {"model": model.model_id, "server": model.base, "load_s": load_s}
+                    | result
+                )
+                load_s = None
+        return rows
+    finally:
+        _reuse_responses.reset(token)
+
+
+def format_bench_table(rows: list[dict[str, Any]]) -> str:
+    columns = (
+        ("model", "model", "{}"),
+        ("conc", "concurrency", "{}"),
+        ("reqs", "requests", "{}"),
+        ("errs", "errors", "{}"),
+        ("load s", "load_s", "{:.2f}"),
+        ("ttft p50", "ttft_ms_p50", "{:.0f}"),
+        ("ttft p95", "ttft_ms_p95", "{:.0f}"),
+        ("tok/s", "stream_tokens_per_second", "{:.1f}"),
+        ("agg tok/s", "aggregate_tokens_per_second", "{:.1f}"),
+        ("p50 ms", "latency_ms_p50", "{:.0f}"),
+        ("p95 ms", "latency_ms_p95", "{:.0f}"),
+        ("p99 ms", "latency_ms_p99", "{:.0f}"),
+    )
+    table = [[title for title, _, _ in columns]]
+    for row in rows:
+        if "error" in row:
+            table.append([row["model"], row["error"]])
+            continue
+        table.append(
+            [
+                "-" if row.get(key) is None else template.format(row[key])
+                for _, key, template in columns
+            ]
+        )
+    widths = [
+        max(len(line[i]) for line in table if len(line) == len(columns))
+        for i in range(len(columns))
+    ]
+    lines = []
+    for line in table:
+        if len(line) != len(columns):
+            lines.append(f"{line[0].ljust(widths[0])}  {line[1]}")
+            continue
+        cells = [line[0].ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in zip(line[1:], widths[1:])]
+        lines.append("  ".join(cells))
+    return "\n".join(lines)
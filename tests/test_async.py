@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -233,10 +234,420 @@ async def test_async_execute_streams_events_and_records_usage(monkeypatch):
         "stream_options": {"include_usage": True},
     }
     assert response.response_json == {
+        "timing": response.response_json["timing"],
         "chunks": [json.loads(line[5:]) for line in lines[:-1]]
     }
     response.set_resolved_model.assert_called_once_with("resolved-model")
-    response.set_usage.assert_called_once_with(input=42, output=5, details=None)
+    usage = response.set_usage.call_args.kwargs
+    assert (usage["input"], usage["output"]) == (42, 5)
+    assert usage["details"] == {"timing": response.response_json["timing"]}
+    assert set(usage["details"]["timing"]) == {
+        "headers_ms",
+        "ttfb_ms",
+        "ttft_ms",
+        "decode_ms",
+        "inter_token_ms",
+        "total_ms",
+        "tokens_per_second",
+        "prefill_tokens_per_second",
+    }
+
+
+def _mock_async_client(monkeypatch, handler):
+    transport = llm_lmstudio.httpx.MockTransport(handler)
+    async_client_class = llm_lmstudio.httpx.AsyncClient
+    monkeypatch.setattr(
+        llm_lmstudio.httpx,
+        "AsyncClient",
+        lambda **kwargs: async_client_class(transport=transport, **kwargs),
+    )
+
+
+def _mock_stream_model(monkeypatch, handler):
+    """A loaded ``LMStudioAsyncModel`` whose requests go to ``handler``."""
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioAsyncModel, "_is_model_loaded", lambda self: True
+    )
+    _mock_async_client(monkeypatch, handler)
+    return llm_lmstudio.LMStudioAsyncModel(
+        model_id="lmstudio/test",
+        base_url="http://localhost:1234",
+        raw_id="test-model",
+        api_path_prefix="/api/v0",
+    )
+
+
+async def test_async_execute_coalesces_stream_events(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "COALESCE_BYTES", 64)
+    body = "".join(
+        f'data: {{"choices":[{{"delta":{{"content":"{token}"}}}}]}}\n\n'
+        for token in ["Hel", "lo", ", ", "world"]
+    )
+
+    async def handler(request):
+        return llm_lmstudio.httpx.Response(200, content=body + "data: [DONE]\n\n")
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt("Hello", model, messages=[llm.user("Hello")])
+
+    events = [
+        event
+        async for event in model.execute(
+            prompt=prompt, stream=True, response=MagicMock(), conversation=None
+        )
+    ]
+
+    assert [(event.type, event.chunk) for event in events] == [
+        ("text", "Hello, world")
+    ]
+
+
+async def test_async_execute_records_profile_spans(monkeypatch):
+    profiles = []
+    monkeypatch.setattr(llm_lmstudio, "_profile_sink", profiles.append)
+
+    async def handler(request):
+        return llm_lmstudio.httpx.Response(
+            200,
+            content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            "data: [DONE]\n\n",
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt("Hello", model, messages=[llm.user("Hello")])
+
+    async for _ in model.execute(
+        prompt=prompt, stream=True, response=MagicMock(), conversation=None
+    ):
+        pass
+
+    (profile,) = profiles
+    assert [span.name for span in profile.spans] == [
+        "prepare_request",
+        "is_model_loaded",
+        "serialize",
+        "request",
+        "network",
+        "parse",
+    ]
+
+
+async def test_async_response_cache_replays_stream(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        llm_lmstudio,
+        "_response_cache",
+        llm_lmstudio.ResponseCache(str(tmp_path / "responses.db"), 1024 * 1024),
+    )
+    requests_seen = []
+
+    async def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return llm_lmstudio.httpx.Response(
+            200,
+            content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":1}}\n\n'
+            "data: [DONE]\n\n",
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt(
+        "Hello",
+        model,
+        messages=[llm.user("Hello")],
+        options=model.Options(temperature=0),
+    )
+
+    replies = []
+    for _ in range(2):
+        response = MagicMock()
+        events = [
+            event
+            async for event in model.execute(
+                prompt=prompt, stream=True, response=response, conversation=None
+            )
+        ]
+        replies.append(([getattr(e, "chunk", e) for e in events], response))
+
+    assert len(requests_seen) == 1
+    (first, first_response), (second, second_response) = replies
+    assert first == second == ["Hi"]
+    assert second_response.set_usage.call_args == first_response.set_usage.call_args
+
+
+# At temperature 0 the requests go through in-flight deduplication, which
+# must record the events for the semantic cache even without a response cache.
+@pytest.mark.parametrize("temperature", [None, 0])
+async def test_async_semantic_cache_replays_paraphrase(
+    monkeypatch, tmp_path, temperature
+):
+    monkeypatch.setattr(llm_lmstudio, "_response_cache", None)
+    monkeypatch.setattr(llm_lmstudio, "DEDUPLICATE_REQUESTS", True)
+    vectors = {"Hello": [1.0, 0.0], "Hello there": [0.99, 0.141]}
+    embedding_model = MagicMock()
+    embedding_model.embed.side_effect = vectors.__getitem__
+    monkeypatch.setattr(llm, "get_embedding_model", lambda model_id: embedding_model)
+    cache = llm_lmstudio.SemanticCache(str(tmp_path / "semantic.db"), "embed", 0.9, 0)
+    monkeypatch.setattr(llm_lmstudio, "_semantic_cache", cache)
+    requests_seen = []
+
+    async def handler(request):
+        requests_seen.append(json.loads(request.content))
+        return llm_lmstudio.httpx.Response(
+            200, content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+    replies = []
+    for text in ("Hello", "Hello there"):
+        prompt = llm.Prompt(
+            text,
+            model,
+            messages=[llm.user(text)],
+            options=model.Options(temperature=temperature),
+        )
+        response = MagicMock()
+        events = [
+            event
+            async for event in model.execute(
+                prompt=prompt, stream=True, response=response, conversation=None
+            )
+        ]
+        replies.append(([getattr(e, "chunk", e) for e in events], response))
+
+    assert len(requests_seen) == 1
+    (first, _), (second, second_response) = replies
+    assert first == second == ["Hi"]
+    assert second_response.response_json["semantic_similarity"] > 0.9
+
+
+async def _collect(model, prompt):
+    response = MagicMock()
+    events = [
+        getattr(event, "chunk", event)
+        async for event in model.execute(
+            prompt=prompt, stream=True, response=response, conversation=None
+        )
+    ]
+    return events, response
+
+
+@pytest.mark.parametrize("temperature, upstream", [(0, 1), (0.7, 3)])
+async def test_identical_concurrent_requests_share_one_upstream_call(
+    monkeypatch, temperature, upstream
+):
+    calls = []
+    release = asyncio.Event()
+
+    async def handler(request):
+        calls.append(request)
+        await release.wait()
+        return llm_lmstudio.httpx.Response(
+            200,
+            content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":1}}\n\n'
+            "data: [DONE]\n\n",
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt(
+        "Hello",
+        model,
+        messages=[llm.user("Hello")],
+        options=model.Options(temperature=temperature),
+    )
+
+    tasks = [asyncio.create_task(_collect(model, prompt)) for _ in range(3)]
+    while len(calls) < upstream:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+    release.set()
+    results = await asyncio.gather(*tasks)
+
+    assert len(calls) == upstream
+    assert [events for events, _ in results] == [["Hi"]] * 3
+    for _, response in results:
+        response.set_usage.assert_called_once()
+    assert llm_lmstudio._inflight == {}
+
+
+async def test_streaming_and_non_streaming_requests_are_not_shared(monkeypatch):
+    calls = []
+    release = asyncio.Event()
+
+    async def handler(request):
+        body = json.loads(request.content)
+        calls.append(body)
+        await release.wait()
+        if body["stream"]:
+            return llm_lmstudio.httpx.Response(
+                200, content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            )
+        return llm_lmstudio.httpx.Response(
+            200, json={"choices": [{"message": {"content": "Hi"}}]}
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt(
+        "Hello",
+        model,
+        messages=[llm.user("Hello")],
+        options=model.Options(temperature=0),
+    )
+
+    async def collect(stream):
+        response = MagicMock()
+        return [
+            getattr(event, "chunk", event)
+            async for event in model.execute(
+                prompt=prompt, stream=stream, response=response, conversation=None
+            )
+        ]
+
+    tasks = [asyncio.create_task(collect(stream)) for stream in (True, False)]
+    await asyncio.sleep(0.01)
+    release.set()
+
+    assert await asyncio.gather(*tasks) == [["Hi"], ["Hi"]]
+    assert sorted(call["stream"] for call in calls) == [False, True]
+    assert llm_lmstudio._inflight == {}
+
+
+async def test_shared_request_error_reaches_every_caller(monkeypatch):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return llm_lmstudio.httpx.Response(500, json={"error": "boom"})
+
+    model = _mock_stream_model(monkeypatch, handler)
+    prompt = llm.Prompt(
+        "Hello",
+        model,
+        messages=[llm.user("Hello")],
+        options=model.Options(temperature=0),
+    )
+
+    results = await asyncio.gather(
+        _collect(model, prompt), _collect(model, prompt), return_exceptions=True
+    )
+
+    assert len(calls) == 1
+    first, second = results
+    assert isinstance(first, llm_lmstudio.httpx.HTTPStatusError)
+    assert second is first
+    assert llm_lmstudio._inflight == {}
+
+
+async def test_run_bench_sends_every_request_upstream(monkeypatch, tmp_path):
+    monkeypatch.setattr(
+        llm_lmstudio,
+        "_response_cache",
+        llm_lmstudio.ResponseCache(str(tmp_path / "responses.db"), 1024 * 1024),
+    )
+    embedding_model = MagicMock()
+    embedding_model.embed.return_value = [1.0, 0.0]
+    monkeypatch.setattr(llm, "get_embedding_model", lambda model_id: embedding_model)
+    monkeypatch.setattr(
+        llm_lmstudio,
+        "_semantic_cache",
+        llm_lmstudio.SemanticCache(str(tmp_path / "semantic.db"), "embed", 0.9, 0),
+    )
+    monkeypatch.setattr(llm_lmstudio, "DEDUPLICATE_REQUESTS", True)
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        return llm_lmstudio.httpx.Response(
+            200,
+            content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":1}}\n\n'
+            "data: [DONE]\n\n",
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+
+    (row,) = await llm_lmstudio.run_bench(
+        [model], ["Hello"], [4], request_count=8, options={"temperature": 0}
+    )
+
+    assert row["errors"] == 0
+    assert len(calls) == row["requests"] == 8
+    assert llm_lmstudio._reuse_responses.get() is True
+
+
+async def test_async_embedding_model_batches_concurrently_in_order(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_CONCURRENCY", 2)
+    in_flight = []
+    peak = []
+
+    async def handler(request):
+        inputs = json.loads(request.content)["input"]
+        in_flight.append(1)
+        peak.append(len(in_flight))
+        # Later batches finish first.
+        await asyncio.sleep(0.02 / (1 + int(inputs[0])))
+        in_flight.pop()
+        return llm_lmstudio.httpx.Response(
+            200, json={"data": [{"embedding": [float(text)]} for text in inputs]}
+        )
+
+    _mock_async_client(monkeypatch, handler)
+    model = llm_lmstudio.LMStudioAsyncEmbeddingModel(
+        "lmstudio/embed", "http://localhost:1234", "embed", "/api/v0"
+    )
+
+    async def texts():
+        for i in range(7):
+            yield str(i)
+
+    vectors = [vector async for vector in model.aembed_multi(texts())]
+
+    assert vectors == [[float(i)] for i in range(7)]
+    assert max(peak) == 2
+    assert await model.aembed("5") == [5.0]
+    await model.aclose()
+
+
+async def test_run_bench_reports_percentiles_and_errors(monkeypatch):
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) % 4 == 0:
+            return llm_lmstudio.httpx.Response(500, json={"error": "busy"})
+        return llm_lmstudio.httpx.Response(
+            200,
+            content='data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n'
+            'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":2}}\n\n'
+            "data: [DONE]\n\n",
+        )
+
+    model = _mock_stream_model(monkeypatch, handler)
+
+    rows = await llm_lmstudio.run_bench([model], ["Hello"], [1, 2])
+
+    assert [row["concurrency"] for row in rows] == [1, 2]
+    assert [row["requests"] for row in rows] == [4, 8]
+    assert [row["errors"] for row in rows] == [1, 2]
+    assert all(row["model"] == "lmstudio/test" for row in rows)
+    assert rows[0]["load_s"] is None
+    assert rows[0]["ttft_ms_p50"] is not None
+    assert rows[0]["latency_ms_p50"] <= rows[0]["latency_ms_p99"]
+    assert rows[1]["aggregate_tokens_per_second"] > 0
+
+
+async def test_aiter_json_items_skips_non_text_events():
+    async def events():
+        yield StreamEvent(type="reasoning", chunk="{not json")
+        yield StreamEvent(type="text", chunk='[{"a": 1}, ')
+        yield StreamEvent(type="text", chunk='{"a": 2}]')
+
+    items = [item async for item in llm_lmstudio.aiter_json_items(events())]
+
+    assert items == [((0,), {"a": 1}), ((1,), {"a": 2})]
 
 
 async def test_async_execute_handles_tool_call_response(monkeypatch):
@@ -335,7 +746,9 @@ async def test_async_execute_handles_tool_call_response(monkeypatch):
     assert added_call.name == "get_weather"
     assert added_call.arguments == {"location": "Berlin"}
     assert added_call.tool_call_id == "call_weather_async"
-    response.set_usage.assert_called_once_with(input=33, output=7, details=None)
+    usage = response.set_usage.call_args.kwargs
+    assert (usage["input"], usage["output"]) == (33, 7)
+    assert usage["details"] == {"timing": response.response_json["timing"]}
 
     assert captured["client_kwargs"] == {"timeout": llm_lmstudio.TIMEOUT}
     request = captured["request"]
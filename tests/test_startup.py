@@ -0,0 +1,42 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import llm_lmstudio
+
+# Loaded on first use, never by ``import llm_lmstudio``. The import-time budget
+# itself is checked by ``benchmarks/bench_startup.py``.
+FORBIDDEN = ("requests", "httpx", "http.server")
+LIST_ADDED_MODULES = """
+import json, sys
+import llm
+before = set(sys.modules)
+import llm_lmstudio
+print(json.dumps(sorted(set(sys.modules) - before)))
+"""
+
+
+def test_import_does_not_load_http_clients():
+    result = subprocess.run(
+        [sys.executable, "-c", LIST_ADDED_MODULES],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    added = json.loads(result.stdout)
+    assert [name for name in FORBIDDEN if name in added] == []
+
+
+@pytest.mark.parametrize("name", ["requests", "httpx"])
+def test_lazy_http_clients_are_module_attributes(name):
+    module = getattr(llm_lmstudio, name)
+
+    assert module is sys.modules[name]
+
+
+def test_unknown_module_attribute_raises():
+    with pytest.raises(AttributeError):
+        llm_lmstudio.no_such_attribute
@@ -1,9 +1,17 @@
+import base64
 import json
+import threading
+import time
+import urllib.request
+from array import array
 from types import SimpleNamespace
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock
 
 import llm
 import pytest
+from click.testing import CliRunner
+from llm.cli import cli
+from llm.parts import StreamEvent
 
 import llm_lmstudio
 from llm_lmstudio import LMStudioModel
@@ -124,22 +132,47 @@ def mock_prompt_factory():
     return _factory
 
 
-# Removed custom captured_stderr, will use capsys
+@pytest.fixture
+def debug_logging():
+    llm_lmstudio.configure_logging(True)
+    yield
+    llm_lmstudio.configure_logging(False)
+
 
-def test_debug_logging_is_disabled_by_default(monkeypatch, capsys):
-    monkeypatch.delenv("LLM_LMSTUDIO_DEBUG", raising=False)
+def test_debug_logging_is_disabled_by_default(capsys):
+    llm_lmstudio.configure_logging(False)
 
-    llm_lmstudio._debug("LMSTUDIO DEBUG: hidden")
+    llm_lmstudio._debug("hidden %s", "value")
 
+    assert not llm_lmstudio._debug_enabled
     assert capsys.readouterr().err == ""
 
 
-def test_debug_logging_writes_to_stderr_when_enabled(monkeypatch, capsys):
-    monkeypatch.setenv("LLM_LMSTUDIO_DEBUG", "1")
+def test_debug_logging_writes_to_stderr_when_enabled(debug_logging, capsys):
+    llm_lmstudio._debug("visible %s", "value")
+
+    assert capsys.readouterr().err == "LMSTUDIO DEBUG: visible value\n"
+
+
+def test_configure_logging_respects_application_level():
+    llm_lmstudio.logger.setLevel("DEBUG")
+
+    llm_lmstudio.configure_logging(False)
+
+    assert llm_lmstudio._debug_enabled
+    llm_lmstudio.logger.setLevel("NOTSET")
+    llm_lmstudio.configure_logging(False)
+    assert not llm_lmstudio._debug_enabled
 
-    llm_lmstudio._debug("LMSTUDIO DEBUG: visible")
 
-    assert capsys.readouterr().err == "LMSTUDIO DEBUG: visible\n"
+def test_debug_logging_does_not_format_arguments_when_disabled():
+    class Exploding:
+        def __str__(self):
+            raise AssertionError("formatted while logging is off")
+
+    llm_lmstudio.configure_logging(False)
+
+    llm_lmstudio._debug("value: %s", Exploding())
 
 
 # --- Tests for _build_messages (which calls _encode_attachments) ---
@@ -232,7 +265,7 @@ def test_build_messages_with_text_and_multiple_valid_images(
 
 
 def test_build_messages_unsupported_attachment_type_on_vlm(
-    vlm_model, mock_prompt_factory, mock_attachment_factory, capsys
+    debug_logging, vlm_model, mock_prompt_factory, mock_attachment_factory, capsys
 ):
     pdf_attachment = mock_attachment_factory(
         mime_type="application/pdf", base64_content="pdf_data", path="doc.pdf"
@@ -240,8 +273,7 @@ def test_build_messages_unsupported_attachment_type_on_vlm(
     prompt = mock_prompt_factory(
         prompt_text="Summarize this.", attachments=[pdf_attachment]
     )
-    with patch.dict("os.environ", {"LLM_LMSTUDIO_DEBUG": "1"}):
-        messages = vlm_model._build_messages(prompt, conversation=None)
+    messages = vlm_model._build_messages(prompt, conversation=None)
 
     assert len(messages) == 1
     user_message = messages[0]
@@ -255,7 +287,11 @@ def test_build_messages_unsupported_attachment_type_on_vlm(
 
 
 def test_build_messages_image_with_non_vlm_model(
-    non_vlm_model, mock_prompt_factory, mock_attachment_factory, capsys
+    debug_logging,
+    non_vlm_model,
+    mock_prompt_factory,
+    mock_attachment_factory,
+    capsys,
 ):
     image_attachment = mock_attachment_factory(
         mime_type="image/png", base64_content="img_data"
@@ -263,8 +299,7 @@ def test_build_messages_image_with_non_vlm_model(
     prompt = mock_prompt_factory(
         prompt_text="What is this?", attachments=[image_attachment]
     )
-    with patch.dict("os.environ", {"LLM_LMSTUDIO_DEBUG": "1"}):
-        messages = non_vlm_model._build_messages(prompt, conversation=None)
+    messages = non_vlm_model._build_messages(prompt, conversation=None)
 
     assert len(messages) == 1
     user_message = messages[0]
@@ -314,14 +349,13 @@ def test_build_messages_attachment_processing_error(
 
 
 def test_build_messages_no_text_no_valid_attachments(
-    vlm_model, mock_prompt_factory, mock_attachment_factory, capsys
+    debug_logging, vlm_model, mock_prompt_factory, mock_attachment_factory, capsys
 ):
     failing_attachment = mock_attachment_factory(
         resolve_type_raises=ValueError("Cannot resolve"), path="fail.img"
     )
     prompt = mock_prompt_factory(prompt_text=None, attachments=[failing_attachment])
-    with patch.dict("os.environ", {"LLM_LMSTUDIO_DEBUG": "1"}):
-        messages = vlm_model._build_messages(prompt, conversation=None)
+    messages = vlm_model._build_messages(prompt, conversation=None)
 
     assert len(messages) == 1
     user_message = messages[0]
@@ -461,10 +495,9 @@ def test_build_messages_includes_tool_calls_from_history(
     assert "tool_calls" in assistant_message
     assert assistant_message["tool_calls"][0]["id"] == "call_weather_1"
     assert assistant_message["tool_calls"][0]["function"]["name"] == "get_weather"
-    assert (
-        assistant_message["tool_calls"][0]["function"]["arguments"]
-        == '{"location": "Berlin"}'
-    )
+    assert json.loads(assistant_message["tool_calls"][0]["function"]["arguments"]) == {
+        "location": "Berlin"
+    }
 
 
 def test_build_messages_includes_current_tool_results(vlm_model, mock_prompt_factory):
@@ -493,9 +526,8 @@ def test_build_messages_includes_current_tool_results(vlm_model, mock_prompt_fac
 
 
 def test_sync_stream_ignores_invalid_utf8_and_recovers(
-    monkeypatch, vlm_model, capsys
+    debug_logging, monkeypatch, vlm_model, capsys
 ):
-    monkeypatch.setenv("LLM_LMSTUDIO_DEBUG", "1")
     monkeypatch.setattr(
         llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
     )
@@ -504,13 +536,14 @@ def test_sync_stream_ignores_invalid_utf8_and_recovers(
         def raise_for_status(self):
             return None
 
-        def iter_lines(self):
+        def iter_content(self, chunk_size=None):
+            assert chunk_size is None
             return iter(
                 [
-                    b'data: {"choices":[{"delta":{"content":"bad \xff"}}]}',
-                    b'data: {"model":"resolved-model","choices":[{"delta":{"content":"Recovered"}}]}',
-                    b'data: {"choices":[],"usage":{"prompt_tokens":42,"completion_tokens":5}}',
-                    b"data: [DONE]",
+                    b'data: {"choices":[{"delta":{"content":"bad \xff"}}]}\n\n',
+                    b'data: {"model":"resolved-model","choices":[{"delta":{"content":"Recovered"}}]}\n\n',
+                    b'data: {"choices":[],"usage":{"prompt_tokens":42,"completion_tokens":5}}\n\n',
+                    b"data: [DONE]\n\n",
                 ]
             )
 
@@ -539,9 +572,112 @@ def test_sync_stream_ignores_invalid_utf8_and_recovers(
     assert [(event.type, event.chunk) for event in events] == [
         ("text", "Recovered")
     ]
-    assert "Ignoring invalid UTF-8 stream line" in capsys.readouterr().err
+    assert "Ignoring invalid UTF-8 stream event" in capsys.readouterr().err
     response.set_resolved_model.assert_called_once_with("resolved-model")
-    response.set_usage.assert_called_once_with(input=42, output=5, details=None)
+    usage = response.set_usage.call_args.kwargs
+    assert (usage["input"], usage["output"]) == (42, 5)
+    assert usage["details"] == {"timing": response.response_json["timing"]}
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgspec"])
+def test_json_codecs_share_behaviour(name):
+    if name != "json":
+        pytest.importorskip(name)
+    codec = llm_lmstudio._select_json_codec(name)
+    chunk = (
+        '{"id":"chatcmpl-1","object":"chat.completion.chunk","model":"m",'
+        '"choices":[{"index":0,"delta":{"content":"caf\u00e9"},"logprobs":null}]}'
+    )
+
+    assert codec.name == name
+    assert codec.loads(codec.dumps({"a": [1, "é"]})) == {"a": [1, "é"]}
+    decoded = codec.loads_chunk(chunk)
+    assert decoded["model"] == "m"
+    assert decoded["choices"][0]["delta"] == {"content": "café"}
+    assert codec.loads_chunk('{"choices": {"delta": {}}}') == {
+        "choices": {"delta": {}}
+    }
+    with pytest.raises(ValueError):
+        codec.loads("{not JSON")
+    with pytest.raises(ValueError):
+        codec.loads_chunk(b"{not JSON")
+
+
+def test_select_json_codec_warns_and_falls_back_for_unknown_name(capsys):
+    codec = llm_lmstudio._select_json_codec("simdjson")
+
+    assert codec.name == llm_lmstudio._select_json_codec("auto").name
+    assert "Unknown LMSTUDIO_JSON_CODEC value 'simdjson'" in capsys.readouterr().err
+
+
+def test_select_json_codec_warns_and_falls_back_for_missing_library(
+    monkeypatch, capsys
+):
+    def missing():
+        raise ImportError("No module named 'msgspec'")
+
+    monkeypatch.setitem(llm_lmstudio._JSON_CODECS, "msgspec", missing)
+
+    codec = llm_lmstudio._select_json_codec("msgspec")
+
+    assert codec.name in ("orjson", "json")
+    assert "requires msgspec" in capsys.readouterr().err
+
+
+def test_sse_parser_handles_split_bytes_crlf_and_multiline_data():
+    parser = llm_lmstudio.SSEParser()
+    body = (
+        ': keep-alive\r\n'
+        'event: message\r\n'
+        'data: {"text":\r\n'
+        'data: "caf\u00e9 \U0001f426"}\r\n'
+        '\r\n'
+        'data: [DONE]'
+    ).encode("utf-8")
+
+    events = []
+    for i in range(len(body)):
+        events.extend(parser.feed(body[i : i + 1]))
+    events.extend(parser.close())
+
+    assert events == ['{"text":\n"caf\u00e9 \U0001f426"}', "[DONE]"]
+    assert json.loads(events[0]) == {"text": "caf\u00e9 \U0001f426"}
+
+
+def test_event_coalescer_merges_runs_up_to_size():
+    coalescer = llm_lmstudio.EventCoalescer(max_bytes=4)
+    events = [
+        StreamEvent(type="reasoning", chunk="a"),
+        StreamEvent(type="reasoning", chunk="b"),
+        StreamEvent(type="text", chunk="é"),
+        StreamEvent(type="text", chunk="fg"),
+        StreamEvent(type="text", chunk="h"),
+        StreamEvent(type="tool_call_name", chunk="lookup", tool_call_id="call_1"),
+        StreamEvent(type="text", chunk="i"),
+    ]
+
+    merged = list(coalescer.coalesce(events))
+
+    assert [(event.type, event.chunk) for event in merged] == [
+        ("reasoning", "ab"),
+        ("text", "éfg"),
+        ("text", "h"),
+        ("tool_call_name", "lookup"),
+        ("text", "i"),
+    ]
+    assert merged[3].tool_call_id == "call_1"
+
+
+def test_event_coalescer_releases_after_delay(monkeypatch):
+    clock = iter([10.0, 10.001, 10.02])
+    monkeypatch.setattr(llm_lmstudio.time, "monotonic", lambda: next(clock))
+    coalescer = llm_lmstudio.EventCoalescer(max_delay=0.01)
+
+    assert coalescer.push(StreamEvent(type="text", chunk="a")) == []
+    released = coalescer.push(StreamEvent(type="text", chunk="b"))
+
+    assert [(event.type, event.chunk) for event in released] == [("text", "ab")]
+    assert coalescer.flush() == []
 
 
 def test_execute_handles_tool_call_response(monkeypatch, vlm_model):
@@ -572,20 +708,18 @@ def test_execute_handles_tool_call_response(monkeypatch, vlm_model):
 
     class FakePostResponse:
         def __init__(self, payload):
-            self._payload = payload
             self.text = json.dumps(payload)
+            self.content = self.text.encode("utf-8")
 
         def raise_for_status(self):
             return None
 
-        def json(self):
-            return self._payload
-
     last_request = {}
 
-    def fake_post(url, json=None, stream=False, timeout=None):
+    def fake_post(url, data=None, headers=None, stream=False, timeout=None):
         last_request["url"] = url
-        last_request["json"] = json
+        last_request["headers"] = headers
+        last_request["json"] = json.loads(data)
         return FakePostResponse(api_response)
 
     monkeypatch.setattr(llm_lmstudio.requests, "post", fake_post)
@@ -639,8 +773,11 @@ def test_execute_handles_tool_call_response(monkeypatch, vlm_model):
     assert tool_call_arg.name == "get_weather"
     assert tool_call_arg.arguments == {"location": "Berlin"}
     assert tool_call_arg.tool_call_id == "call_weather_123"
-    response.set_usage.assert_called_once_with(input=42, output=5, details=None)
+    usage = response.set_usage.call_args.kwargs
+    assert (usage["input"], usage["output"]) == (42, 5)
+    assert usage["details"] == {"timing": response.response_json["timing"]}
 
+    assert last_request["headers"] == {"Content-Type": "application/json"}
     sent_tools = last_request["json"]["tools"]
     assert sent_tools[0]["function"]["name"] == "get_weather"
     assert sent_tools[0]["function"]["parameters"]["required"] == ["location"]
@@ -666,9 +803,7 @@ def test_prepare_chat_request_for_streaming(vlm_model, mock_prompt_factory):
     }
 
 
-def test_prepare_chat_request_for_schema_forces_non_streaming(
-    vlm_model, mock_prompt_factory
-):
+def test_prepare_chat_request_for_schema_streams(vlm_model, mock_prompt_factory):
     prompt = mock_prompt_factory(prompt_text="Hello")
     prompt.schema = {"type": "object"}
     prompt.tools = []
@@ -676,10 +811,10 @@ def test_prepare_chat_request_for_schema_forces_non_streaming(
     request = vlm_model._prepare_chat_request(prompt, stream=True)
 
     assert request.url == "http://localhost:1234/v1/chat/completions"
-    assert request.stream is False
+    assert request.stream is True
     assert request.timeout == max(llm_lmstudio.TIMEOUT, 30.0)
-    assert request.payload["stream"] is False
-    assert "stream_options" not in request.payload
+    assert request.payload["stream"] is True
+    assert request.payload["stream_options"] == {"include_usage": True}
     assert request.payload["response_format"] == {
         "type": "json_schema",
         "json_schema": {
@@ -689,10 +824,32 @@ def test_prepare_chat_request_for_schema_forces_non_streaming(
     }
 
 
+def test_iter_json_items_yields_records_as_they_close():
+    text = '{"items": [{"name": "Ada", "tags": ["x"]}, {"name": "Grace"}], "n": 2}'
+    chunks = [text[i : i + 3] for i in range(0, len(text), 3)]
+    seen = []
+
+    def stream():
+        for chunk in chunks:
+            seen.append(chunk)
+            yield chunk
+
+    items = llm_lmstudio.iter_json_items(stream(), depth=2)
+
+    assert next(items) == (("items", 0), {"name": "Ada", "tags": ["x"]})
+    assert "Grace" not in "".join(seen)
+    assert list(items) == [(("items", 1), {"name": "Grace"})]
+    assert list(llm_lmstudio.iter_json_items(chunks)) == [
+        (("items",), [{"name": "Ada", "tags": ["x"]}, {"name": "Grace"}]),
+        (("n",), 2),
+    ]
+    with pytest.raises(ValueError, match="Expected ','"):
+        list(llm_lmstudio.iter_json_items(['{"a": 1 "b"']))
+
+
 def test_process_stream_line_ignores_malformed_input_without_corrupting_state(
-    vlm_model, monkeypatch, capsys
+    debug_logging, vlm_model, monkeypatch, capsys
 ):
-    monkeypatch.setenv("LLM_LMSTUDIO_DEBUG", "1")
     state = llm_lmstudio.StreamState()
     lines = [
         "data: {not JSON",
@@ -753,6 +910,1095 @@ def test_process_and_finalize_stream(vlm_model):
     assert added_call.tool_call_id == "call_1"
 
 
+def test_compact_stream_state_keeps_summary_and_sample(vlm_model):
+    response = MagicMock()
+    state = llm_lmstudio.StreamState(chunk_limit=1)
+    lines = [
+        'data: {"model":"resolved-model","choices":[{"delta":{"content":"A"}}]}',
+        'data: {"choices":[{"delta":{"content":"B"}}]}',
+        'data: {"choices":[{"delta":{},"finish_reason":"stop"}]}',
+        'data: {"choices":[],"usage":{"prompt_tokens":42,"completion_tokens":2}}',
+    ]
+
+    for line in lines:
+        list(vlm_model._process_stream_line(line, state))
+    list(vlm_model._finalize_stream(response, state))
+
+    assert not hasattr(state, "__dict__")
+    assert response.response_json == {
+        "model": "resolved-model",
+        "finish_reason": "stop",
+        "usage": {"prompt_tokens": 42, "completion_tokens": 2},
+        "chunk_count": 4,
+        "chunks": [json.loads(lines[0][5:])],
+    }
+    response.set_resolved_model.assert_called_once_with("resolved-model")
+
+
+def test_streamed_tool_call_arguments_are_validated_incrementally(
+    debug_logging, vlm_model, monkeypatch, capsys
+):
+    response = MagicMock()
+    state = llm_lmstudio.StreamState(validate_tool_arguments=True)
+    deltas = [
+        (0, "call_ok", "write", '{"path": "a.txt", '),
+        (0, "", "", '"content": "line\\n"}'),
+        (1, "call_bad", "write", '{"path": ]'),
+        (1, "", "", '"ignored"}'),
+    ]
+    for index, call_id, name, arguments in deltas:
+        delta = {
+            "index": index,
+            "id": call_id,
+            "function": {"name": name, "arguments": arguments},
+        }
+        line = "data: " + json.dumps({"choices": [{"delta": {"tool_calls": [delta]}}]})
+        list(vlm_model._process_stream_line(line, state))
+
+    assert state.tool_calls[0].arguments == [
+        '{"path": "a.txt", ',
+        '"content": "line\\n"}',
+    ]
+    assert state.tool_calls[0].error is None
+    assert "Unexpected ']' at offset 9" in state.tool_calls[1].error
+    assert "has malformed arguments" in capsys.readouterr().err
+
+    events = list(vlm_model._finalize_stream(response, state))
+
+    assert [(event.type, event.tool_call_id) for event in events] == [
+        ("tool_call_name", "call_ok"),
+        ("tool_call_args", "call_ok"),
+    ]
+    added_call = response.add_tool_call.call_args.args[0]
+    assert added_call.arguments == {"path": "a.txt", "content": "line\n"}
+
+
+@pytest.mark.parametrize(
+    "fragments, valid",
+    [
+        (['{"a": [1, 2.5e3, true, null], ', '"b": "\\u00e9"}'], True),
+        (["[", "]"], True),
+        (['{"a": 1', "}", " "], True),
+        (['{"a": 1,', "}"], False),
+        (['{"a": 01}'], False),
+        (['{"a": "unterminated'], False),
+        (["{} {}"], False),
+    ],
+)
+def test_json_scanner_matches_json_loads(fragments, valid):
+    scanner = llm_lmstudio._JSONScanner()
+    try:
+        for fragment in fragments:
+            scanner.feed(fragment)
+        scanner.close()
+    except ValueError:
+        accepted = False
+    else:
+        accepted = True
+
+    assert accepted is valid
+
+
+def test_request_timer_reports_latency_and_throughput(monkeypatch):
+    clock = iter([100.5, 100.75, 101.0, 102.0])
+    monkeypatch.setattr(llm_lmstudio.time, "perf_counter", lambda: next(clock))
+    timer = llm_lmstudio.RequestTimer(started=100.0)
+    timer.headers = 100.01
+    timer.first_byte = 100.05
+
+    timer.mark_token()
+    timer.mark_token()
+    timer.mark_token()
+    timing = timer.finish({"prompt_tokens": 500, "completion_tokens": 11})
+
+    assert timing == {
+        "headers_ms": 10.0,
+        "ttfb_ms": 50.0,
+        "ttft_ms": 500.0,
+        "decode_ms": 500.0,
+        "inter_token_ms": 250.0,
+        "total_ms": 2000.0,
+        "tokens_per_second": 20.0,
+        "prefill_tokens_per_second": 1000.0,
+    }
+
+
+def test_execute_records_profile_spans(monkeypatch, vlm_model):
+    profiles = []
+    monkeypatch.setattr(llm_lmstudio, "_profile_sink", profiles.append)
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+
+    class StreamResponse:
+        def raise_for_status(self):
+            return None
+
+        def iter_content(self, chunk_size=None):
+            return iter(
+                [
+                    b'data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n',
+                    b"data: [DONE]\n\n",
+                ]
+            )
+
+    monkeypatch.setattr(
+        llm_lmstudio.requests, "post", lambda *args, **kwargs: StreamResponse()
+    )
+    prompt = SimpleNamespace(
+        messages=[llm.user("Hello")], options=None, schema=None, tools=[]
+    )
+    events = list(
+        vlm_model.execute(
+            prompt=prompt,
+            stream=True,
+            response=MagicMock(spec=llm.Response),
+            conversation=None,
+        )
+    )
+
+    assert [event.chunk for event in events] == ["Hi"]
+    (profile,) = profiles
+    assert profile.model_id == vlm_model.model_id
+    assert [span.name for span in profile.spans] == [
+        "prepare_request",
+        "is_model_loaded",
+        "serialize",
+        "request",
+        "network",
+        "parse",
+    ]
+    assert all(span.duration >= 0 for span in profile.spans)
+
+
+def test_profiling_is_a_no_op_when_disabled(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "_profile_sink", None)
+    profile = llm_lmstudio._start_profile("lmstudio/model")
+    chunks = [b"a", b"b"]
+
+    assert profile is llm_lmstudio._NULL_PROFILE
+    assert profile.iter("network", chunks) is chunks
+    with profile.span("request"):
+        pass
+    profile.finish()
+
+
+def test_jsonl_profile_sink_appends_one_record_per_request(tmp_path):
+    path = tmp_path / "profile.jsonl"
+    sink = llm_lmstudio._select_profile_sink(f"jsonl:{path}")
+    for _ in range(2):
+        profile = llm_lmstudio.RequestProfile("lmstudio/model")
+        with profile.span("serialize"):
+            pass
+        list(profile.iter("network", iter([b"x"])))
+        sink(profile)
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert len(records) == 2
+    assert records[0]["model"] == "lmstudio/model"
+    assert [span["name"] for span in records[0]["spans"]] == ["serialize", "network"]
+    assert records[0]["request_id"] != records[1]["request_id"]
+
+
+def test_select_profile_sink_warns_on_unknown_value(capsys):
+    assert llm_lmstudio._select_profile_sink("flamegraph") is None
+    assert "Unknown LLM_LMSTUDIO_PROFILE" in capsys.readouterr().err
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = llm_lmstudio.MetricsRegistry()
+    monkeypatch.setattr(llm_lmstudio, "metrics", registry)
+    return registry
+
+
+def test_execute_records_request_and_token_metrics(monkeypatch, vlm_model, registry):
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+
+    class StreamResponse:
+        def raise_for_status(self):
+            return None
+
+        def iter_content(self, chunk_size=None):
+            return iter(
+                [
+                    b'data: {"choices":[{"delta":{"content":"Hi"}}]}\n\n',
+                    b'data: {"choices":[],"usage":{"prompt_tokens":7,"completion_tokens":2}}\n\n',
+                    b"data: [DONE]\n\n",
+                ]
+            )
+
+    monkeypatch.setattr(
+        llm_lmstudio.requests, "post", lambda *args, **kwargs: StreamResponse()
+    )
+    prompt = SimpleNamespace(
+        messages=[llm.user("Hello")], options=None, schema=None, tools=[]
+    )
+    list(
+        vlm_model.execute(
+            prompt=prompt,
+            stream=True,
+            response=MagicMock(spec=llm.Response),
+            conversation=None,
+        )
+    )
+
+    labels = {"server": vlm_model.base, "model": vlm_model.raw_id}
+    assert (
+        registry.value(
+            "lmstudio_requests_total", mode="stream", outcome="ok", **labels
+        )
+        == 1
+    )
+    assert registry.value("lmstudio_tokens_total", kind="prompt", **labels) == 7
+    assert registry.value("lmstudio_tokens_total", kind="completion", **labels) == 2
+    assert registry.value("lmstudio_request_duration_seconds", **labels) == 1
+    assert registry.value("lmstudio_time_to_first_token_seconds", **labels) == 1
+
+
+def test_execute_counts_timeouts(monkeypatch, vlm_model, registry):
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+    monkeypatch.setattr(
+        llm_lmstudio.requests,
+        "post",
+        MagicMock(side_effect=llm_lmstudio.requests.Timeout("slow")),
+    )
+    prompt = SimpleNamespace(
+        messages=[llm.user("Hello")], options=None, schema=None, tools=[]
+    )
+
+    with pytest.raises(llm.ModelError):
+        list(
+            vlm_model.execute(
+                prompt=prompt,
+                stream=False,
+                response=MagicMock(spec=llm.Response),
+                conversation=None,
+            )
+        )
+
+    assert (
+        registry.value(
+            "lmstudio_requests_total",
+            server=vlm_model.base,
+            model=vlm_model.raw_id,
+            mode="non_stream",
+            outcome="timeout",
+        )
+        == 1
+    )
+
+
+def test_embed_batch_records_metrics(monkeypatch, registry):
+    class EmbeddingResponse:
+        content = b'{"data": [{"embedding": [0.5, 1.0]}, {"embedding": [1.5, 2.0]}]}'
+
+        def raise_for_status(self):
+            return None
+
+    monkeypatch.setattr(
+        llm_lmstudio.requests, "post", lambda *args, **kwargs: EmbeddingResponse()
+    )
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://localhost:1234", "embed", "/api/v0"
+    )
+
+    assert list(model.embed_batch(["a", "b"])) == [[0.5, 1.0], [1.5, 2.0]]
+    labels = {"server": "http://localhost:1234", "model": "embed"}
+    assert (
+        registry.value("lmstudio_embedding_requests_total", outcome="ok", **labels)
+        == 1
+    )
+    assert registry.value("lmstudio_embedding_inputs_total", **labels) == 2
+
+
+def _embeddings_response(vectors):
+    body = {"data": [{"embedding": vector} for vector in vectors]}
+    return SimpleNamespace(
+        content=json.dumps(body).encode(), raise_for_status=lambda: None
+    )
+
+
+def _embeddings_error(text):
+    response = SimpleNamespace(status_code=400, text=text)
+    error = llm_lmstudio.requests.HTTPError("400 Client Error", response=response)
+    return SimpleNamespace(
+        status_code=400, text=text, raise_for_status=MagicMock(side_effect=error)
+    )
+
+
+def _embeddings_post(vector=lambda text: [float(text)], sent=None):
+    """A ``requests.post`` fake that embeds each input with ``vector``."""
+
+    def post(url, data=None, headers=None, timeout=None):
+        inputs = json.loads(data)["input"]
+        if sent is not None:
+            sent.append(inputs)
+        return _embeddings_response([vector(text) for text in inputs])
+
+    return post
+
+
+def test_embed_batch_runs_bounded_concurrent_batches_in_order(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_CONCURRENCY", 3)
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+    sizes = []
+
+    def post(url, data=None, headers=None, timeout=None):
+        inputs = json.loads(data)["input"]
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+            sizes.append(len(inputs))
+        # Later batches finish first.
+        time.sleep(0.02 / int(inputs[0]) if int(inputs[0]) else 0.03)
+        with lock:
+            in_flight.pop()
+        return _embeddings_response([[float(text)] for text in inputs])
+
+    monkeypatch.setattr(llm_lmstudio.requests, "post", post)
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://embed-pool-test:1234", "embed", "/api/v0"
+    )
+
+    vectors = list(model.embed_batch(str(i) for i in range(11)))
+
+    assert vectors == [[float(i)] for i in range(11)]
+    assert sorted(sizes) == [1, 2, 2, 2, 2, 2]
+    assert 1 < max(peak) <= 3
+    assert model.batch_size == 6
+
+
+def test_embedding_cache_sends_only_misses_upstream(monkeypatch, tmp_path, registry):
+    monkeypatch.setattr(
+        llm_lmstudio,
+        "_embedding_cache",
+        llm_lmstudio.EmbeddingCache(str(tmp_path / "embeddings.db"), 1024 * 1024),
+    )
+    sent = []
+    monkeypatch.setattr(
+        llm_lmstudio.requests,
+        "post",
+        _embeddings_post(lambda text: [len(text), 0.5], sent),
+    )
+
+    def model(quantization):
+        return llm_lmstudio.LMStudioEmbeddingModel(
+            "lmstudio/embed",
+            "http://localhost:1234",
+            "embed",
+            "/api/v0",
+            metadata={"quantization": quantization},
+        )
+
+    assert list(model("Q8_0").embed_batch(["a", "bb"])) == [[1.0, 0.5], [2.0, 0.5]]
+    assert list(model("Q8_0").embed_batch(["ccc", "a", "bb"])) == [
+        [3.0, 0.5],
+        [1.0, 0.5],
+        [2.0, 0.5],
+    ]
+    list(model("F16").embed_batch(["a"]))
+
+    assert sent == [["a", "bb"], ["ccc"], ["a"]]
+    labels = {"server": "http://localhost:1234", "model": "embed"}
+    assert registry.value("lmstudio_embedding_cache_total", outcome="hit", **labels) == 2
+    assert (
+        registry.value("lmstudio_embedding_cache_total", outcome="miss", **labels) == 4
+    )
+
+
+def test_embed_batch_decodes_base64_and_falls_back_to_floats(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "base64")
+    monkeypatch.setattr(llm_lmstudio, "_float_only_servers", set())
+    bodies = []
+    reject_base64 = []
+
+    def post(url, data=None, headers=None, timeout=None):
+        body = json.loads(data)
+        bodies.append(body)
+        if body.get("encoding_format") == "base64":
+            if reject_base64:
+                return _embeddings_error('{"error": "Unsupported encoding_format"}')
+            value = base64.b64encode(array("f", [0.5, -2.0]).tobytes()).decode()
+        else:
+            value = [0.25, 4.0]
+        return _embeddings_response([value])
+
+    monkeypatch.setattr(llm_lmstudio.requests, "post", post)
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://localhost:1234", "embed", "/api/v0"
+    )
+
+    assert list(model.embed_batch(["a"])) == [[0.5, -2.0]]
+    reject_base64.append(True)
+    assert list(model.embed_batch(["a"])) == [[0.25, 4.0]]
+    assert list(model.embed_batch(["a"])) == [[0.25, 4.0]]
+
+    assert [body.get("encoding_format") for body in bodies] == [
+        "base64",
+        "base64",
+        None,
+        None,
+    ]
+
+
+def test_embed_batch_keeps_base64_when_float_retry_fails_too(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "base64")
+    monkeypatch.setattr(llm_lmstudio, "_float_only_servers", set())
+    monkeypatch.setattr(
+        llm_lmstudio.requests,
+        "post",
+        lambda *args, **kwargs: _embeddings_error('{"error": "Invalid input"}'),
+    )
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://localhost:1234", "embed", "/api/v0"
+    )
+
+    with pytest.raises(llm.ModelError):
+        list(model.embed_batch(["malformed"]))
+
+    assert llm_lmstudio._float_only_servers == set()
+
+
+def test_pack_window_groups_similar_lengths_within_limits():
+    window = ["x" * 40, "a", "y" * 400, "bb", "z" * 44, "c"]
+
+    batches = llm_lmstudio._pack_window(window, max_items=2, max_tokens=30)
+
+    assert [batch.inputs for batch in batches] == [
+        ["a", "bb"],
+        ["c", "x" * 40],
+        ["z" * 44],
+        ["y" * 400],
+    ]
+    released = [
+        batch.fill([[float(len(text))] for text in batch.inputs])
+        for batch in batches
+    ]
+    # Positions 0-1 are ready after the second batch, 2-5 only after the last.
+    assert [len(vectors) for vectors in released] == [0, 2, 0, 4]
+    assert sum(released, []) == [[float(len(text))] for text in window]
+
+
+def test_embed_batch_splits_batches_the_server_rejects_as_too_large(
+    monkeypatch, registry
+):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 4)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_CONCURRENCY", 1)
+    monkeypatch.setattr(llm_lmstudio, "_float_only_servers", set())
+    sizes = []
+
+    def post(url, data=None, headers=None, timeout=None):
+        inputs = json.loads(data)["input"]
+        sizes.append(len(inputs))
+        if len(inputs) > 1:
+            return _embeddings_error(
+                '{"error": "Input length exceeds the context length"}'
+            )
+        return _embeddings_response([[float(inputs[0])]])
+
+    monkeypatch.setattr(llm_lmstudio.requests, "post", post)
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://localhost:1234", "embed", "/api/v0"
+    )
+
+    assert list(model.embed_batch(["1", "2", "3", "4"])) == [[1.0], [2.0], [3.0], [4.0]]
+    assert sizes == [4, 2, 1, 1, 2, 1, 1]
+    assert llm_lmstudio._float_only_servers == set()
+    assert (
+        registry.value(
+            "lmstudio_embedding_splits_total",
+            server="http://localhost:1234",
+            model="embed",
+        )
+        == 3
+    )
+
+
+def _embedding_member(base):
+    return llm_lmstudio.LMStudioAsyncEmbeddingModel(
+        f"lmstudio@{base}/embed", base, "embed", "/api/v0"
+    )
+
+
+def test_pooled_embedding_model_prefers_faster_servers():
+    fast, slow = _embedding_member("http://fast:1"), _embedding_member("http://slow:1")
+    pool = llm_lmstudio.LMStudioPooledEmbeddingModel(
+        "lmstudio@pool/embed", [fast, slow]
+    )
+    pool._loads[fast.base].rate = 100.0
+    pool._loads[slow.base].rate = 10.0
+
+    chosen = [pool._choose(10).base for _ in range(11)]
+
+    assert chosen == [fast.base] * 10 + [slow.base]
+
+
+def test_pooled_embedding_model_fails_over_and_keeps_order(monkeypatch, registry):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "float")
+    requests_module = llm_lmstudio.requests
+    served = []
+    embed = _embeddings_post(sent=served)
+
+    def post(url, data=None, headers=None, timeout=None):
+        if url.startswith("http://down:1"):
+            raise requests_module.ConnectionError("refused")
+        return embed(url, data=data)
+
+    monkeypatch.setattr(requests_module, "post", post)
+    down, up = _embedding_member("http://down:1"), _embedding_member("http://up:1")
+    pool = llm_lmstudio.LMStudioPooledEmbeddingModel("lmstudio@pool/embed", [down, up])
+
+    vectors = list(pool.embed_batch(str(i) for i in range(9)))
+
+    assert vectors == [[float(i)] for i in range(9)]
+    assert sorted(text for batch in served for text in batch) == sorted(
+        str(i) for i in range(9)
+    )
+    assert pool._loads[down.base].failed_until > 0
+    assert pool._loads[down.base].in_flight == pool._loads[up.base].in_flight == 0
+    assert registry.value("lmstudio_embedding_failovers_total", model="embed") >= 1
+
+
+def test_pooled_embedding_failover_respects_each_server_limit(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 1)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_CONCURRENCY", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "float")
+    requests_module = llm_lmstudio.requests
+    lock = threading.Lock()
+    active = peak = 0
+    embed = _embeddings_post()
+
+    def post(url, data=None, headers=None, timeout=None):
+        nonlocal active, peak
+        if url.startswith("http://down-limit:1"):
+            raise requests_module.ConnectionError("refused")
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.02)
+        with lock:
+            active -= 1
+        return embed(url, data=data)
+
+    monkeypatch.setattr(requests_module, "post", post)
+    down = _embedding_member("http://down-limit:1")
+    up = _embedding_member("http://up-limit:1")
+    pool = llm_lmstudio.LMStudioPooledEmbeddingModel("lmstudio@pool/embed", [down, up])
+
+    vectors = list(pool.embed_batch(str(i) for i in range(12)))
+
+    assert vectors == [[float(i)] for i in range(12)]
+    # Retries from the failed server wait for a slot on the healthy one.
+    assert peak <= 2
+    assert pool._loads[down.base].in_flight == pool._loads[up.base].in_flight == 0
+
+
+def test_register_embedding_models_pools_identical_models(monkeypatch):
+    servers = ["http://one:1234", "http://two:1234"]
+    monkeypatch.setattr(llm_lmstudio, "SERVER_LIST", servers)
+    embed = {"id": "embed", "type": "embeddings", "quantization": "F16"}
+    other = {"id": "other", "type": "embeddings", "quantization": "F16"}
+    listing = {"http://one:1234": [embed], "http://two:1234": [embed, other]}
+    monkeypatch.setattr(
+        llm_lmstudio, "_fetch_models", lambda base: (listing[base], "/api/v0")
+    )
+    registered = []
+
+    llm_lmstudio.register_embedding_models(registered.append)
+
+    pools = [
+        model
+        for model in registered
+        if isinstance(model, llm_lmstudio.LMStudioPooledEmbeddingModel)
+    ]
+    assert [pool.model_id for pool in pools] == ["lmstudio@pool/embed"]
+    assert [member.base for member in pools[0].members] == servers
+    assert len(registered) == 4
+
+
+def test_embed_batch_streams_generator_input_with_bounded_read_ahead(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_BATCH_SIZE", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_CONCURRENCY", 2)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "float")
+    monkeypatch.setattr(llm_lmstudio.requests, "post", _embeddings_post())
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed", "http://stream-test:1234", "embed", "/api/v0"
+    )
+    pulled = []
+
+    def corpus():
+        for i in range(10_000):
+            pulled.append(i)
+            yield str(i)
+
+    read_ahead = 0
+    for count, vector in enumerate(model.embed_batch(corpus()), 1):
+        assert vector == [float(count - 1)]
+        read_ahead = max(read_ahead, len(pulled) - count)
+
+    assert count == 10_000
+    # At most the window being yielded and the next one are read ahead.
+    assert read_ahead <= 2 * model.batch_size
+
+
+@pytest.mark.parametrize(
+    "precision, expected",
+    [
+        ("float32", [0.6, 0.8]),
+        ("float16", [0.60009765625, 0.7998046875]),
+        ("int8", [95.0, 127.0]),
+    ],
+)
+def test_embed_batch_truncates_and_reduces_precision(monkeypatch, precision, expected):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "float")
+    monkeypatch.setattr(
+        llm_lmstudio.requests, "post", _embeddings_post(lambda text: [3.0, 4.0, 12.0])
+    )
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed",
+        "http://reduce-test:1234",
+        "embed",
+        "/api/v0",
+        dimensions=2,
+        precision=precision,
+    )
+
+    (vector,) = model.embed_batch(["text"])
+
+    assert vector == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    "dimensions, precision, variant",
+    [
+        (256, "int8", ("embed-256d-int8", 256, "int8")),
+        (1024, "int8", ("embed-1024d-int8", 1024, "int8")),
+        (0, "float32", None),
+    ],
+)
+def test_register_embedding_models_adds_reduced_variants(
+    monkeypatch, dimensions, precision, variant
+):
+    monkeypatch.setattr(llm_lmstudio, "SERVER_LIST", ["http://one:1234"])
+    monkeypatch.setattr(llm_lmstudio, "EMBED_DIMENSIONS", dimensions)
+    monkeypatch.setattr(llm_lmstudio, "EMBED_PRECISION", precision)
+    embed = {"id": "embed", "type": "embeddings"}
+    listing = ([embed], "/api/v0")
+    monkeypatch.setattr(llm_lmstudio, "_fetch_models", lambda base: listing)
+    registered = []
+
+    llm_lmstudio.register_embedding_models(registered.append)
+
+    full, *reduced = registered
+    assert full.model_id == "embed"
+    assert (full.dimensions, full.precision) == (None, "float32")
+    assert [(m.model_id, m.dimensions, m.precision) for m in reduced] == (
+        [variant] if variant else []
+    )
+    # Variants share cached vectors, which are stored before reduction.
+    for model in reduced:
+        assert model._cache_keys(["a"]) == full._cache_keys(["a"])
+
+
+def test_embedding_models_are_registered_through_the_plugin_hook(monkeypatch):
+    monkeypatch.setattr(llm_lmstudio, "SERVER_LIST", ["http://one:1234"])
+    monkeypatch.setattr(llm_lmstudio, "EMBED_DIMENSIONS", 256)
+    embed = {"id": "embed", "type": "embeddings"}
+    monkeypatch.setattr(
+        llm_lmstudio, "_fetch_models", lambda base: ([embed], "/api/v0")
+    )
+
+    model_ids = [model.model_id for model in llm.get_embedding_models()]
+
+    assert "embed" in model_ids
+    assert "embed-256d" in model_ids
+
+
+def test_embed_batch_keeps_vectors_no_larger_than_the_dimensions(
+    monkeypatch, capsys
+):
+    monkeypatch.setattr(llm_lmstudio, "EMBED_ENCODING", "float")
+    monkeypatch.setattr(
+        llm_lmstudio.requests, "post", _embeddings_post(lambda text: [3.0, 4.0])
+    )
+    model = llm_lmstudio.LMStudioEmbeddingModel(
+        "lmstudio/embed-1024d",
+        "http://reduce-test:1234",
+        "embed",
+        "/api/v0",
+        dimensions=1024,
+    )
+
+    assert list(model.embed_batch(["a", "b"])) == [[3.0, 4.0], [3.0, 4.0]]
+    assert list(model.embed_batch(["c"])) == [[3.0, 4.0]]
+
+    assert model.model_id == "lmstudio/embed-1024d"
+    assert capsys.readouterr().err.count("LMSTUDIO_EMBED_DIMENSIONS=1024") == 1
+
+
+def test_select_embed_precision_warns_and_ignores_unknown_value(capsys):
+    assert llm_lmstudio._select_embed_precision("bfloat16") == "float32"
+    assert "Unknown LMSTUDIO_EMBED_PRECISION value 'bfloat16'" in (
+        capsys.readouterr().err
+    )
+
+
+def test_render_prometheus_formats_counters_and_histograms(registry):
+    registry.inc("lmstudio_requests_total", server="s", model='a"b', outcome="ok")
+    for seconds in (0.3, 500):
+        registry.observe(
+            "lmstudio_model_load_duration_seconds", seconds, server="s", model="m"
+        )
+
+    text = llm_lmstudio.render_prometheus()
+
+    assert "# TYPE lmstudio_requests_total counter" in text
+    assert 'lmstudio_requests_total{model="a\\"b",outcome="ok",server="s"} 1' in text
+    assert (
+        'lmstudio_model_load_duration_seconds_bucket{model="m",server="s",le="0.25"} 0'
+        in text
+    )
+    assert (
+        'lmstudio_model_load_duration_seconds_bucket{model="m",server="s",le="0.5"} 1'
+        in text
+    )
+    assert (
+        'lmstudio_model_load_duration_seconds_bucket{model="m",server="s",le="+Inf"} 2'
+        in text
+    )
+    assert 'lmstudio_model_load_duration_seconds_sum{model="m",server="s"} 500.3' in text
+
+
+def test_metrics_file_and_http_endpoint(registry, tmp_path):
+    registry.inc("lmstudio_discovery_total", server="s", outcome="ok")
+    path = tmp_path / "lmstudio.prom"
+
+    llm_lmstudio.write_metrics(str(path))
+    server = llm_lmstudio.start_metrics_server(port=0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as r:
+            served = r.read().decode("utf-8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert path.read_text() == served == llm_lmstudio.render_prometheus()
+    assert 'lmstudio_discovery_total{outcome="ok",server="s"} 1' in served
+
+
+@pytest.fixture
+def response_cache(monkeypatch, tmp_path):
+    cache = llm_lmstudio.ResponseCache(str(tmp_path / "responses.db"), 1024 * 1024)
+    monkeypatch.setattr(llm_lmstudio, "_response_cache", cache)
+    return cache
+
+
+def _tool_call_post(calls):
+    body = json.dumps(
+        {
+            "model": "test-vlm-raw-id",
+            "choices": [
+                {
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "content": "Checking.",
+                        "tool_calls": [
+                            {
+                                "id": "call_1",
+                                "function": {
+                                    "name": "get_weather",
+                                    "arguments": '{"location": "Berlin"}',
+                                },
+                            }
+                        ],
+                    },
+                }
+            ],
+            "usage": {"prompt_tokens": 12, "completion_tokens": 3},
+        }
+    ).encode("utf-8")
+
+    def post(url, data=None, headers=None, stream=False, timeout=None):
+        calls.append(json.loads(data))
+        return SimpleNamespace(content=body, raise_for_status=lambda: None)
+
+    return post
+
+
+def test_response_cache_replays_deterministic_response(
+    monkeypatch, vlm_model, response_cache, registry
+):
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+    calls = []
+    monkeypatch.setattr(llm_lmstudio.requests, "post", _tool_call_post(calls))
+    prompt = SimpleNamespace(
+        messages=[llm.user("Weather?")],
+        options=vlm_model.Options(temperature=0),
+        schema=None,
+        tools=[],
+    )
+
+    responses = []
+    outputs = []
+    for _ in range(2):
+        response = MagicMock(spec=llm.Response)
+        outputs.append(list(vlm_model.execute(prompt, False, response, None)))
+        responses.append(response)
+
+    assert len(calls) == 1
+    assert outputs[1] == outputs[0]
+    assert "Checking." in [getattr(e, "chunk", e) for e in outputs[1]]
+    first, second = responses
+    assert second.set_usage.call_args == first.set_usage.call_args
+    (tool_call,) = [c.args[0] for c in second.add_tool_call.call_args_list]
+    assert tool_call.name == "get_weather"
+    assert tool_call.arguments == {"location": "Berlin"}
+    assert tool_call.tool_call_id == "call_1"
+    assert second.response_json["cached"] is True
+    assert registry.value("lmstudio_response_cache_total", outcome="hit") == 1
+    assert registry.value("lmstudio_response_cache_total", outcome="miss") == 1
+    # Only the request that reached the server is counted as one.
+    labels = {"server": vlm_model.base, "model": vlm_model.raw_id}
+    assert (
+        registry.value(
+            "lmstudio_requests_total", mode="non_stream", outcome="ok", **labels
+        )
+        == 1
+    )
+    assert registry.value("lmstudio_request_duration_seconds", **labels) == 1
+
+
+def test_response_cache_skips_sampled_requests(monkeypatch, vlm_model, response_cache):
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+    calls = []
+    monkeypatch.setattr(llm_lmstudio.requests, "post", _tool_call_post(calls))
+    prompt = SimpleNamespace(
+        messages=[llm.user("Weather?")],
+        options=vlm_model.Options(temperature=0.7),
+        schema=None,
+        tools=[],
+    )
+
+    for _ in range(2):
+        list(vlm_model.execute(prompt, False, MagicMock(spec=llm.Response), None))
+
+    assert len(calls) == 2
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    entry = llm_lmstudio.CachedResponse(events=[{"text": "x" * 400}])
+    size = len(llm_lmstudio._codec.dumps(llm_lmstudio.asdict(entry)))
+    cache = llm_lmstudio.ResponseCache(str(tmp_path / "responses.db"), size * 2)
+
+    cache.put("a", entry)
+    cache.put("b", entry)
+    assert cache.get("a") == entry  # "b" is now the least recently used
+    cache.put("c", entry)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == entry
+    assert cache.get("c") == entry
+
+
+# Unit vectors: the paraphrase has cosine similarity 0.95 with "Weather?".
+SEMANTIC_VECTORS = {
+    "Weather?": [1.0, 0.0, 0.0],
+    "What is the weather like?": [0.95, 0.3122, 0.0],
+    "Tell me a joke.": [0.0, 0.0, 1.0],
+}
+
+
+@pytest.fixture
+def semantic_cache(monkeypatch, tmp_path):
+    model = SimpleNamespace(embed=SEMANTIC_VECTORS.__getitem__)
+    monkeypatch.setattr(llm, "get_embedding_model", lambda model_id: model)
+    cache = llm_lmstudio.SemanticCache(str(tmp_path / "semantic.db"), "embed", 0.9, 0)
+    monkeypatch.setattr(llm_lmstudio, "_semantic_cache", cache)
+    return cache
+
+
+def test_semantic_cache_replays_response_to_paraphrase(
+    monkeypatch, vlm_model, semantic_cache, registry
+):
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+    calls = []
+    monkeypatch.setattr(llm_lmstudio.requests, "post", _tool_call_post(calls))
+    responses = []
+    for text in ("Weather?", "What is the weather like?", "Tell me a joke."):
+        prompt = SimpleNamespace(
+            messages=[llm.user(text)],
+            options=vlm_model.Options(temperature=0.7),
+            schema=None,
+            tools=[],
+        )
+        response = MagicMock(spec=llm.Response)
+        list(vlm_model.execute(prompt, False, response, None))
+        responses.append(response)
+
+    assert len(calls) == 2  # the joke is not close enough to reuse
+    paraphrase = responses[1]
+    assert paraphrase.response_json["cached"] is True
+    similarity = paraphrase.response_json["semantic_similarity"]
+    assert similarity == pytest.approx(0.95, abs=1e-3)
+    (tool_call,) = [c.args[0] for c in paraphrase.add_tool_call.call_args_list]
+    assert tool_call.arguments == {"location": "Berlin"}
+    assert registry.value("lmstudio_semantic_cache_total", outcome="hit") == 1
+    assert registry.value("lmstudio_semantic_cache_total", outcome="miss") == 2
+    assert registry.value("lmstudio_semantic_cache_total", outcome="store") == 2
+
+
+def test_semantic_cache_scopes_entries_and_expires_them(monkeypatch, semantic_cache):
+    def request(system: str) -> llm_lmstudio.ChatRequest:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": "Weather?"},
+        ]
+        return llm_lmstudio.ChatRequest(
+            url="http://localhost:1234/api/v0/chat/completions",
+            payload={"model": "m", "messages": messages},
+            stream=False,
+            timeout=1,
+        )
+
+    entry = llm_lmstudio.CachedResponse(events=[{"text": "Sunny."}])
+    semantic_cache.store(semantic_cache.lookup(request("Be brief.")), entry)
+
+    assert semantic_cache.lookup(request("Be brief.")).hit == entry
+    assert semantic_cache.lookup(request("Be verbose.")).hit is None
+    semantic_cache.ttl = 60
+    later = time.time() + 61
+    monkeypatch.setattr(llm_lmstudio.time, "time", lambda: later)
+    assert semantic_cache.lookup(request("Be brief.")).hit is None
+
+
+def test_semantic_cache_treats_any_embedding_error_as_a_miss(
+    monkeypatch, vlm_model, semantic_cache, registry
+):
+    def embed(text):
+        raise ConnectionError("embedding server is down")
+
+    monkeypatch.setattr(
+        llm, "get_embedding_model", lambda model_id: SimpleNamespace(embed=embed)
+    )
+    monkeypatch.setattr(
+        llm_lmstudio.LMStudioModel, "_is_model_loaded", lambda self: True
+    )
+    calls = []
+    monkeypatch.setattr(llm_lmstudio.requests, "post", _tool_call_post(calls))
+    prompt = SimpleNamespace(
+        messages=[llm.user("Weather?")],
+        options=vlm_model.Options(),
+        schema=None,
+        tools=[],
+    )
+
+    list(vlm_model.execute(prompt, False, MagicMock(spec=llm.Response), None))
+
+    assert len(calls) == 1
+    assert registry.value("lmstudio_semantic_cache_total", outcome="error") == 1
+
+
+def test_semantic_cache_without_model_warns_and_is_disabled(capsys, tmp_path):
+    path = str(tmp_path / "semantic.db")
+
+    assert llm_lmstudio._select_semantic_cache(path, "") is None
+    assert "LMSTUDIO_SEMANTIC_CACHE_MODEL" in capsys.readouterr().err
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+
+    assert llm_lmstudio._percentile(values, 50) == 50.0
+    assert llm_lmstudio._percentile(values, 99) == 99.0
+    assert llm_lmstudio._percentile([7.0], 95) == 7.0
+    assert llm_lmstudio._percentile([], 50) is None
+
+
+def test_bench_command_prints_table_and_writes_json(monkeypatch, tmp_path):
+    model = llm_lmstudio.LMStudioAsyncModel(
+        "lmstudio/test", "http://localhost:1234", "test-model", "/api/v0"
+    )
+    row = {
+        "model": "lmstudio/test",
+        "server": "http://localhost:1234",
+        "load_s": 1.5,
+        "concurrency": 2,
+        "requests": 8,
+        "errors": 1,
+        "error_messages": ["busy"],
+        "wall_s": 2.0,
+        "ttft_ms_p50": 120.0,
+        "ttft_ms_p95": 300.0,
+        "latency_ms_p50": 900.0,
+        "latency_ms_p95": 1400.0,
+        "latency_ms_p99": 1500.0,
+        "stream_tokens_per_second": 42.5,
+        "aggregate_tokens_per_second": 80.25,
+    }
+    calls = []
+
+    async def fake_run_bench(models, prompts, levels, request_count, options):
+        calls.append((models, prompts, levels, request_count, options))
+        return [row]
+
+    monkeypatch.setattr(llm_lmstudio, "_bench_models", lambda ids, servers: [model])
+    monkeypatch.setattr(llm_lmstudio, "run_bench", fake_run_bench)
+    output = tmp_path / "bench.json"
+
+    result = CliRunner().invoke(
+        cli,
+        [
+            "lmstudio",
+            "bench",
+            "-c",
+            "1,2",
+            "-p",
+            "Hi",
+            "-o",
+            "max_tokens",
+            "16",
+            "--output",
+            str(output),
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert calls == [([model], ["Hi"], [1, 2], None, {"max_tokens": "16"})]
+    header, line = result.output.splitlines()
+    assert header.split() == [
+        "model", "conc", "reqs", "errs", "load", "s", "ttft", "p50", "ttft", "p95",
+        "tok/s", "agg", "tok/s", "p50", "ms", "p95", "ms", "p99", "ms",
+    ]  # fmt: skip
+    assert line.split() == [
+        "lmstudio/test", "2", "8", "1", "1.50", "120", "300", "42.5", "80.2",
+        "900", "1400", "1500",
+    ]  # fmt: skip
+    assert json.loads(output.read_text()) == [row]
+
+
+def test_bench_command_rejects_bad_concurrency():
+    result = CliRunner().invoke(cli, ["lmstudio", "bench", "-c", "0"])
+
+    assert result.exit_code != 0
+    assert "must be at least 1" in result.output
+
+
 def test_process_non_streaming_response(vlm_model):
     response = MagicMock()
     payload = {
@@ -870,17 +2116,14 @@ def test_three_step_tool_chain_sends_one_system_message(monkeypatch, vlm_model):
 
     class FakePostResponse:
         def __init__(self, payload):
-            self._payload = payload
             self.text = json.dumps(payload)
+            self.content = self.text.encode("utf-8")
 
         def raise_for_status(self):
             return None
 
-        def json(self):
-            return self._payload
-
-    def fake_post(url, json=None, stream=False, timeout=None):
-        requests_sent.append(json)
+    def fake_post(url, data=None, headers=None, stream=False, timeout=None):
+        requests_sent.append(json.loads(data))
         return FakePostResponse(next(api_responses))
 
     monkeypatch.setattr(llm_lmstudio.requests, "post", fake_post)